@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+ARTIFACT_MANIFEST_VERSION = 1
+HASH_BLOCK_SIZE = 1 << 20
+
+@dataclass
+class Artifact:
+    """A set of output files built by calling build(*args) from a set of input files, which can be the outputs of other
+        artifacts, with JSON-serializable params and the source files of the code that builds them.
+
+        The artifact is rebuilt only if the hash of its build function, params, input contents or code changes, or its
+        outputs are missing or modified since they were built.
+    """
+    name: str
+    outputs: list[str]
+    build: Callable[..., Any]
+    args: tuple = ()
+    inputs: list[str] = field(default_factory=list)
+    params: dict = field(default_factory=dict)
+    code: list[str] = field(default_factory=list)
+
+    def get_manifest_filename(self) -> str:
+        return self.outputs[0] + '.manifest.json'
+
+def get_file_sha256(filename: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        while block := file.read(HASH_BLOCK_SIZE):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+class FileHasher:
+    """Hash file contents, reusing known hashes of files whose size and mtime are unchanged, so that large inputs
+        like the ITDK datasets are only rehashed when they change."""
+    def __init__(self):
+        self.fingerprints: dict[str, dict] = {}
+
+    def add_known(self, fingerprints: dict[str, dict]) -> None:
+        for filename, fingerprint in fingerprints.items():
+            self.fingerprints.setdefault(filename, fingerprint)
+
+    def get_fingerprint(self, filename: str) -> dict:
+        stat = os.stat(filename)
+        known = self.fingerprints.get(filename)
+        if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known
+        fingerprint = { 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': get_file_sha256(filename) }
+        self.fingerprints[filename] = fingerprint
+        return fingerprint
+
+def read_manifest(manifest_file: str) -> Optional[dict]:
+    try:
+        with open(manifest_file) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('version') == ARTIFACT_MANIFEST_VERSION else None
+
+def write_manifest(manifest_file: str, key: str, inputs: dict[str, dict], outputs: dict[str, dict]) -> None:
+    tmp_file = f'{manifest_file}.tmp.{os.getpid()}'
+    with open(tmp_file, 'w') as file:
+        json.dump({ 'version': ARTIFACT_MANIFEST_VERSION, 'key': key, 'inputs': inputs, 'outputs': outputs },
+                  file, indent=1)
+    os.replace(tmp_file, manifest_file)
+
+def run_artifact_build(artifact: Artifact) -> None:
+    # Outputs may have been made read-only (chmod 440) after the last build, so they are replaced instead.
+    for output in artifact.outputs:
+        if os.path.exists(output):
+            os.remove(output)
+    artifact.build(*artifact.args)
+
+class ArtifactRunner:
+    """Build a DAG of artifacts in dependency order, skipping the ones that are up to date, and running independent
+        ones in parallel on up to `jobs` forked processes.
+
+        Each artifact records the hash of its build function, params, inputs and code in a manifest next to its first
+        output. An artifact whose rebuilt outputs have the same contents as before does not invalidate its dependents.
+    """
+    def __init__(self, artifacts: list[Artifact], jobs: int = 1, before_build: Optional[Callable[[], None]] = None):
+        self.artifacts = { artifact.name: artifact for artifact in artifacts }
+        self.jobs = jobs
+        self.before_build = before_build
+        self.hasher = FileHasher()
+        self.manifests: dict[str, Optional[dict]] = {}
+        producers = { output: artifact.name for artifact in artifacts for output in artifact.outputs }
+        self.dependencies = { artifact.name: set(producers[f] for f in artifact.inputs if f in producers)
+                              for artifact in artifacts }
+        for artifact in artifacts:
+            manifest = read_manifest(artifact.get_manifest_filename())
+            self.manifests[artifact.name] = manifest
+            if manifest is not None:
+                self.hasher.add_known(manifest['inputs'])
+                self.hasher.add_known(manifest['outputs'])
+
+    def get_key(self, artifact: Artifact) -> tuple[str, dict[str, dict]]:
+        """Return the hash of everything the outputs of an artifact depend on, along with the input fingerprints."""
+        inputs = { filename: self.hasher.get_fingerprint(filename) for filename in artifact.inputs }
+        key = {
+            'build': f'{artifact.build.__module__}.{artifact.build.__qualname__}',
+            'outputs': artifact.outputs,
+            'params': artifact.params,
+            'inputs': { filename: fingerprint['sha256'] for filename, fingerprint in inputs.items() },
+            'code': { filename: self.hasher.get_fingerprint(filename)['sha256'] for filename in artifact.code },
+        }
+        return (hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest(), inputs)
+
+    def is_up_to_date(self, artifact: Artifact, key: str) -> bool:
+        manifest = self.manifests[artifact.name]
+        if manifest is None or manifest['key'] != key:
+            return False
+        for output in artifact.outputs:
+            if not os.path.exists(output) or output not in manifest['outputs'] or \
+                self.hasher.get_fingerprint(output)['sha256'] != manifest['outputs'][output]['sha256']:
+                return False
+        return True
+
+    def on_built(self, artifact: Artifact, key: str, inputs: dict[str, dict]) -> None:
+        outputs = { output: self.hasher.get_fingerprint(output) for output in artifact.outputs }
+        write_manifest(artifact.get_manifest_filename(), key, inputs, outputs)
+
+    def run(self, dry_run: bool = False, force: bool = False) -> list[str]:
+        """Build the stale artifacts, or only log them if dry_run, and return their names in the order built."""
+        (done, built, stale) = (set(), [], set())
+        pending = list(self.artifacts)
+        running: dict[Future, tuple[Artifact, str, dict]] = {}
+        executor: Optional[ProcessPoolExecutor] = None
+        start_time = time.time()
+        try:
+            while pending or running:
+                ready = [name for name in pending if self.dependencies[name] <= done]
+                if not ready and not running:
+                    raise ValueError(f'Artifacts with circular dependencies: {pending}')
+                for name in ready:
+                    pending.remove(name)
+                    artifact = self.artifacts[name]
+                    if dry_run:
+                        # Outputs of stale dependencies are not rebuilt, so the dependents are assumed stale as well.
+                        if force or self.dependencies[name] & stale or not self.is_up_to_date(artifact,
+                                                                                             self.get_key(artifact)[0]):
+                            logging.info(f'Stale: {name}')
+                            stale.add(name)
+                            built.append(name)
+                        done.add(name)
+                        continue
+                    (key, inputs) = self.get_key(artifact)
+                    if not force and self.is_up_to_date(artifact, key):
+                        logging.debug(f'Up to date: {name}')
+                        done.add(name)
+                        continue
+                    if executor is None:
+                        if self.before_build is not None:
+                            self.before_build()
+                        # Workers are forked after before_build(), and thus share what it loads copy-on-write.
+                        executor = ProcessPoolExecutor(self.jobs, mp_context=multiprocessing.get_context('fork'))
+                    logging.info(f'Building {name} ...')
+                    running[executor.submit(run_artifact_build, artifact)] = (artifact, key, inputs)
+                if not running:
+                    continue
+                (finished, _) = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    (artifact, key, inputs) = running.pop(future)
+                    future.result()
+                    self.on_built(artifact, key, inputs)
+                    done.add(artifact.name)
+                    built.append(artifact.name)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        elapsed_time = time.time() - start_time
+        logging.info(f'Elapsed: {elapsed_time:.2f}s, {"found" if dry_run else "built"} {len(built)} stale artifacts '
+                     f'out of {len(self.artifacts)}')
+        return built
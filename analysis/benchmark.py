@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+import argparse
+import gc
+import hashlib
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+import carbon_client
+import lookup_cache
+from carbon_client import convert_latlon_to_carbon_region, init_offline_iso_resolver
+from common import RouteMetric, init_logging, iter_weighted_routes_from_file, load_aws_ip_ranges, \
+    load_gcloud_ip_ranges, load_itdk_node_id_to_ips_mapping
+from itdk_geo import convert_routes_from_ip_to_latlon
+from itdk_geo_table import get_node_geo_cache_dirpath, load_ip_node_table, load_node_geo_table, node_id_to_number
+from itdk_nodes import build_trie_from_ip_ranges, get_matching_node_ips
+from route_distribution import export_routes_file_distribution
+from synthetic_itdk import AWS_IP_RANGES_FILENAME, GCLOUD_IP_RANGES_FILENAME, ISO_GEOJSON_FILENAME, \
+    ITDK_LINKS_FILENAME, ITDK_NODE_GEO_FILENAME, ITDK_NODES_FILENAME, MANIFEST_FILENAME, ROUTES_FILENAME
+
+BENCHMARK_RESULTS_VERSION = 1
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+# Changes below these are within the noise of a laptop, and never flagged as regressions or improvements.
+MIN_ELAPSED_CHANGE_S = 0.05
+MIN_PEAK_RSS_CHANGE_MB = 32
+
+# The stages of the pipeline in the order they run, and the stages whose outputs each one needs.
+STAGES = ['node_load.ip_node_table', 'node_load.id_to_ips', 'node_geo_load', 'node_geo_load.cached', 'cloud_ip_match',
+          'graph_build', 'path_search', 'geo_conversion', 'iso_conversion', 'distribution_export.by_geo',
+          'distribution_export.by_iso']
+STAGE_DEPENDENCIES = {
+    'node_geo_load.cached': ['node_geo_load'],
+    'cloud_ip_match': ['node_load.id_to_ips'],
+    'graph_build': ['node_load.id_to_ips', 'node_geo_load'],
+    'path_search': ['graph_build', 'cloud_ip_match'],
+    'geo_conversion': ['node_load.ip_node_table', 'node_geo_load'],
+    'iso_conversion': ['geo_conversion'],
+    'distribution_export.by_geo': ['geo_conversion'],
+    'distribution_export.by_iso': ['iso_conversion'],
+}
+
+class StageSkipped(Exception):
+    """Raised by a stage that cannot run in this environment, e.g. without the compiled graph module."""
+
+@dataclass
+class StageResult:
+    elapsed_s: Optional[float] = None
+    # The peak RSS during the stage above the RSS at its start, or None if the peak RSS can't be reset.
+    peak_rss_mb: Optional[float] = None
+    # The number of items the stage produced, e.g. IPs, nodes, routes, to check that runs are comparable.
+    items: Optional[int] = None
+    # The SHA-256 of the stage output in a canonical form, e.g. the sorted distribution rows, to check that a change
+    #   keeps the same results, or None if the output is opaque, e.g. the graph.
+    digest: Optional[str] = None
+    skipped: Optional[str] = None
+
+def read_proc_status_mb(field: str) -> Optional[float]:
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss() -> bool:
+    """Reset the peak RSS (VmHWM) of this process to its current RSS, which is only supported on Linux."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+def get_sha256(chunks: Iterable[bytes]) -> str:
+    sha256 = hashlib.sha256()
+    for chunk in chunks:
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+def get_repr_sha256(items: Iterable) -> str:
+    return get_sha256(f'{item!r}\n'.encode() for item in items)
+
+def get_routes_file_digest(routes_file: str) -> str:
+    """Digest the decoded (route, count) pairs, so that the text and binary formats of the same routes are equal."""
+    return get_repr_sha256(iter_weighted_routes_from_file(routes_file, log=False))
+
+def get_distribution_file_digest(distribution_file: str) -> str:
+    """Digest the sorted rows of a distribution TSV, as the order of routes with the same count is arbitrary."""
+    with open(distribution_file) as file:
+        header = file.readline()
+        return get_repr_sha256([header] + sorted(file))
+
+def get_stage_dependencies(stages: list[str]) -> list[str]:
+    """Return the stages with all the stages they depend on, in the order of STAGES."""
+    required = set()
+    pending = list(stages)
+    while pending:
+        stage = pending.pop()
+        if stage not in required:
+            required.add(stage)
+            pending += STAGE_DEPENDENCIES.get(stage, [])
+    return [stage for stage in STAGES if stage in required]
+
+class PipelineBenchmark:
+    """Run each stage of the pipeline on a synthetic dataset of synthetic_itdk.py, measuring its elapsed time and peak
+        memory. Stages keep their outputs, e.g. the loaded tables or the converted routes files, as inputs of the
+        next stages, so each stage is measured alone."""
+    def __init__(self, data_dir: str, work_dir: str, repeat: int = 1):
+        self.data_dir = data_dir
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.ip_node_table = None
+        self.node_id_to_ips: Optional[dict[str, list]] = None
+        self.node_geo_table = None
+        self.matched_node_ips: Optional[dict] = None
+        self.graph = None
+        self.ip_to_unsigned_int: Optional[Callable[[str], int]] = None
+        self.paths: Optional[list] = None
+        self.stage_functions: dict[str, Callable[[], int]] = {
+            'node_load.ip_node_table': self.load_ip_node_table,
+            'node_load.id_to_ips': self.load_node_id_to_ips,
+            'node_geo_load': self.load_node_geo_table,
+            'node_geo_load.cached': self.load_node_geo_table,
+            'cloud_ip_match': self.match_cloud_ips,
+            'graph_build': self.build_graph,
+            'path_search': self.search_paths,
+            'geo_conversion': self.convert_routes_to_geo,
+            'iso_conversion': self.convert_routes_to_iso,
+            'distribution_export.by_geo': self.export_geo_distribution,
+            'distribution_export.by_iso': self.export_iso_distribution,
+        }
+        self.stage_digests: dict[str, Callable[[], Optional[str]]] = {
+            'node_load.ip_node_table': lambda: get_sha256([self.ip_node_table.ips.tobytes(),
+                                                           self.ip_node_table.node_numbers.tobytes()]),
+            'node_load.id_to_ips': lambda: get_repr_sha256(sorted(self.node_id_to_ips.items())),
+            'node_geo_load': self.get_node_geo_table_digest,
+            'node_geo_load.cached': self.get_node_geo_table_digest,
+            'cloud_ip_match': lambda: get_repr_sha256(sorted((node_id, sorted(matched_ips))
+                                                             for (node_id, matched_ips) in self.matched_node_ips.items())),
+            'graph_build': lambda: None,
+            'path_search': lambda: get_repr_sha256(sorted(map(repr, self.paths))),
+            'geo_conversion': lambda: get_routes_file_digest(self.get_work_file('routes.synthetic.by_geo')),
+            'iso_conversion': lambda: get_routes_file_digest(self.get_work_file('routes.synthetic.by_iso')),
+            'distribution_export.by_geo':
+                lambda: get_distribution_file_digest(self.get_work_file('routes.synthetic.by_geo.distribution')),
+            'distribution_export.by_iso':
+                lambda: get_distribution_file_digest(self.get_work_file('routes.synthetic.by_iso.distribution')),
+        }
+        self.can_reset_peak_rss = reset_peak_rss()
+        if not self.can_reset_peak_rss:
+            logging.warning('Cannot reset the peak RSS on this platform, memory usage is not measured per stage')
+
+    def get_data_file(self, filename: str) -> str:
+        return os.path.join(self.data_dir, filename)
+
+    def get_work_file(self, filename: str) -> str:
+        return os.path.join(self.work_dir, filename)
+
+    def load_ip_node_table(self) -> int:
+        self.ip_node_table = load_ip_node_table(self.get_data_file(ITDK_NODES_FILENAME))
+        return len(self.ip_node_table.ips)
+
+    def load_node_id_to_ips(self) -> int:
+        self.node_id_to_ips = load_itdk_node_id_to_ips_mapping(self.get_data_file(ITDK_NODES_FILENAME))
+        return len(self.node_id_to_ips)
+
+    def load_node_geo_table(self) -> int:
+        self.node_geo_table = load_node_geo_table(self.get_data_file(ITDK_NODE_GEO_FILENAME))
+        return len(self.node_geo_table.node_numbers)
+
+    def get_node_geo_table_digest(self) -> str:
+        return get_sha256([self.node_geo_table.node_numbers.tobytes(), self.node_geo_table.lat.tobytes(),
+                           self.node_geo_table.lon.tobytes()])
+
+    def match_cloud_ips(self) -> int:
+        ip_ranges = load_aws_ip_ranges(None, self.get_data_file(AWS_IP_RANGES_FILENAME)) + \
+            load_gcloud_ip_ranges(None, self.get_data_file(GCLOUD_IP_RANGES_FILENAME))
+        self.matched_node_ips = get_matching_node_ips(build_trie_from_ip_ranges(ip_ranges), self.node_id_to_ips)
+        return len(self.matched_node_ips)
+
+    def build_graph(self) -> int:
+        try:
+            from itdk_links import ip_to_unsigned_int, load_itdk_graph_from_links
+        except ImportError as ex:
+            raise StageSkipped(f'{ex}, build it with setup_pybind.sh')
+        # Same as remove_node_without_geo_coordinates() of itdk_links.py, over the synthetic node geo table.
+        node_ids = list(self.node_id_to_ips)
+        has_geo = np.isin(np.array([node_id_to_number(node_id) for node_id in node_ids], dtype=np.int64),
+                          self.node_geo_table.node_numbers)
+        node_id_to_ips = { node_id: self.node_id_to_ips[node_id]
+                           for (node_id, is_kept) in zip(node_ids, has_geo.tolist()) if is_kept }
+        self.graph = load_itdk_graph_from_links(node_id_to_ips, self.get_data_file(ITDK_LINKS_FILENAME))
+        self.ip_to_unsigned_int = ip_to_unsigned_int
+        return len(node_id_to_ips)
+
+    def search_paths(self) -> int:
+        if self.graph is None:
+            raise StageSkipped('graph_build was skipped')
+        # From the IPs of all other regions to the region with the most matched IPs, in one batch as itdk_links.py does.
+        ips_by_region: dict[str, list[str]] = {}
+        for matched_ips in self.matched_node_ips.values():
+            for (ip, _, (cloud, region)) in matched_ips:
+                ips_by_region.setdefault(f'{cloud}:{region}', []).append(ip)
+        if len(ips_by_region) < 2:
+            raise StageSkipped('fewer than 2 cloud regions with matched IPs')
+        dst_region = max(ips_by_region, key=lambda region: len(ips_by_region[region]))
+        src_ips = [self.ip_to_unsigned_int(ip) for (region, ips) in ips_by_region.items() if region != dst_region
+                   for ip in ips]
+        dst_ips = set(self.ip_to_unsigned_int(ip) for ip in ips_by_region[dst_region])
+        self.paths = self.graph.parallelDijkstra(src_ips, dst_ips)
+        return sum(1 for path in self.paths if path)
+
+    def convert_routes_to_geo(self) -> int:
+        return convert_routes_from_ip_to_latlon(
+            iter_weighted_routes_from_file(self.get_data_file(ROUTES_FILENAME), log=False), self.ip_node_table,
+            self.node_geo_table, lambda _: True, self.get_work_file('routes.synthetic.by_geo'))
+
+    def convert_routes_to_iso(self) -> int:
+        init_offline_iso_resolver(self.get_data_file(ISO_GEOJSON_FILENAME))
+        return convert_latlon_to_carbon_region(
+            iter_weighted_routes_from_file(self.get_work_file('routes.synthetic.by_geo'), log=False), lambda _: True,
+            self.get_work_file('routes.synthetic.by_iso'))
+
+    def export_geo_distribution(self) -> int:
+        with open(self.get_work_file('routes.synthetic.by_geo.distribution'), 'w') as file:
+            distribution = export_routes_file_distribution(self.get_work_file('routes.synthetic.by_geo'),
+                                                           [RouteMetric.HopCount, RouteMetric.DistanceKM], file,
+                                                           header=True)
+        return len(distribution)
+
+    def export_iso_distribution(self) -> int:
+        with open(self.get_work_file('routes.synthetic.by_iso.distribution'), 'w') as file:
+            distribution = export_routes_file_distribution(self.get_work_file('routes.synthetic.by_iso'),
+                                                           [RouteMetric.HopCount], file, header=True)
+        return len(distribution)
+
+    def reset_lookup_state(self) -> None:
+        """Reset the process-wide ISO resolvers and lookup cache, and start over from an empty lookup cache file in the
+            work directory, so that repeated runs of a stage start as cold as the first one, and the ISO lookups of
+            the benchmark are kept out of the shared lookup cache."""
+        carbon_client.offline_iso_resolver = None
+        carbon_client.spatial_iso_memo = None
+        if lookup_cache.lookup_cache is not None:
+            lookup_cache.lookup_cache.connection.close()
+            lookup_cache.lookup_cache = None
+        lookup_cache_file = self.get_work_file('lookup_cache.sqlite3')
+        os.environ[lookup_cache.LOOKUP_CACHE_PATH_ENV] = lookup_cache_file
+        for filename in [lookup_cache_file, f'{lookup_cache_file}-wal', f'{lookup_cache_file}-shm']:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def measure_stage(self, stage: str) -> StageResult:
+        self.reset_lookup_state()
+        if stage == 'node_geo_load':
+            # Measure the first load, which parses the geo file and builds the cache.
+            shutil.rmtree(get_node_geo_cache_dirpath(self.get_data_file(ITDK_NODE_GEO_FILENAME)), ignore_errors=True)
+        gc.collect()
+        self.can_reset_peak_rss = self.can_reset_peak_rss and reset_peak_rss()
+        start_rss_mb = read_proc_status_mb('VmRSS')
+        start_time = time.perf_counter()
+        items = self.stage_functions[stage]()
+        elapsed_time = time.perf_counter() - start_time
+        peak_rss_mb = read_proc_status_mb('VmHWM') if self.can_reset_peak_rss else None
+        return StageResult(elapsed_s=round(elapsed_time, 4), items=items, digest=self.stage_digests[stage](),
+                           peak_rss_mb=round(max(peak_rss_mb - start_rss_mb, 0), 1)
+                                       if peak_rss_mb is not None and start_rss_mb is not None else None)
+
+    def run_stage(self, stage: str) -> StageResult:
+        """Run a stage `repeat` times from the same cold state, and return the least elapsed time and the highest peak
+            memory of all runs."""
+        logging.info(f'Running stage {stage} ...')
+        results = []
+        try:
+            for _ in range(self.repeat):
+                results.append(self.measure_stage(stage))
+        except StageSkipped as ex:
+            logging.warning(f'Skipped stage {stage}: {ex}')
+            return StageResult(skipped=str(ex))
+        if len(set(result.digest for result in results)) > 1:
+            logging.warning(f'Stage {stage} produced different outputs across runs')
+        peak_rss_mbs = [result.peak_rss_mb for result in results if result.peak_rss_mb is not None]
+        result = StageResult(elapsed_s=min(result.elapsed_s for result in results),
+                             peak_rss_mb=max(peak_rss_mbs) if peak_rss_mbs else None, items=results[-1].items,
+                             digest=results[0].digest)
+        logging.info(f'Stage {stage}: {result}')
+        return result
+
+    def run(self, stages: list[str]) -> dict[str, StageResult]:
+        return { stage: self.run_stage(stage) for stage in get_stage_dependencies(stages) }
+
+def get_benchmark_results(stage_results: dict[str, StageResult], data_dir: str, repeat: int) -> dict:
+    with open(os.path.join(data_dir, MANIFEST_FILENAME)) as file:
+        manifest = json.load(file)
+    return {
+        'version': BENCHMARK_RESULTS_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        },
+        'repeat': repeat,
+        'dataset': manifest,
+        'stages': { stage: asdict(result) for (stage, result) in stage_results.items() },
+    }
+
+def get_change_status(value: Optional[float], baseline_value: Optional[float], threshold: float,
+                      min_change: float) -> str:
+    if value is None or baseline_value is None:
+        return ''
+    if abs(value - baseline_value) < min_change:
+        return 'ok'
+    if value > baseline_value * (1 + threshold):
+        return 'regression'
+    if value < baseline_value * (1 - threshold):
+        return 'improvement'
+    return 'ok'
+
+def format_change(value: Optional[float], baseline_value: Optional[float]) -> str:
+    if value is None or baseline_value is None:
+        return '-'
+    if not baseline_value:
+        return f'{value:+.4g}'
+    return f'{(value - baseline_value) / baseline_value:+.1%}'
+
+def compare_with_baseline(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Print the change of each stage from the baseline, and return the stages that regressed in time or memory, or
+        whose output differs from the baseline."""
+    if results['dataset'] != baseline.get('dataset'):
+        logging.warning('The dataset differs from the one of the baseline, the results may not be comparable')
+    regressed_stages = []
+    print('\t'.join(['stage', 'elapsed_s', 'baseline_elapsed_s', 'elapsed_change', 'peak_rss_mb',
+                     'baseline_peak_rss_mb', 'peak_rss_change', 'status']))
+    for (stage, result) in results['stages'].items():
+        baseline_result = baseline['stages'].get(stage)
+        if baseline_result is None:
+            print('\t'.join([stage] + ['-'] * 6 + ['new']))
+            continue
+        if result['skipped'] or baseline_result['skipped']:
+            print('\t'.join([stage] + ['-'] * 6 + ['skipped']))
+            continue
+        if result['items'] != baseline_result['items']:
+            logging.warning(f'Stage {stage} produced {result["items"]} items, {baseline_result["items"]} in baseline')
+        is_output_changed = result['digest'] is not None and baseline_result.get('digest') is not None and \
+            result['digest'] != baseline_result['digest']
+        if is_output_changed:
+            logging.error(f'Stage {stage} output differs from the baseline')
+        statuses = [get_change_status(result['elapsed_s'], baseline_result['elapsed_s'], threshold,
+                                      MIN_ELAPSED_CHANGE_S),
+                    get_change_status(result['peak_rss_mb'], baseline_result['peak_rss_mb'], threshold,
+                                      MIN_PEAK_RSS_CHANGE_MB)]
+        status = 'output_changed' if is_output_changed else 'regression' if 'regression' in statuses else \
+            'improvement' if 'improvement' in statuses else 'ok'
+        if status in ('regression', 'output_changed'):
+            regressed_stages.append(stage)
+        print('\t'.join([stage,
+                         str(result['elapsed_s']), str(baseline_result['elapsed_s']),
+                         format_change(result['elapsed_s'], baseline_result['elapsed_s']),
+                         str(result['peak_rss_mb']), str(baseline_result['peak_rss_mb']),
+                         format_change(result['peak_rss_mb'], baseline_result['peak_rss_mb']),
+                         status]))
+    return regressed_stages
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the elapsed time and peak memory of each stage of the '
+                                                 'pipeline on a synthetic dataset of synthetic_itdk.py, and compare '
+                                                 'them with a baseline.')
+    parser.add_argument('--data-dir', required=True, help='The synthetic dataset directory of synthetic_itdk.py.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES,
+                        help='The stages to run, along with the stages they depend on, default to all stages.')
+    parser.add_argument('--work-dir',
+                        help='The directory to write the converted routes and distributions to, default to a temporary '
+                             'directory that is removed afterwards.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='The number of times to run each stage, keeping the least elapsed time and the highest '
+                             'peak memory, to reduce the noise of a single run.')
+    parser.add_argument('-o', '--output', help='The JSON file to write the results to, e.g. to be used as a baseline.')
+    parser.add_argument('--baseline', help='The JSON results of a previous run to compare with.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help=f'The relative change from the baseline to report as a regression or improvement, '
+                             f'default to {DEFAULT_REGRESSION_THRESHOLD}.')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='Exit with status 1 if any stage regressed from the baseline, or its output differs from it.')
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.data_dir, MANIFEST_FILENAME)):
+        parser.error(f'{args.data_dir} is not a dataset of synthetic_itdk.py, {MANIFEST_FILENAME} is missing')
+    if args.fail_on_regression and not args.baseline:
+        parser.error('--baseline must be specified when --fail-on-regression is specified')
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    if args.threshold <= 0:
+        parser.error('--threshold must be positive')
+
+    return args
+
+def main():
+    init_logging(level=logging.INFO)
+    args = parse_args()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    with tempfile.TemporaryDirectory(prefix='benchmark.') as tmp_dirpath:
+        work_dir = args.work_dir or tmp_dirpath
+        os.makedirs(work_dir, exist_ok=True)
+        stage_results = PipelineBenchmark(args.data_dir, work_dir, args.repeat).run(args.stages or STAGES)
+    results = get_benchmark_results(stage_results, args.data_dir, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        logging.info(f'Wrote the results to {args.output}')
+    if baseline is None:
+        print('\t'.join(['stage', 'elapsed_s', 'peak_rss_mb', 'items']))
+        for (stage, result) in results['stages'].items():
+            print('\t'.join([stage] + (['skipped'] * 3 if result['skipped'] else
+                                       [str(result['elapsed_s']), str(result['peak_rss_mb']), str(result['items'])])))
+        return
+    regressed_stages = compare_with_baseline(results, baseline, args.threshold)
+    if regressed_stages:
+        logging.warning(f'Regressed stages: {", ".join(regressed_stages)}')
+        if args.fail_on_regression:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -4,24 +4,168 @@ import argparse
 import csv
 import io
 import logging
-import sys
+import time
 import traceback
-from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
 
-import requests_cache
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from common import Coordinate, RouteInCoordinate, RouteInISO, get_routes_from_file, CARBON_API_URL, init_logging
+from common import Coordinate, RouteInISO, WeightedRoute, iter_chunks, \
+    iter_weighted_routes_from_file, CARBON_API_URL, init_logging
+from lookup_cache import NAMESPACE_CARBON_REGION, get_coordinate_key, get_lookup_cache
+from route_format import HOP_TYPE_ISO, RouteWriter, is_weighted_routes_file
 
-session = requests_cache.CachedSession('carbon_cache', backend='filesystem')
+# Max number of concurrent carbon API requests, and the optional bulk lookup path, e.g. '/balancing-authority/batch/'.
+CARBON_API_MAX_WORKERS = 16
+CARBON_API_BULK_BATCH_SIZE = 1000
+carbon_api_bulk_path: Optional[str] = None
+
+carbon_api_max_workers = CARBON_API_MAX_WORKERS
+
+def create_session(max_workers: int) -> requests.Session:
+    """Create a session with a keep-alive connection pool sized for the concurrent lookups, that retries failed
+        requests with exponential backoff. Responses are cached by the shared lookup cache instead.
+
+        Once the retries are exhausted, the last error response is returned rather than raised, so that the lookup is
+        recorded as Unknown, and connection errors are caught by the callers likewise."""
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET', 'POST'], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+session = create_session(CARBON_API_MAX_WORKERS)
+
+def configure_carbon_api(max_workers: int, bulk_path: Optional[str]) -> None:
+    global session, carbon_api_max_workers, carbon_api_bulk_path
+    if max_workers != carbon_api_max_workers:
+        session = create_session(max_workers)
+        carbon_api_max_workers = max_workers
+    carbon_api_bulk_path = bulk_path
+
+# The in-process resolver over local ISO boundaries, if initialized, with the carbon API as a fallback, and the
+#   grid memo on top of both.
+offline_iso_resolver = None
+spatial_iso_memo = None
+ISO_GRID_CELL_SIZE_DEG = 0.1
+
+def init_offline_iso_resolver(iso_geojson: str, grid_cell_size_deg: float = ISO_GRID_CELL_SIZE_DEG) -> None:
+    global offline_iso_resolver, spatial_iso_memo
+    from iso_resolver import OfflineIsoResolver, SpatialIsoMemo
+    offline_iso_resolver = OfflineIsoResolver(iso_geojson)
+    if grid_cell_size_deg > 0:
+        spatial_iso_memo = SpatialIsoMemo(offline_iso_resolver, resolve_carbon_regions_from_coordinates,
+                                          grid_cell_size_deg)
+
+def log_spatial_iso_memo_stats() -> None:
+    if spatial_iso_memo is not None:
+        logging.info(f'ISO grid memo stats: {spatial_iso_memo.get_stats()}')
 
 def get_carbon_region_from_coordinate(coordinate: tuple[float, float]) -> str:
+    if spatial_iso_memo is not None:
+        return spatial_iso_memo.resolve([coordinate])[0]
+    if offline_iso_resolver is not None:
+        iso = offline_iso_resolver.resolve([coordinate])[0]
+        if iso is not None:
+            return iso
+    cache = get_lookup_cache()
+    key = get_coordinate_key(coordinate)
+    iso = cache.get(NAMESPACE_CARBON_REGION, key)
+    if iso is None:
+        iso = get_carbon_region_from_coordinate_via_api(coordinate)
+        if iso != 'Unknown':
+            cache.put(NAMESPACE_CARBON_REGION, key, iso)
+    return iso
+
+def get_carbon_regions_from_coordinates(coordinates: list[Coordinate]) -> list[str]:
+    """Batched version of get_carbon_region_from_coordinate(), which goes through the grid memo if initialized."""
+    if spatial_iso_memo is not None:
+        return spatial_iso_memo.resolve(coordinates)
+    return resolve_carbon_regions_from_coordinates(coordinates)
+
+def resolve_carbon_regions_from_coordinates(coordinates: list[Coordinate]) -> list[str]:
+    """Resolve all coordinates offline at once if possible, then from the lookup cache, and look up the remaining ones
+        via the carbon API, in bulk or concurrently."""
+    if offline_iso_resolver is not None:
+        isos = offline_iso_resolver.resolve(coordinates)
+    else:
+        isos = [None] * len(coordinates)
+    unresolved_indices = [i for i in range(len(coordinates)) if isos[i] is None]
+    if offline_iso_resolver is not None:
+        logging.info(f'Resolved {len(coordinates) - len(unresolved_indices)}/{len(coordinates)} coordinates offline')
+
+    cache = get_lookup_cache()
+    keys = [get_coordinate_key(coordinates[i]) for i in unresolved_indices]
+    cached_isos = cache.get_many(NAMESPACE_CARBON_REGION, keys)
+    uncached = [(i, key) for (i, key) in zip(unresolved_indices, keys) if key not in cached_isos]
+    logging.info(f'Found {len(unresolved_indices) - len(uncached)}/{len(unresolved_indices)} coordinates in cache')
+    for (i, key) in zip(unresolved_indices, keys):
+        isos[i] = cached_isos.get(key)
+
+    uncached_isos = get_carbon_regions_from_coordinates_via_api([coordinates[i] for (i, _) in uncached])
+    for (i, _), iso in zip(uncached, uncached_isos):
+        isos[i] = iso
+    cache.put_many(NAMESPACE_CARBON_REGION,
+                   { key: iso for (_, key), iso in zip(uncached, uncached_isos) if iso != 'Unknown' })
+    return isos
+
+def get_carbon_regions_from_coordinates_via_api(coordinates: list[Coordinate]) -> list[str]:
+    global carbon_api_bulk_path
+    if not coordinates:
+        return []
+    logging.info(f'Looking up {len(coordinates)} coordinates via the carbon API ...')
+    start_time = time.time()
+    isos = None
+    if carbon_api_bulk_path:
+        isos = get_carbon_regions_from_coordinates_via_bulk_api(coordinates)
+        if isos is None:
+            logging.warning(f'Bulk lookup via {carbon_api_bulk_path} is not supported, falling back to single lookups')
+            carbon_api_bulk_path = None
+    if isos is None:
+        with ThreadPoolExecutor(max_workers=carbon_api_max_workers) as executor:
+            isos = list(executor.map(get_carbon_region_from_coordinate_via_api, coordinates))
+    elapsed_time = time.time() - start_time
+    unknown_count = isos.count('Unknown')
+    logging.info(f'Elapsed: {elapsed_time:.2f}s, looked up {len(coordinates)} coordinates, {unknown_count} failed')
+    if unknown_count:
+        logging.warning(f'Failed to look up {unknown_count}/{len(coordinates)} coordinates, recorded as Unknown')
+    return isos
+
+def get_carbon_regions_from_coordinates_via_bulk_api(coordinates: list[Coordinate]) -> Optional[list[str]]:
+    """Look up coordinates in batches using the bulk endpoint, which takes a JSON list of {latitude, longitude} and
+        returns a list of {iso} in the same order. Return None if the server has no such endpoint."""
+    isos: list[str] = []
+    for i in range(0, len(coordinates), CARBON_API_BULK_BATCH_SIZE):
+        batch = coordinates[i:i + CARBON_API_BULK_BATCH_SIZE]
+        try:
+            response = session.post(f'{CARBON_API_URL}{carbon_api_bulk_path}', params={ 'iso_format': 'emap' },
+                                    json=[{ 'latitude': lat, 'longitude': lon } for (lat, lon) in batch])
+            if response.status_code in [404, 405]:
+                return None
+            assert response.ok, "Bulk carbon region lookup failed (%d): %s" % (response.status_code, response.text)
+            response_json = response.json()
+            assert isinstance(response_json, list) and len(response_json) == len(batch), \
+                'Invalid bulk carbon region lookup response: %s' % response.text
+            isos += [e.get('iso', 'Unknown') if isinstance(e, dict) else 'Unknown' for e in response_json]
+        except Exception as ex:
+            logging.error(ex)
+            logging.error(traceback.format_exc())
+            isos += ['Unknown'] * len(batch)
+    return isos
+
+def get_carbon_region_from_coordinate_via_api(coordinate: tuple[float, float]) -> str:
     (latitude, longitude) = coordinate
-    response = session.get(f'{CARBON_API_URL}/balancing-authority/', params={
-        'latitude': latitude,
-        'longitude': longitude,
-        'iso_format': 'emap',
-    })
     try:
+        response = session.get(f'{CARBON_API_URL}/balancing-authority/', params={
+            'latitude': latitude,
+            'longitude': longitude,
+            'iso_format': 'emap',
+        })
         assert response.ok, "Carbon region lookup failed for %s (%d): %s" % (coordinate, response.status_code, response.text)
         response_json = response.json()
         assert 'iso' in response_json, 'Invalid carbon region lookup response %s: %s' % (coordinate, response.text)
@@ -31,22 +175,22 @@ def get_carbon_region_from_coordinate(coordinate: tuple[float, float]) -> str:
         logging.error(traceback.format_exc())
         return 'Unknown'
 
-def convert_latlon_to_carbon_region(routes: list[RouteInCoordinate],
-                                    is_valid_route: Callable[[RouteInISO], bool],
-                                    output: Optional[io.TextIOWrapper] = None):
-    logging.info('Converting lat/lon to carbon region ...')
+def convert_latlon_chunk_to_carbon_region(weighted_routes: list[WeightedRoute],
+                                          is_valid_route: Callable[[RouteInISO], bool]) -> list[WeightedRoute]:
+    """Convert a chunk of (route, count) to carbon regions, looking up each unique coordinate in the chunk once, and
+        return the valid ones with their counts. Coordinates repeated across chunks are served by the lookup cache."""
     coordinates: set[Coordinate] = set()
-    for route in routes:
+    for (route, _) in weighted_routes:
         for coordinate in route:
             coordinates.add(coordinate)
 
-    d_coordinate_to_carbon_region: dict[Coordinate, str] = {}
-    for coordinate in coordinates:
-        d_coordinate_to_carbon_region[coordinate] = get_carbon_region_from_coordinate(coordinate)
+    l_coordinates = list(coordinates)
+    d_coordinate_to_carbon_region: dict[Coordinate, str] = \
+        dict(zip(l_coordinates, get_carbon_regions_from_coordinates(l_coordinates)))
 
-    routes_in_carbon_region: list[RouteInISO] = []
-    for route in routes:
-        route_in_carbon_region: list[str] = []
+    routes_in_carbon_region: list[WeightedRoute] = []
+    for (route, count) in weighted_routes:
+        route_in_carbon_region: RouteInISO = []
         for coordinate in route:
             carbon_region = d_coordinate_to_carbon_region[coordinate]
             route_in_carbon_region.append(carbon_region)
@@ -54,14 +198,26 @@ def convert_latlon_to_carbon_region(routes: list[RouteInCoordinate],
         if not is_valid_route(route_in_carbon_region):
             continue
 
-        routes_in_carbon_region.append(route_in_carbon_region)
-        print(route_in_carbon_region, file=output if output else sys.stdout)
+        routes_in_carbon_region.append((route_in_carbon_region, count))
+    return routes_in_carbon_region
 
-    if output:
-        output.close()
+def convert_latlon_to_carbon_region(weighted_routes: Iterable[WeightedRoute],
+                                    is_valid_route: Callable[[RouteInISO], bool],
+                                    output_file: Optional[str] = None,
+                                    weighted: bool = False) -> int:
+    """Convert a stream of (route, count) to carbon regions chunk by chunk, writing out each chunk as soon as it's
+        converted, with the counts if weighted, and return the number of converted routes."""
+    logging.info('Converting lat/lon to carbon region ...')
+    (converted_count, total_count) = (0, 0)
+    with RouteWriter(output_file, HOP_TYPE_ISO, weighted=weighted) as writer:
+        for chunk in iter_chunks(weighted_routes):
+            routes_in_carbon_region = convert_latlon_chunk_to_carbon_region(chunk, is_valid_route)
+            writer.write_weighted(routes_in_carbon_region)
+            converted_count += len(routes_in_carbon_region)
+            total_count += len(chunk)
 
-    logging.info('Converted/Total: %d/%d', len(routes_in_carbon_region), len(routes))
-    return routes_in_carbon_region
+    logging.info('Converted/Total: %d/%d', converted_count, total_count)
+    return converted_count
 
 def load_region_to_iso_groud_truth(iso_ground_truth_csv: io.TextIOWrapper):
     with iso_ground_truth_csv as f:
@@ -94,7 +250,7 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--routes_file', type=str, required=True,
                         help='The routes file, each line contains a list of (lat, long) coordinates and represents a route.')
-    parser.add_argument('-o', '--output', type=argparse.FileType('w'), help='The output file.')
+    parser.add_argument('-o', '--output', type=str, help='The output file, in the binary format if it ends with .bin.')
     parser.add_argument('--convert-latlon-to-carbon-region', action='store_true', required=True,
                         help='Convert the routes from lat/lon coordinates to Carbon region names.')
     parser.add_argument('--filter-iso-by-ground-truth', action='store_true',
@@ -105,6 +261,15 @@ def parse_args():
     parser.add_argument('--dst-cloud', required=False, help='The destination cloud')
     parser.add_argument('--src-region', required=False, help='The source region')
     parser.add_argument('--dst-region', required=False, help='The destination region')
+    parser.add_argument('--iso-geojson', required=False,
+                        help='The GeoJSON file of ISO boundaries to resolve coordinates offline, '
+                             'and only fall back to the carbon API for coordinates outside of any boundary.')
+    parser.add_argument('--iso-grid-cell-deg', type=float, default=ISO_GRID_CELL_SIZE_DEG,
+                        help='The grid cell size in degrees to memoize ISO lookups with --iso-geojson, 0 to disable.')
+    parser.add_argument('--api-concurrency', type=int, default=CARBON_API_MAX_WORKERS,
+                        help='The max number of concurrent carbon API requests.')
+    parser.add_argument('--api-bulk-path', required=False,
+                        help='The path of the bulk lookup endpoint of the carbon API, if supported by the server.')
     args = parser.parse_args()
 
     if args.filter_iso_by_ground_truth:
@@ -126,8 +291,11 @@ def parse_args():
 def main():
     init_logging(level=logging.INFO)
     args = parse_args()
+    if args.iso_geojson:
+        init_offline_iso_resolver(args.iso_geojson, args.iso_grid_cell_deg)
+    configure_carbon_api(args.api_concurrency, args.api_bulk_path)
     if args.convert_latlon_to_carbon_region:
-        routes = get_routes_from_file(args.routes_file)
+        routes = iter_weighted_routes_from_file(args.routes_file)
         if args.filter_iso_by_ground_truth:
             iso_ground_truth = load_region_to_iso_groud_truth(args.iso_ground_truth_csv)
             check_route_by_ground_truth = \
@@ -136,7 +304,10 @@ def main():
                                                          args.src_region, args.dst_region)
         else:
             check_route_by_ground_truth = lambda _: True
-        convert_latlon_to_carbon_region(routes, check_route_by_ground_truth, args.output)
+        # Weighted routes stay weighted, as each unique route converts to one route with the same count.
+        convert_latlon_to_carbon_region(routes, check_route_by_ground_truth, args.output,
+                                        is_weighted_routes_file(args.routes_file))
+        log_spatial_iso_memo_stats()
     else:
         raise ValueError('No action specified')
 
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from common import RegionPair, WeightedRoute, detect_cloud_regions_from_filename, init_logging
+
+UNKNOWN_ISO = 'Unknown'
+# The columns of the carbon intensity CSV, one row per ISO and timestamp, e.g. as exported from Electricity Maps.
+CARBON_INTENSITY_COLUMNS = ['timestamp', 'iso', 'carbon_intensity']
+
+def get_hop_weight_matrix(weighted_routes: Iterable[WeightedRoute], isos: list[str]) -> tuple[csr_matrix, np.ndarray]:
+    """Reduce routes of ISOs into a sparse (route x ISO) matrix of the share of the hops of each route in each ISO,
+        along with the count of each route.
+
+        Hops in unknown ISOs, or in ISOs not in `isos`, are left out of the shares, so the row of a route without any
+        known hop is all zeros.
+    """
+    iso_indices = { iso: i for i, iso in enumerate(isos) }
+    (rows, columns, shares, counts) = ([], [], [], [])
+    for row, (route, count) in enumerate(weighted_routes):
+        known_indices = [iso_indices[hop] for hop in route if hop in iso_indices]
+        counts.append(count)
+        if not known_indices:
+            continue
+        rows += [row] * len(known_indices)
+        columns += known_indices
+        shares += [1 / len(known_indices)] * len(known_indices)
+    # Duplicate (route, ISO) entries are summed up, e.g. two hops in the same ISO.
+    matrix = csr_matrix((shares, (rows, columns)), shape=(len(counts), len(isos)), dtype=np.float64)
+    return matrix, np.array(counts, dtype=np.float64)
+
+def get_iso_weights(hop_weight_matrix: csr_matrix, counts: np.ndarray) -> np.ndarray:
+    """Return the weight of each ISO across all routes, weighted by the route counts, where the weights sum up to 1
+        unless no route has any known hop."""
+    has_known_hops = np.diff(hop_weight_matrix.indptr) > 0
+    total_count = counts[has_known_hops].sum()
+    if total_count == 0:
+        return np.zeros(hop_weight_matrix.shape[1])
+    return hop_weight_matrix.T @ counts / total_count
+
+def to_timestamp(time: datetime, index: pd.DatetimeIndex) -> pd.Timestamp:
+    """Convert a time to compare with the index, where naive times are in UTC."""
+    timestamp = pd.Timestamp(time)
+    if index.tz is not None and timestamp.tzinfo is None:
+        return timestamp.tz_localize('UTC')
+    if index.tz is None and timestamp.tzinfo is not None:
+        return timestamp.tz_convert('UTC').tz_localize(None)
+    return timestamp
+
+def load_carbon_intensities(carbon_intensity_csv: str, start_time: Optional[datetime] = None,
+                            end_time: Optional[datetime] = None) -> pd.DataFrame:
+    """Load the carbon intensity series of each ISO within [start_time, end_time] into a (time x ISO) dataframe.
+
+        Missing values are interpolated in time within each ISO, and filled with the nearest value at both ends.
+    """
+    logging.info(f'Loading carbon intensities from {carbon_intensity_csv} ...')
+    df = pd.read_csv(carbon_intensity_csv, usecols=CARBON_INTENSITY_COLUMNS)
+    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    intensities = df.pivot_table(index='timestamp', columns='iso', values='carbon_intensity', aggfunc='mean')
+    if start_time is not None:
+        intensities = intensities[intensities.index >= to_timestamp(start_time, intensities.index)]
+    if end_time is not None:
+        intensities = intensities[intensities.index <= to_timestamp(end_time, intensities.index)]
+    return intensities.interpolate(method='time', limit_direction='both')
+
+def calculate_cidt_timeseries(weighted_routes: Iterable[WeightedRoute], intensities: pd.DataFrame) -> pd.Series:
+    """Calculate the carbon intensity of data transfer (CIDT) at each timestamp, as the average carbon intensity of
+        the hops of each route, averaged across the routes weighted by their counts.
+
+        The routes are reduced to one weight per ISO first, so the whole series is a single (time x ISO) @ (ISO)
+        product. Hops in ISOs without any carbon intensity are ignored.
+    """
+    isos = [iso for iso in intensities.columns if iso != UNKNOWN_ISO and intensities[iso].notna().any()]
+    (hop_weight_matrix, counts) = get_hop_weight_matrix(weighted_routes, isos)
+    iso_weights = get_iso_weights(hop_weight_matrix, counts)
+    unknown_count = counts[np.diff(hop_weight_matrix.indptr) == 0].sum()
+    if unknown_count:
+        logging.warning(f'Ignored {unknown_count:.0f} out of {counts.sum():.0f} routes without any hop in the '
+                        f'{len(isos)} ISOs with carbon intensities')
+    cidts = intensities[isos].to_numpy(dtype=np.float64) @ iso_weights
+    return pd.Series(cidts, index=intensities.index, name='cidt')
+
+def iter_weighted_routes_from_distribution_file(distribution_file: str) -> Iterable[WeightedRoute]:
+    """Read the routes of a TSV distribution, i.e. the count, the optional metric columns and the "|"-joined route,
+        with or without a header."""
+    with open(distribution_file) as file:
+        first_line = file.readline()
+    if not first_line:
+        return iter([])
+    has_header = not first_line.split('\t', 1)[0].strip().isdigit()
+    df = pd.read_csv(distribution_file, sep='\t', header=0 if has_header else None, keep_default_na=False)
+    return zip([route.split('|') for route in df.iloc[:, -1].astype(str).tolist()], df.iloc[:, 0].tolist())
+
+def get_distribution_file_iso_weights(distribution_file: str) -> dict[str, float]:
+    """Return the weight of each known ISO across the routes of a .by_iso.distribution file, see get_iso_weights()."""
+    weighted_routes = list(iter_weighted_routes_from_distribution_file(distribution_file))
+    isos = sorted(set(hop for (route, _) in weighted_routes for hop in route) - { UNKNOWN_ISO })
+    iso_weights = get_iso_weights(*get_hop_weight_matrix(weighted_routes, isos))
+    return { iso: weight for iso, weight in zip(isos, iso_weights.tolist()) if weight > 0 }
+
+class RegionPairCidtMatrix:
+    """The CIDT of all region pairs at once, from a sparse (region pair x ISO) matrix of the ISO weights of each pair,
+        precompiled from their .by_iso.distribution files.
+
+        Given the carbon intensity of each ISO, the CIDT of all pairs is one sparse mat-vec, and when only some ISOs
+        change, only the rows of the pairs with routes through them are recomputed. ISOs without a carbon intensity are
+        left out of the weighted average of each pair, and pairs without any are NaN.
+    """
+    def __init__(self, region_pairs: list[RegionPair], isos: list[str], weights: csr_matrix):
+        self.region_pairs = region_pairs
+        self.region_pair_indices = { pair: i for i, pair in enumerate(region_pairs) }
+        self.isos = isos
+        self.iso_indices = { iso: i for i, iso in enumerate(isos) }
+        self.weights = weights.tocsr()
+        # The columns of each ISO, to find the pairs affected by a change.
+        self.weights_by_iso = self.weights.tocsc()
+        self.intensities = np.zeros(len(isos))
+        self.has_intensities = np.zeros(len(isos))
+        # The sum of the weighted intensities, and of the weights with intensities, of each pair.
+        self.weighted_sums = np.zeros(len(region_pairs))
+        self.known_weights = np.zeros(len(region_pairs))
+
+    @staticmethod
+    def from_distribution_files(distribution_files: list[str], jobs: int = 1) -> 'RegionPairCidtMatrix':
+        """Precompile the ISO weights of each .by_iso.distribution file, named as
+            *.src_cloud.src_region.dst_cloud.dst_region.by_iso.distribution, on `jobs` processes."""
+        region_pairs = []
+        for distribution_file in distribution_files:
+            cloud_regions = detect_cloud_regions_from_filename(os.path.basename(distribution_file))
+            assert cloud_regions is not None, f"Cannot detect cloud regions from filename '{distribution_file}'"
+            region_pairs.append(cloud_regions)
+        logging.info(f'Compiling the ISO weights of {len(distribution_files)} region pairs ...')
+        if jobs > 1:
+            with multiprocessing.get_context('fork').Pool(jobs) as pool:
+                iso_weights_by_pair = pool.map(get_distribution_file_iso_weights, distribution_files, chunksize=16)
+        else:
+            iso_weights_by_pair = list(map(get_distribution_file_iso_weights, distribution_files))
+
+        isos = sorted(set(iso for iso_weights in iso_weights_by_pair for iso in iso_weights))
+        iso_indices = { iso: i for i, iso in enumerate(isos) }
+        (rows, columns, data) = ([], [], [])
+        for row, iso_weights in enumerate(iso_weights_by_pair):
+            rows += [row] * len(iso_weights)
+            columns += [iso_indices[iso] for iso in iso_weights]
+            data += list(iso_weights.values())
+        weights = csr_matrix((data, (rows, columns)), shape=(len(region_pairs), len(isos)), dtype=np.float64)
+        return RegionPairCidtMatrix(region_pairs, isos, weights)
+
+    def save(self, matrix_file: str) -> None:
+        np.savez_compressed(matrix_file, region_pairs=np.array(self.region_pairs, dtype=str).reshape(-1, 4),
+                            isos=np.array(self.isos, dtype=str), indptr=self.weights.indptr,
+                            indices=self.weights.indices, data=self.weights.data)
+
+    @staticmethod
+    def load(matrix_file: str) -> 'RegionPairCidtMatrix':
+        with np.load(matrix_file) as npz:
+            region_pairs = [tuple(pair) for pair in npz['region_pairs'].tolist()]
+            isos = npz['isos'].tolist()
+            weights = csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=(len(region_pairs), len(isos)))
+        return RegionPairCidtMatrix(region_pairs, isos, weights)
+
+    def get_intensity_vectors(self, intensities: dict[str, float]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return the columns of the known ISOs among the given ones, and their intensities and known flags."""
+        columns = np.array([self.iso_indices[iso] for iso in intensities if iso in self.iso_indices], dtype=np.int64)
+        values = np.array([intensity for iso, intensity in intensities.items() if iso in self.iso_indices],
+                          dtype=np.float64)
+        has_values = ~np.isnan(values)
+        return columns, np.where(has_values, values, 0.), has_values.astype(np.float64)
+
+    def set_intensities(self, intensities: dict[str, float]) -> np.ndarray:
+        """Set the carbon intensity of each ISO, where the missing ones or NaN have none, and return the CIDT of all
+            region pairs."""
+        (columns, values, has_values) = self.get_intensity_vectors(intensities)
+        (self.intensities[:], self.has_intensities[:]) = (0., 0.)
+        (self.intensities[columns], self.has_intensities[columns]) = (values, has_values)
+        self.weighted_sums = self.weights @ self.intensities
+        self.known_weights = self.weights @ self.has_intensities
+        return self.get_cidts()
+
+    def update_intensities(self, intensities: dict[str, float]) -> np.ndarray:
+        """Update the carbon intensity of some ISOs, where NaN removes it, and return the indices of the region pairs
+            whose CIDT changed, by recomputing only their rows."""
+        (columns, values, has_values) = self.get_intensity_vectors(intensities)
+        is_changed = (self.intensities[columns] != values) | (self.has_intensities[columns] != has_values)
+        columns = columns[is_changed]
+        (self.intensities[columns], self.has_intensities[columns]) = (values[is_changed], has_values[is_changed])
+        rows = np.unique(self.weights_by_iso[:, columns].indices)
+        if len(rows) == 0:
+            return rows
+        affected_weights = self.weights[rows]
+        self.weighted_sums[rows] = affected_weights @ self.intensities
+        self.known_weights[rows] = affected_weights @ self.has_intensities
+        return rows
+
+    def get_cidts(self, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        (weighted_sums, known_weights) = (self.weighted_sums, self.known_weights) if rows is None else \
+            (self.weighted_sums[rows], self.known_weights[rows])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(known_weights > 0, weighted_sums / known_weights, np.nan)
+
+    def get_cidt(self, src_cloud: str, src_region: str, dst_cloud: str, dst_region: str) -> float:
+        row = self.region_pair_indices[(src_cloud, src_region, dst_cloud, dst_region)]
+        return float(self.get_cidts(np.array([row]))[0])
+
+    def to_dataframe(self, rows: Optional[np.ndarray] = None) -> pd.DataFrame:
+        region_pairs = self.region_pairs if rows is None else [self.region_pairs[row] for row in rows.tolist()]
+        df = pd.DataFrame(region_pairs, columns=['src_cloud', 'src_region', 'dst_cloud', 'dst_region'])
+        df['cidt'] = self.get_cidts(rows)
+        return df
+
+def load_latest_carbon_intensities(carbon_intensity_csv: str, at: Optional[datetime] = None) -> dict[str, float]:
+    """Load the carbon intensity of each ISO, i.e. its latest one up to `at` if the CSV has a timestamp column."""
+    df = pd.read_csv(carbon_intensity_csv)
+    if 'timestamp' in df.columns:
+        df['timestamp'] = pd.to_datetime(df['timestamp'])
+        if at is not None:
+            df = df[df['timestamp'] <= to_timestamp(at, pd.DatetimeIndex(df['timestamp']))]
+        df = df.sort_values('timestamp', kind='stable')
+    df = df.dropna(subset=['carbon_intensity']).drop_duplicates('iso', keep='last')
+    return dict(zip(df['iso'].tolist(), df['carbon_intensity'].astype(float).tolist()))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Precompile the ISO weights of all region pairs into a matrix, and '
+                                                 'calculate the CIDT of all region pairs from carbon intensities.')
+    parser.add_argument('--compile', action='store_true',
+                        help='Compile the .by_iso.distribution files into the matrix file.')
+    parser.add_argument('--distribution-files', nargs='+', help='The .by_iso.distribution files of all region pairs.')
+    parser.add_argument('--matrix-file', required=True, help='The .npz file of the compiled matrix.')
+    parser.add_argument('--carbon-intensity-csv',
+                        help='The CSV file of carbon intensities, with iso, carbon_intensity and optionally timestamp '
+                             'columns, where the latest intensity of each ISO is used.')
+    parser.add_argument('--at', type=datetime.fromisoformat,
+                        help='Use the latest carbon intensities up to this time, instead of the latest ones.')
+    parser.add_argument('--updated-carbon-intensity-csv',
+                        help='The CSV file of updated carbon intensities of some ISOs, to apply incrementally, where '
+                             'only the updated region pairs are printed.')
+    parser.add_argument('-o', '--output-tsv', help='The output TSV file of the CIDT of each region pair, '
+                                                   'stdout if not specified.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of processes to compile the distribution files in parallel.')
+    args = parser.parse_args()
+
+    if args.compile and not args.distribution_files:
+        parser.error('--distribution-files must be specified with --compile')
+    if args.updated_carbon_intensity_csv and not args.carbon_intensity_csv:
+        parser.error('--carbon-intensity-csv must be specified with --updated-carbon-intensity-csv')
+    if not (args.compile or args.carbon_intensity_csv):
+        parser.error('No action specified')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    return args
+
+def main():
+    init_logging(level=logging.INFO)
+    args = parse_args()
+    if args.compile:
+        matrix = RegionPairCidtMatrix.from_distribution_files(args.distribution_files, args.jobs)
+        matrix.save(args.matrix_file)
+        logging.info(f'Saved the weights of {len(matrix.region_pairs)} region pairs over {len(matrix.isos)} ISOs '
+                     f'to {args.matrix_file}')
+    if not args.carbon_intensity_csv:
+        return
+    matrix = RegionPairCidtMatrix.load(args.matrix_file)
+    intensities = load_latest_carbon_intensities(args.carbon_intensity_csv, args.at)
+    start_time = time.perf_counter()
+    matrix.set_intensities(intensities)
+    logging.info(f'Elapsed: {(time.perf_counter() - start_time) * 1000:.3f}ms, '
+                 f'CIDT of {len(matrix.region_pairs)} region pairs')
+    rows = None
+    if args.updated_carbon_intensity_csv:
+        updated_intensities = load_latest_carbon_intensities(args.updated_carbon_intensity_csv, args.at)
+        start_time = time.perf_counter()
+        rows = matrix.update_intensities(updated_intensities)
+        logging.info(f'Elapsed: {(time.perf_counter() - start_time) * 1000:.3f}ms, '
+                     f'updated the CIDT of {len(rows)} region pairs')
+    matrix.to_dataframe(rows).to_csv(args.output_tsv if args.output_tsv else sys.stdout, sep='\t', index=False)
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,142 @@
 #!/usr/bin/env python3
 
 import logging
+import multiprocessing
 import os
 import sys
 import pandas as pd
 import argparse
+from typing import Iterable, Optional
 
-from common import init_logging, detect_cloud_regions_from_filename
+from common import init_logging, detect_cloud_regions_from_filename, iter_chunks
 
 REQUIRED_COLUMNS = ['count', 'hop_count', 'distance_km', 'route']
+REGION_COLUMNS = ['src_cloud', 'src_region', 'dst_cloud', 'dst_region']
+# The Parquet dataset is partitioned by the source region, as Hive-style src_cloud=.../src_region=... directories.
+PARTITION_COLUMNS = ['src_cloud', 'src_region']
+PARQUET_PART_FILENAME = 'part-0.parquet'
+# The number of TSV files read ahead per worker process, which bounds the memory of the files not yet written.
+READ_AHEAD_PER_JOB = 4
 
-def combine_tsv_files_and_add_regions(input_files: list[str], output_file: str) -> None:
-    """Combine the TSV files into a single TSV file with added src/dst region information based on the file name."""
-    combined_df = pd.DataFrame()
-    for input_file in input_files:
-        logging.info(f'Processing {input_file} ...')
-        cloud_regions = detect_cloud_regions_from_filename(os.path.basename(input_file))
-        assert cloud_regions is not None, f"Cannot detect cloud regions from filename '{input_file}'"
-        (src_cloud, src_region, dst_cloud, dst_region) = cloud_regions
+def add_region_columns(df: pd.DataFrame, cloud_regions: tuple[str, str, str, str]) -> pd.DataFrame:
+    """Add the src/dst cloud regions to a region pair distribution, with the new columns at the beginning."""
+    for column, value in zip(REGION_COLUMNS, cloud_regions):
+        df[column] = value
+    return df[REGION_COLUMNS + REQUIRED_COLUMNS]
 
-        df = pd.read_csv(input_file, delimiter='\t')
-        for column in REQUIRED_COLUMNS:
-            assert column in df.columns, f"Required column '{column}' is missing in '{input_file}'"
+def read_tsv_file_and_add_regions(input_file: str) -> pd.DataFrame:
+    logging.info(f'Processing {input_file} ...')
+    cloud_regions = detect_cloud_regions_from_filename(os.path.basename(input_file))
+    assert cloud_regions is not None, f"Cannot detect cloud regions from filename '{input_file}'"
 
-        df['src_cloud'] = src_cloud
-        df['src_region'] = src_region
-        df['dst_cloud'] = dst_cloud
-        df['dst_region'] = dst_region
+    df = pd.read_csv(input_file, delimiter='\t')
+    for column in REQUIRED_COLUMNS:
+        assert column in df.columns, f"Required column '{column}' is missing in '{input_file}'"
+    return add_region_columns(df, cloud_regions)
 
-        combined_df = pd.concat([combined_df, df], ignore_index=True)
+class CombinedDistributionWriter:
+    """Append region pair distributions with region columns to the combined TSV one at a time, and optionally to a
+        Parquet dataset partitioned by src_cloud/src_region, so that only the distribution being written is in memory.
 
-    # Reorder columns with the new ones at the beginning
-    new_columns = ['src_cloud', 'src_region', 'dst_cloud', 'dst_region'] + REQUIRED_COLUMNS
-    combined_df = combined_df[new_columns]
+        In the Parquet dataset, the dst region columns are dictionary-encoded, and the src region columns are those of
+        the partition directories, which pd.read_parquet() and pq.read_table() read back as dictionary-encoded too, but
+        pyarrow.dataset.dataset(partitioning='hive') reads back as plain strings, unless the partitioning is discovered
+        with infer_dictionary=True. Each partition is a single file with a row group per region pair, so that existing
+        partitions are replaced when rewritten.
+    """
+    def __init__(self, output_file: Optional[str], parquet_dirpath: Optional[str] = None):
+        self.output_file = output_file
+        self.output = None
+        self.parquet_dirpath = parquet_dirpath
+        self.parquet_writers = {}
+        self.parquet_schema = None
+        self.count = 0
 
-    logging.info(f'Writing to {output_file} ...')
-    combined_df.to_csv(output_file if output_file else sys.stdout, sep='\t', index=False)
+    def __enter__(self):
+        if self.output_file or not self.parquet_dirpath:
+            self.output = open(self.output_file, 'w', newline='') if self.output_file else sys.stdout
+        if self.parquet_dirpath:
+            # Optional dependency, only needed for the Parquet dataset.
+            import pyarrow as pa
+            self.parquet_schema = pa.schema([(column, pa.dictionary(pa.int32(), pa.string()))
+                                             for column in REGION_COLUMNS if column not in PARTITION_COLUMNS] +
+                                            [('count', pa.int64()), ('hop_count', pa.int64()),
+                                             ('distance_km', pa.float64()), ('route', pa.string())])
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def write(self, df: pd.DataFrame) -> None:
+        if self.output is not None:
+            df.to_csv(self.output, sep='\t', index=False, header=self.count == 0)
+        if self.parquet_schema is not None:
+            self.write_parquet(df)
+        self.count += 1
+
+    def write_parquet(self, df: pd.DataFrame) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if df.empty:
+            return
+        for partition, partition_df in df.groupby(PARTITION_COLUMNS, sort=False):
+            writer = self.parquet_writers.get(partition)
+            if writer is None:
+                dirpath = os.path.join(self.parquet_dirpath,
+                                       *[f'{column}={value}' for column, value in zip(PARTITION_COLUMNS, partition)])
+                os.makedirs(dirpath, exist_ok=True)
+                writer = self.parquet_writers[partition] = \
+                    pq.ParquetWriter(os.path.join(dirpath, PARQUET_PART_FILENAME), self.parquet_schema)
+            table = pa.Table.from_pandas(partition_df.drop(columns=PARTITION_COLUMNS), schema=self.parquet_schema,
+                                         preserve_index=False)
+            writer.write_table(table)
+
+    def close(self) -> None:
+        if self.output is not None and self.output is not sys.stdout:
+            self.output.close()
+        self.output = None
+        for writer in self.parquet_writers.values():
+            writer.close()
+        self.parquet_writers = {}
+
+def iter_tsv_files_with_regions(input_files: list[str], jobs: int = 1) -> Iterable[pd.DataFrame]:
+    """Read the TSV files with region columns in their order, on `jobs` processes with a bounded read-ahead."""
+    if jobs <= 1:
+        yield from map(read_tsv_file_and_add_regions, input_files)
+        return
+    with multiprocessing.get_context('fork').Pool(jobs) as pool:
+        for batch in iter_chunks(input_files, jobs * READ_AHEAD_PER_JOB):
+            yield from pool.imap(read_tsv_file_and_add_regions, batch)
+
+def combine_tsv_files_and_add_regions(input_files: list[str], output_file: Optional[str], jobs: int = 1,
+                                      parquet_dirpath: Optional[str] = None) -> None:
+    """Combine the TSV files into a single TSV file with added src/dst region information based on the file name,
+        and optionally a Parquet dataset partitioned by the source region.
+
+        Each TSV file is appended as soon as it is read, so memory doesn't grow with the number of files.
+    """
+    logging.info(f'Writing to {output_file if output_file or not parquet_dirpath else parquet_dirpath} ...')
+    with CombinedDistributionWriter(output_file, parquet_dirpath) as writer:
+        for df in iter_tsv_files_with_regions(input_files, jobs):
+            writer.write(df)
+    logging.info(f'Combined {writer.count} TSV files')
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Process TSV files and add columns.')
     parser.add_argument('-i', '--input-tsvs', type=str, required=True, nargs='+', help='The TSV files for each region, must be named in the format of *.src_cloud.src_region.dst_cloud.dst_region.*')
-    parser.add_argument('-o', '--output-tsv', type=str, help='The output TSV file.')
+    parser.add_argument('-o', '--output-tsv', type=str, help='The output TSV file, stdout if neither it nor --parquet-dir is specified.')
+    parser.add_argument('--parquet-dir', type=str, help='The directory to also write a Parquet dataset partitioned by src_cloud/src_region to, which requires pyarrow.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='The number of processes to read the TSV files in parallel.')
     args = parser.parse_args()
 
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
     return args
 
 def main():
     init_logging()
     args = parse_args()
-    combine_tsv_files_and_add_regions(args.input_tsvs, args.output_tsv)
+    combine_tsv_files_and_add_regions(args.input_tsvs, args.output_tsv, args.jobs, args.parquet_dir)
 
 if __name__ == '__main__':
     main()
@@ -3,24 +3,30 @@
 import argparse
 import ast
 from enum import Enum
-import functools
+import itertools
 import json
 import os
 import re
 import sys
 import time
 import logging
-from typing import Optional
-from geopy.distance import geodesic
+from typing import Iterable, Iterator, Optional
 
 CARBON_API_URL = 'http://yak-03.sysnet.ucsd.edu'
 MATCHED_NODES_FILENAME_AWS = 'matched_nodes.aws.by_region.txt'
 MATCHED_NODES_FILENAME_GCLOUD = 'matched_nodes.gcloud.by_region.txt'
 
+# The number of routes to process at once when streaming routes files.
+ROUTES_CHUNK_SIZE = 100000
+
 Coordinate = tuple[float, float]
 RouteInCoordinate = list[Coordinate]
 RouteInIP = list[str]
 RouteInISO = list[str]
+# A unique route with the number of times it occurs, as in weighted routes files.
+WeightedRoute = tuple[list, int]
+# (src_cloud, src_region, dst_cloud, dst_region)
+RegionPair = tuple[str, str, str, str]
 
 class RouteMetric(str, Enum):
     HopCount = 'hop_count'
@@ -35,9 +41,9 @@ def init_logging(level=logging.DEBUG):
                         format='%(asctime)s %(levelname)-8s %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
 
-def load_aws_ip_ranges(region):
+def load_aws_ip_ranges(region, ip_ranges_file='../data/cloud/ip-ranges.aws.json'):
     # Load the JSON data from the file
-    with open('../data/cloud/ip-ranges.aws.json', 'r') as file:
+    with open(ip_ranges_file, 'r') as file:
         data = json.load(file)
     # Iterate through the prefixes and populate the mapping
     ip_ranges = []
@@ -48,8 +54,8 @@ def load_aws_ip_ranges(region):
         ip_ranges.append((ip_prefix, 'aws', item['region']))
     return ip_ranges
 
-def load_gcloud_ip_ranges(region):
-    with open('../data/cloud/ip-ranges.gcloud.json', 'r') as file:
+def load_gcloud_ip_ranges(region, ip_ranges_file='../data/cloud/ip-ranges.gcloud.json'):
+    with open(ip_ranges_file, 'r') as file:
         data = json.load(file)
     # Iterate through the prefixes and populate the mapping
     ip_ranges = []
@@ -62,6 +68,18 @@ def load_gcloud_ip_ranges(region):
         ip_ranges.append((ip_prefix, 'gcloud', item['scope']))
     return ip_ranges
 
+def load_cloud_ip_ranges_version(cloud) -> dict[str, str]:
+    """Return the version fields (sync token and creation time) of the cloud IP ranges file."""
+    if cloud == 'aws':
+        with open('../data/cloud/ip-ranges.aws.json', 'r') as file:
+            data = json.load(file)
+        return { 'syncToken': data['syncToken'], 'createDate': data['createDate'] }
+    if cloud == 'gcloud':
+        with open('../data/cloud/ip-ranges.gcloud.json', 'r') as file:
+            data = json.load(file)
+        return { 'syncToken': data['syncToken'], 'createDate': data['creationTime'] }
+    raise ValueError(f'Unsupported cloud {cloud}')
+
 def load_cloud_ip_ranges(cloud, region):
     if cloud == 'aws':
         return load_aws_ip_ranges(region)
@@ -111,26 +129,84 @@ def load_itdk_node_id_to_ips_mapping(node_file='../data/caida-itdk/midar-iff.nod
 def load_itdk_node_ip_to_id_mapping(node_file='../data/caida-itdk/midar-iff.nodes') -> dict[str, str]:
     return load_itdk_mapping_internal(node_file, True)
 
+def parse_route_literal(text: str) -> list:
+    """Parse a route as printed by print(route), with a fast path for lists of (lat, lon) floats or of quoted IPs/ISOs,
+        and ast.literal_eval() for anything else."""
+    text = text.strip()
+    try:
+        if text.startswith('[(') and text.endswith(')]'):
+            tokens = text[2:-2].replace('), (', ', ').split(', ')
+            # Integers and special values are left to literal_eval(), so the hops are the same as it would parse.
+            if len(tokens) % 2 == 0 and all('.' in token for token in tokens):
+                values = [float(token) for token in tokens]
+                return list(zip(values[::2], values[1::2]))
+        elif text.startswith("['") and text.endswith("']") and '\\' not in text:
+            hops = text[2:-2].split("', '")
+            if not any("'" in hop or '"' in hop for hop in hops):
+                return hops
+    except ValueError:
+        pass
+    return ast.literal_eval(text)
+
+def parse_weighted_route_line(line: str) -> WeightedRoute:
+    """Parse a line of a text routes file, either a route, or a weighted route of "<count> <route>"."""
+    line = line.lstrip()
+    if line[0].isdigit():
+        (count, _, route) = line.partition(' ')
+        return (parse_route_literal(route), int(count))
+    return (parse_route_literal(line), 1)
+
 def get_routes_from_file(filename) -> list[list]:
+    """Load routes from a text routes file, or a binary one with the .bin suffix (see route_format.py).
+
+        Weighted routes are repeated by their counts.
+    """
     logging.info(f'Loading routes from {filename} ...')
-    with open(filename, 'r') as file:
-        lines = file.readlines()
-        routes = [ ast.literal_eval(line) for line in lines ]
+    routes = [route for (route, count) in iter_weighted_routes_from_file(filename, log=False)
+              for _ in range(count)]
     logging.info(f'Loaded {len(routes)} routes')
     return routes
 
+def iter_weighted_routes_from_file(filename, log: bool = True) -> Iterator[WeightedRoute]:
+    """Lazily read (route, count) from a routes file one by one, in either format, without loading the whole file.
+
+        Routes in a file that is not weighted have a count of 1 each.
+    """
+    from route_format import is_binary_routes_file, read_routes
+    if log:
+        logging.info(f'Streaming routes from {filename} ...')
+    if is_binary_routes_file(filename):
+        for weighted_routes in read_routes(filename).iter_weighted_chunks():
+            yield from weighted_routes
+    else:
+        with open(filename, 'r') as file:
+            for line in file:
+                if line.strip():
+                    yield parse_weighted_route_line(line)
+
+def iter_routes_from_file(filename) -> Iterator[list]:
+    """Lazily read routes from a routes file one by one, in either format, repeating weighted routes by their counts."""
+    for (route, count) in iter_weighted_routes_from_file(filename):
+        yield route
+        for _ in range(count - 1):
+            yield list(route)
+
+def iter_chunks(items: Iterable, chunk_size: int = ROUTES_CHUNK_SIZE) -> Iterator[list]:
+    """Group items into lists of up to chunk_size items, e.g. to process a stream of routes in bounded memory."""
+    iterator = iter(items)
+    while chunk := list(itertools.islice(iterator, chunk_size)):
+        yield chunk
+
 def write_routes_to_file(routes: list[list], output_file: Optional[str] = None) -> None:
+    from route_format import RouteWriter
     if output_file:
-        output = open(output_file, 'x')
         logging.info(f'Writing (lat, lon) routes to {output_file} ...')
-    else:
-        output = None
 
-    for route in routes:
-        print(route, file=output if output else sys.stdout)
+    with RouteWriter(output_file, mode='x') as writer:
+        for route in routes:
+            writer.write(route)
 
-    if output:
-        output.close()
+    if output_file:
         logging.info('Done')
 
 def detect_cloud_regions_from_filename(filename: str) -> Optional[tuple[str, str, str, str]]:
@@ -157,27 +233,3 @@ def DirType(path: str):
         return path
     else:
         raise argparse.ArgumentTypeError(f'{path} is not a valid directory path')
-
-def calculate_total_distance_km(hops: RouteInCoordinate) -> float:
-    """Calculate the total distance across all hops, by summing the pairwise distances.
-    """
-    if len(hops) <= 1:
-        return 0.
-
-    @functools.cache
-    def calculate_pairwise_distance_km(hop1: Coordinate, hop2: Coordinate) -> float:
-        return geodesic(hop1, hop2).km
-
-    total_distance = 0.
-    for i in range(len(hops) - 1):
-        total_distance += calculate_pairwise_distance_km(hops[i], hops[i + 1])
-    return total_distance
-
-def calculate_route_metric(route: str, metric: RouteMetric) -> float:
-    match metric:
-        case RouteMetric.HopCount:
-            return len(route.split('|'))
-        case RouteMetric.DistanceKM:
-            return round(calculate_total_distance_km([ast.literal_eval(e) for e in route.split('|')]), 2)
-        case _:
-            raise ValueError(f'Unknown metric {metric}')
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+from typing import Optional
+
+import pandas as pd
+
+from artifact_dag import Artifact, ArtifactRunner
+from carbon_client import CARBON_API_MAX_WORKERS, ISO_GRID_CELL_SIZE_DEG, configure_carbon_api, \
+    convert_latlon_chunk_to_carbon_region, init_offline_iso_resolver, log_spatial_iso_memo_stats
+from combine_per_region_pair_tsvs import CombinedDistributionWriter, add_region_columns, \
+    combine_tsv_files_and_add_regions
+from common import RouteMetric, detect_cloud_regions_from_filename, init_logging, iter_chunks, \
+    iter_weighted_routes_from_file
+from itdk_geo import convert_route_chunk_from_ip_to_latlon, get_route_check_function_by_ground_truth, \
+    load_region_to_geo_coordinate_ground_truth, shared_lookup_tables
+from itdk_geo_table import load_ip_node_table, load_node_geo_table
+from route_distance import DistanceModel
+from route_distribution import RouteDistribution
+from route_format import HOP_TYPE_COORDINATE, HOP_TYPE_ISO, ROUTES_BINARY_SUFFIX, RouteWriter, \
+    is_weighted_routes_file
+
+# The same distributions as run_all.conversions.sh used to export with distribution.routes.py.
+GEO_DISTRIBUTION_METRICS = [RouteMetric.HopCount, RouteMetric.DistanceKM]
+ISO_DISTRIBUTION_METRICS: list[RouteMetric] = []
+OUTPUT_DIRNAMES = ['region_pair.by_geo', 'region_pair.by_geo.distribution',
+                   'region_pair.by_iso', 'region_pair.by_iso.distribution']
+# The default ITDK datasets of load_ip_node_table() and load_node_geo_table(), which all region pairs depend on.
+ITDK_NODES_FILE = '../data/caida-itdk/midar-iff.nodes'
+ITDK_NODE_GEO_FILE = '../data/caida-itdk/midar-iff.nodes.geo'
+# The code of each artifact, so that changing any of them rebuilds the artifacts with --incremental.
+REGION_PAIR_CODE_FILES = ['conversion_pipeline.py', 'itdk_geo.py', 'itdk_geo_table.py', 'carbon_client.py',
+                          'iso_resolver.py', 'route_distribution.py', 'route_distance.py', 'route_format.py', 'common.py']
+COMBINED_TSV_CODE_FILES = ['combine_per_region_pair_tsvs.py', 'common.py']
+
+def get_region_pair_outputs(routes_file: str, output_dir: str) -> dict[str, str]:
+    """Name the outputs of a .by_ip routes file in the region_pair.* directories, i.e. .by_geo, .by_iso and their
+        distributions, where the routes files keep the .bin suffix of the input."""
+    name = os.path.basename(routes_file)
+    binary_suffix = ROUTES_BINARY_SUFFIX if name.endswith(ROUTES_BINARY_SUFFIX) else ''
+    name = name.removesuffix(binary_suffix).removesuffix('.by_ip')
+    return {
+        'by_geo': os.path.join(output_dir, 'region_pair.by_geo', f'{name}.by_geo{binary_suffix}'),
+        'by_geo.distribution': os.path.join(output_dir, 'region_pair.by_geo.distribution', f'{name}.by_geo.distribution'),
+        'by_iso': os.path.join(output_dir, 'region_pair.by_iso', f'{name}.by_iso{binary_suffix}'),
+        'by_iso.distribution': os.path.join(output_dir, 'region_pair.by_iso.distribution', f'{name}.by_iso.distribution'),
+    }
+
+def run_region_pair_pipeline(task: tuple[str, str]) -> pd.DataFrame:
+    """Convert one .by_ip routes file to .by_geo and .by_iso in a single pass over its routes, exporting both
+        distributions, and return the geo distribution with the region columns for the combined TSV.
+
+        Each chunk of routes flows through all stages in memory, and only the unique routes of the distributions are
+        kept until the end, so memory stays flat regardless of the file size.
+    """
+    (routes_file, output_dir) = task
+    start_time = time.time()
+    outputs = get_region_pair_outputs(routes_file, output_dir)
+    cloud_regions = detect_cloud_regions_from_filename(os.path.basename(outputs['by_geo']))
+    assert cloud_regions is not None, f"Cannot detect cloud regions from filename '{routes_file}'"
+    if shared_lookup_tables['geo_coordinate_ground_truth']:
+        (src_cloud, src_region, dst_cloud, dst_region) = cloud_regions
+        is_valid_geo_route = \
+            get_route_check_function_by_ground_truth(shared_lookup_tables['geo_coordinate_ground_truth'],
+                                                     src_cloud, src_region, dst_cloud, dst_region)
+    else:
+        is_valid_geo_route = lambda _: True
+
+    logging.info(f'Converting routes from {routes_file} ...')
+    weighted = is_weighted_routes_file(routes_file)
+    geo_distribution = RouteDistribution(remove_duplicate_hops=True)
+    iso_distribution = RouteDistribution()
+    (total_count, geo_count, iso_count) = (0, 0, 0)
+    with RouteWriter(outputs['by_geo'], HOP_TYPE_COORDINATE, weighted=weighted) as geo_writer, \
+         RouteWriter(outputs['by_iso'], HOP_TYPE_ISO, weighted=weighted) as iso_writer:
+        for chunk in iter_chunks(iter_weighted_routes_from_file(routes_file)):
+            geo_routes = convert_route_chunk_from_ip_to_latlon(chunk, shared_lookup_tables['ip_node_table'],
+                                                               shared_lookup_tables['node_geo_table'],
+                                                               is_valid_geo_route)
+            geo_writer.write_weighted(geo_routes)
+            # Routes are already filtered by ground truth in the geo stage, as in run_all.conversions.sh.
+            iso_routes = convert_latlon_chunk_to_carbon_region(geo_routes, lambda _: True)
+            iso_writer.write_weighted(iso_routes)
+            geo_distribution.add_weighted(geo_routes)
+            iso_distribution.add_weighted(iso_routes)
+            total_count += len(chunk)
+            geo_count += len(geo_routes)
+            iso_count += len(iso_routes)
+
+    geo_df = geo_distribution.to_dataframe(GEO_DISTRIBUTION_METRICS, shared_lookup_tables['distance_model'])
+    geo_df.to_csv(outputs['by_geo.distribution'], sep='\t', index=False)
+    iso_df = iso_distribution.to_dataframe(ISO_DISTRIBUTION_METRICS)
+    iso_df.to_csv(outputs['by_iso.distribution'], sep='\t', index=False)
+    log_spatial_iso_memo_stats()
+
+    elapsed_time = time.time() - start_time
+    logging.info(f'Elapsed: {elapsed_time:.2f}s, {routes_file}: {geo_count}/{total_count} routes converted to geo, '
+                 f'{iso_count} to ISO, {len(geo_distribution)} unique geo routes')
+    return add_region_columns(geo_df, cloud_regions)
+
+def run_pipeline(routes_files: list[str], output_dir: str, combined_tsv: Optional[str], jobs: int) -> None:
+    """Run the pipeline of each region pair on a pool of processes, forked after the lookup tables are loaded, and
+        combine the geo distributions into one TSV, in the order of the routes files."""
+    for dirname in OUTPUT_DIRNAMES:
+        os.makedirs(os.path.join(output_dir, dirname), exist_ok=True)
+    tasks = [(routes_file, output_dir) for routes_file in routes_files]
+    logging.info(f'Writing the combined geo distribution of {len(tasks)} region pairs to '
+                 f'{combined_tsv if combined_tsv else "stdout"} ...')
+    # Each geo distribution is appended to the combined TSV as soon as its region pair is done, in order.
+    with CombinedDistributionWriter(combined_tsv) as writer:
+        if jobs > 1:
+            logging.info(f'Running the pipeline of {len(tasks)} region pairs with {jobs} processes ...')
+            with multiprocessing.get_context('fork').Pool(jobs) as pool:
+                for df in pool.imap(run_region_pair_pipeline, tasks, chunksize=1):
+                    writer.write(df)
+        else:
+            for task in tasks:
+                writer.write(run_region_pair_pipeline(task))
+
+def get_code_files(filenames: list[str]) -> list[str]:
+    return [os.path.join(os.path.dirname(os.path.abspath(__file__)), filename) for filename in filenames]
+
+def get_region_pair_ground_truth(geo_coordinate_ground_truth: dict, cloud_regions: tuple[str, str, str, str]) -> \
+                                    Optional[dict]:
+    """Return the ground truth rows of the src and dst regions only, so that changing the other rows of the ground
+        truth CSV doesn't invalidate the region pair."""
+    if not geo_coordinate_ground_truth:
+        return None
+    (src_cloud, src_region, dst_cloud, dst_region) = cloud_regions
+    keys = [f'{src_cloud}:{src_region}', f'{dst_cloud}:{dst_region}']
+    return { key: geo_coordinate_ground_truth.get(key) for key in keys }
+
+def get_pipeline_artifacts(routes_files: list[str], output_dir: str, combined_tsv: str,
+                           geo_coordinate_ground_truth: dict, params: dict, iso_geojson: Optional[str]) -> \
+                            list[Artifact]:
+    """Describe the outputs of each region pair, and the combined TSV of their geo distributions, as artifacts."""
+    artifacts = []
+    for routes_file in routes_files:
+        outputs = get_region_pair_outputs(routes_file, output_dir)
+        cloud_regions = detect_cloud_regions_from_filename(os.path.basename(outputs['by_geo']))
+        artifacts.append(Artifact(
+            name=os.path.basename(outputs['by_geo']).removesuffix(ROUTES_BINARY_SUFFIX).removesuffix('.by_geo'),
+            outputs=list(outputs.values()),
+            build=run_region_pair_pipeline,
+            args=((routes_file, output_dir),),
+            inputs=[routes_file, ITDK_NODES_FILE, ITDK_NODE_GEO_FILE] + ([iso_geojson] if iso_geojson else []),
+            params={ **params, 'ground_truth': get_region_pair_ground_truth(geo_coordinate_ground_truth,
+                                                                             cloud_regions) },
+            code=get_code_files(REGION_PAIR_CODE_FILES)))
+    geo_distribution_files = [get_region_pair_outputs(routes_file, output_dir)['by_geo.distribution']
+                              for routes_file in routes_files]
+    artifacts.append(Artifact(
+        name=os.path.basename(combined_tsv),
+        outputs=[combined_tsv],
+        build=combine_tsv_files_and_add_regions,
+        args=(geo_distribution_files, combined_tsv),
+        inputs=geo_distribution_files,
+        code=get_code_files(COMBINED_TSV_CODE_FILES)))
+    return artifacts
+
+def run_incremental_pipeline(args) -> None:
+    """Rebuild only the region pairs whose routes file, ground truth rows, parameters, datasets or code changed since
+        their last build, as recorded in the manifest next to each .by_geo file, and then the combined TSV if any of
+        the geo distributions changed.
+
+        ISO lookups via the carbon API are assumed not to change between builds.
+    """
+    for dirname in OUTPUT_DIRNAMES:
+        os.makedirs(os.path.join(args.output_dir, dirname), exist_ok=True)
+    geo_coordinate_ground_truth = load_region_to_geo_coordinate_ground_truth(args.geo_coordinate_ground_truth_csv) \
+        if args.geo_coordinate_ground_truth_csv else {}
+    params = { 'distance_model': str(args.distance_model), 'iso_grid_cell_deg': args.iso_grid_cell_deg }
+    artifacts = get_pipeline_artifacts(args.routes_files, args.output_dir, args.combined_tsv,
+                                       geo_coordinate_ground_truth, params, args.iso_geojson)
+    runner = ArtifactRunner(artifacts, args.jobs,
+                            before_build=lambda: load_shared_lookup_tables(geo_coordinate_ground_truth,
+                                                                           args.distance_model))
+    runner.run(dry_run=args.dry_run, force=args.force)
+
+def load_shared_lookup_tables(geo_coordinate_ground_truth: dict, distance_model: DistanceModel) -> None:
+    shared_lookup_tables['ip_node_table'] = load_ip_node_table(ITDK_NODES_FILE)
+    shared_lookup_tables['node_geo_table'] = load_node_geo_table(ITDK_NODE_GEO_FILE)
+    shared_lookup_tables['geo_coordinate_ground_truth'] = geo_coordinate_ground_truth
+    shared_lookup_tables['distance_model'] = distance_model
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert .by_ip routes files to .by_geo, .by_iso and their '
+                                                 'distributions in one pass, and combine the geo distributions.')
+    parser.add_argument('--routes_files', type=str, required=True, nargs='+',
+                        help='The .by_ip routes files, one per region pair, named as *.src_cloud.src_region.dst_cloud.dst_region.by_ip')
+    parser.add_argument('--output-dir', type=str, default='.',
+                        help='The directory to create the region_pair.by_{geo,iso}[.distribution] directories in.')
+    parser.add_argument('-o', '--combined-tsv', type=str,
+                        help='The combined geo distribution TSV of all region pairs, stdout if not specified.')
+    parser.add_argument('--geo-coordinate-ground-truth-csv', type=argparse.FileType('r'),
+                        help='The CSV file of ground truth geo coordinates to filter the routes by, if specified.')
+    parser.add_argument('--distance-model', type=DistanceModel, choices=list(DistanceModel),
+                        default=DistanceModel.Geodesic, help='The model to calculate the distance_km metric.')
+    parser.add_argument('--iso-geojson', required=False,
+                        help='The GeoJSON file of ISO boundaries to resolve coordinates offline, '
+                             'and only fall back to the carbon API for coordinates outside of any boundary.')
+    parser.add_argument('--iso-grid-cell-deg', type=float, default=ISO_GRID_CELL_SIZE_DEG,
+                        help='The grid cell size in degrees to memoize ISO lookups with --iso-geojson, 0 to disable.')
+    parser.add_argument('--api-concurrency', type=int, default=CARBON_API_MAX_WORKERS,
+                        help='The max number of concurrent carbon API requests, in each process.')
+    parser.add_argument('--api-bulk-path', required=False,
+                        help='The path of the bulk lookup endpoint of the carbon API, if supported by the server.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of worker processes to run region pairs in parallel.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only rebuild the outputs whose inputs, ground truth rows, parameters or code changed '
+                             'since their last build, as recorded in .manifest.json files next to them.')
+    parser.add_argument('--dry-run', action='store_true', help='Only list the stale outputs with --incremental.')
+    parser.add_argument('--force', action='store_true', help='Rebuild all outputs with --incremental.')
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.incremental and not args.combined_tsv:
+        parser.error('--combined-tsv must be specified with --incremental')
+    if (args.dry_run or args.force) and not args.incremental:
+        parser.error('--dry-run and --force can only be used with --incremental')
+    for routes_file in args.routes_files:
+        if detect_cloud_regions_from_filename(os.path.basename(routes_file)) is None:
+            parser.error('Cannot auto-detect cloud regions from the filename "%s"' % routes_file)
+
+    return args
+
+def main():
+    init_logging(level=logging.INFO)
+    args = parse_args()
+    if args.iso_geojson:
+        init_offline_iso_resolver(args.iso_geojson, args.iso_grid_cell_deg)
+    configure_carbon_api(args.api_concurrency, args.api_bulk_path)
+    if args.incremental:
+        run_incremental_pipeline(args)
+        return
+    geo_coordinate_ground_truth = load_region_to_geo_coordinate_ground_truth(args.geo_coordinate_ground_truth_csv) \
+        if args.geo_coordinate_ground_truth_csv else {}
+    load_shared_lookup_tables(geo_coordinate_ground_truth, args.distance_model)
+    run_pipeline(args.routes_files, args.output_dir, args.combined_tsv, args.jobs)
+
+if __name__ == '__main__':
+    main()
@@ -3,26 +3,31 @@
 import ast
 import logging
 import argparse
-from typing import Any
+from typing import Any, Optional
+import numpy as np
 from common import MATCHED_NODES_FILENAME_AWS, MATCHED_NODES_FILENAME_GCLOUD, init_logging
-from itdk_geo import load_itdk_node_ip_to_id_mapping, parse_node_geo_as_dataframe
-from carbon_client import get_carbon_region_from_coordinate
+from itdk_geo_table import IpNodeTable, NodeGeoTable, ips_to_uint32, load_ip_node_table, load_node_geo_table
+from carbon_client import ISO_GRID_CELL_SIZE_DEG, get_carbon_regions_from_coordinates, init_offline_iso_resolver, \
+    log_spatial_iso_memo_stats
 
 
-def convert_ip_to_coordinate(ip_address, node_ip_to_id, node_geo_df):
-    """given an ip address and try to change it to a coordinate, 
-    this function is skipping node without geo coordinates"""
+def convert_ips_to_coordinates(ip_addresses: list[str], ip_node_table: IpNodeTable,
+                               node_geo_table: NodeGeoTable) -> list[Optional[tuple[float, float]]]:
+    """given a list of ip addresses and try to change them to coordinates in one batch,
+    this function returns None for nodes without geo coordinates"""
 
-    # Convert a IP address to a node ID using the node_ip_to_id dictionary
-    node_id = node_ip_to_id[ip_address]
+    # Convert IP addresses to node numbers using the IP to node table
+    node_numbers = ip_node_table.lookup_node_numbers(ips_to_uint32(ip_addresses))
+    if np.any(node_numbers < 0):
+        raise KeyError(ip_addresses[int(np.argmax(node_numbers < 0))])
 
-    # skipping node without geo coordinate
-    if node_id not in node_geo_df.index:
-        logging.info(f'Node ID {node_id} not found in node_geo_df')
-        return None
-    # Convert node ID to a coordinate using the node_geo_df dictionary
-    row = node_geo_df.loc[node_id]
-    return (row['lat'], row['long'])
+    # Convert node numbers to coordinates using the node geo table, skipping nodes without geo coordinate
+    rows = node_geo_table.lookup_rows(node_numbers)
+    for node_number in np.unique(node_numbers[rows < 0]):
+        logging.info(f'Node ID N{node_number} not found in node geo table')
+    lats = node_geo_table.lat[rows].tolist()
+    lons = node_geo_table.lon[rows].tolist()
+    return [(lat, lon) if row >= 0 else None for (lat, lon, row) in zip(lats, lons, rows.tolist())]
 
 
 def get_all_coordinates_by_region(cloud) -> dict[str, list[tuple[float, float]]]:
@@ -33,8 +38,8 @@ def get_all_coordinates_by_region(cloud) -> dict[str, list[tuple[float, float]]]
     else:
         raise ValueError(f'Unsupported cloud {cloud}')
 
-    node_ip_to_id = load_itdk_node_ip_to_id_mapping()
-    node_geo_df = parse_node_geo_as_dataframe()
+    ip_node_table = load_ip_node_table()
+    node_geo_table = load_node_geo_table()
 
     with open(matched_nodes_filename) as file:
         dict_str = file.read()
@@ -42,14 +47,10 @@ def get_all_coordinates_by_region(cloud) -> dict[str, list[tuple[float, float]]]
 
     coordinates_by_region = {}
     for region, d_node_to_matches in d_by_region.items():
-        coordinates = []
-        for node_id in d_node_to_matches:
-            for _, ip in d_node_to_matches[node_id]:
-                # if the ip can be transform into coordinates, append it, otherwise skip it.
-                ip_coordinate = convert_ip_to_coordinate(
-                    ip, node_ip_to_id, node_geo_df)
-                if ip_coordinate:
-                    coordinates.append(ip_coordinate)
+        ips = [ip for node_id in d_node_to_matches for _, ip in d_node_to_matches[node_id]]
+        # if the ip can be transform into coordinates, keep it, otherwise skip it.
+        coordinates = [ip_coordinate for ip_coordinate in
+                       convert_ips_to_coordinates(ips, ip_node_table, node_geo_table) if ip_coordinate]
         coordinates_by_region[region] = coordinates
         logging.info(f'Found {len(coordinates)} coordinates for {cloud}:{region}.')
 
@@ -60,9 +61,9 @@ def convert_all_coordinates_to_isos(coordinates_by_region: dict[str, list[tuple[
     isos_by_region = {}
 
     for region, list_of_coordinates in coordinates_by_region.items():
-        region_iso_list = [get_carbon_region_from_coordinate(
-            coordinate) for coordinate in list_of_coordinates]
-        isos_by_region[region] = region_iso_list
+        unique_coordinates = list(dict.fromkeys(list_of_coordinates))
+        d_coordinate_to_iso = dict(zip(unique_coordinates, get_carbon_regions_from_coordinates(unique_coordinates)))
+        isos_by_region[region] = [d_coordinate_to_iso[coordinate] for coordinate in list_of_coordinates]
 
     return isos_by_region
 
@@ -83,6 +84,10 @@ def parse_args():
                         choices=['aws', 'gcloud'], help='The cloud provider you wish to get the iso occurence')
     parser.add_argument('--of-iso', action='store_true', help='Output distribution of ISOs')
     parser.add_argument('--of-coordinate', action='store_true', help='Output distribution of coordinates')
+    parser.add_argument('--iso-geojson', required=False,
+                        help='The GeoJSON file of ISO boundaries to resolve coordinates offline.')
+    parser.add_argument('--iso-grid-cell-deg', type=float, default=ISO_GRID_CELL_SIZE_DEG,
+                        help='The grid cell size in degrees to memoize ISO lookups with --iso-geojson, 0 to disable.')
 
     args = parser.parse_args()
 
@@ -96,6 +101,8 @@ def main():
 
     # input set can be aws or gcloud, to filter the corresponding data
     args = parse_args()
+    if args.iso_geojson:
+        init_offline_iso_resolver(args.iso_geojson, args.iso_grid_cell_deg)
 
     # change region to a dictionary of coordinates
     coordinates_by_region = get_all_coordinates_by_region(args.cloud)
@@ -108,6 +115,7 @@ def main():
             print(f"Region {region} has coordinate distributions: {coordinate_occurence}")
     elif args.of_iso:
         isos_by_region = convert_all_coordinates_to_isos(coordinates_by_region)
+        log_spatial_iso_memo_stats()
         iso_occurence_by_region = get_occurence_by_region(isos_by_region)
 
         for region, iso_occurence in iso_occurence_by_region.items():
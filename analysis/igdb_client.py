@@ -1,24 +1,65 @@
 #!/usr/bin/env python3
 
 import argparse
-import io
+import json
 import logging
 import math
-import sys
+import multiprocessing
+import os
+import time
 import traceback
-from typing import Optional
-import requests_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
 
-from common import get_routes_from_file, init_logging
+from carbon_client import create_session
+from common import WeightedRoute, init_logging, iter_weighted_routes_from_file
+from igdb_engine import IgdbSchema, add_igdb_local_arguments, load_igdb_physical_graph
+from lookup_cache import NAMESPACE_IGDB_PHYSICAL_HOPS, get_coordinate_pair_key, get_lookup_cache
+from route_format import HOP_TYPE_COORDINATE, ROUTES_BINARY_SUFFIX, RouteWriter, is_weighted_routes_file
 
 Coordinate=tuple[float, float]
 Route=list[Coordinate]
+HopPair=tuple[Coordinate, Coordinate]
 
-session = requests_cache.CachedSession('igdb_cache', backend='filesystem')
+# Max number of concurrent iGDB requests, which is also the size of the connection pool.
+IGDB_API_MAX_WORKERS = 16
+igdb_api_max_workers = IGDB_API_MAX_WORKERS
+session = create_session(IGDB_API_MAX_WORKERS)
 IGDB_API_URL = 'http://localhost:8082'
 
+def configure_igdb_api(max_workers: int) -> None:
+    global session, igdb_api_max_workers
+    if max_workers != igdb_api_max_workers:
+        session = create_session(max_workers)
+        igdb_api_max_workers = max_workers
+
+# The in-process iGDB physical graph, if loaded, which replaces the iGDB API server.
+local_igdb_graph = None
+
+def init_local_igdb_graph(db_path: Optional[str], csv_paths: Optional[list[str]], schema: IgdbSchema) -> None:
+    global local_igdb_graph
+    local_igdb_graph = load_igdb_physical_graph(db_path, csv_paths, schema)
+
+# The physical hops of all hop pairs in the input routes, resolved by the main process before stitching, and
+#   inherited by the forked worker processes.
+resolved_physical_hops: dict[HopPair, Route] = {}
+
 def get_igdb_physical_hops(src: Coordinate, dst: Coordinate) -> Route:
     """Get the physical hops between two coordinates using iGDB, inclusive of both ends."""
+    if local_igdb_graph is not None:
+        return local_igdb_graph.get_physical_hops(src, dst)
+    cache = get_lookup_cache()
+    key = get_coordinate_pair_key(src, dst)
+    cached_hops = cache.get(NAMESPACE_IGDB_PHYSICAL_HOPS, key)
+    if cached_hops is not None:
+        return [tuple(hop) for hop in json.loads(cached_hops)]
+
+    response_json = get_igdb_physical_hops_via_api(src, dst)
+    cache.put(NAMESPACE_IGDB_PHYSICAL_HOPS, key, json.dumps(response_json))
+    return [tuple(hop) for hop in response_json]
+
+def get_igdb_physical_hops_via_api(src: Coordinate, dst: Coordinate) -> list[list[float]]:
+    """Look up the physical hops between two coordinates via the iGDB API, and return the validated JSON response."""
     (src_lat, src_lon) = src
     (dst_lat, dst_lon) = dst
     response = session.get(f'{IGDB_API_URL}/physical-route/', params={
@@ -45,51 +86,174 @@ def get_igdb_physical_hops(src: Coordinate, dst: Coordinate) -> Route:
         f'Response first hop {first_hop} is not the same as the src {src}'
     assert math.isclose(last_hop[0], dst_lat) and math.isclose(last_hop[1], dst_lon), \
         f'Response last hop {last_hop} is not the same as the dst {dst}'
+    return response_json
+
+def get_unique_hop_pairs(routes: Iterable[Route]) -> set[HopPair]:
+    """Collect the unique pairs of consecutive hops across all routes, i.e. the iGDB lookups needed to convert them."""
+    hop_pairs: set[HopPair] = set()
+    for route in routes:
+        hop_pairs.update(zip(route, route[1:]))
+    return hop_pairs
+
+def resolve_igdb_physical_hops(hop_pairs: set[HopPair]) -> dict[HopPair, Route]:
+    """Resolve the physical hops of all hop pairs at once, from the lookup cache first, and look up the remaining
+        ones concurrently via the iGDB API, or all of them in-process if the local iGDB graph is loaded."""
+    l_hop_pairs = list(hop_pairs)
+    if local_igdb_graph is not None:
+        logging.info(f'Computing {len(l_hop_pairs)} hop pairs with the local iGDB graph ...')
+        start_time = time.time()
+        physical_hops = local_igdb_graph.get_physical_hops_many(l_hop_pairs)
+        elapsed_time = time.time() - start_time
+        logging.info(f'Elapsed: {elapsed_time:.2f}s, computed {len(l_hop_pairs)} hop pairs')
+        return dict(zip(l_hop_pairs, physical_hops))
+
+    cache = get_lookup_cache()
+    keys = [get_coordinate_pair_key(src, dst) for (src, dst) in l_hop_pairs]
+    cached_hops = cache.get_many(NAMESPACE_IGDB_PHYSICAL_HOPS, keys)
+    physical_hops_by_pair: dict[HopPair, Route] = {}
+    uncached = []
+    for hop_pair, key in zip(l_hop_pairs, keys):
+        if key in cached_hops:
+            physical_hops_by_pair[hop_pair] = [tuple(hop) for hop in json.loads(cached_hops[key])]
+        else:
+            uncached.append((hop_pair, key))
+    logging.info(f'Found {len(l_hop_pairs) - len(uncached)}/{len(l_hop_pairs)} hop pairs in cache')
+    if not uncached:
+        return physical_hops_by_pair
 
-    physical_hops = []
-    for hop in response_json:
-        # Convert JSON list to python tuple
-        physical_hops.append(tuple(hop))
-    return physical_hops
+    logging.info(f'Looking up {len(uncached)} hop pairs via iGDB with {igdb_api_max_workers} workers ...')
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=igdb_api_max_workers) as executor:
+        responses = list(executor.map(lambda item: get_igdb_physical_hops_via_api(*item[0]), uncached))
+    elapsed_time = time.time() - start_time
+    logging.info(f'Elapsed: {elapsed_time:.2f}s, looked up {len(uncached)} hop pairs')
 
-def convert_logical_route_to_physical_route(route: Route) -> Route:
+    cache.put_many(NAMESPACE_IGDB_PHYSICAL_HOPS,
+                   { key: json.dumps(response_json) for (_, key), response_json in zip(uncached, responses) })
+    for (hop_pair, _), response_json in zip(uncached, responses):
+        physical_hops_by_pair[hop_pair] = [tuple(hop) for hop in response_json]
+    return physical_hops_by_pair
+
+def convert_logical_route_to_physical_route(route: Route,
+                                            physical_hops_by_pair: Optional[dict[HopPair, Route]] = None) -> Route:
     physical_route: Route = []
     for i in range(len(route) - 1):
         hop1 = route[i]
         hop2 = route[i + 1]
         # Each logical step can have multiple physical hops, and note that these hops are inclusive on both ends
-        intermediate_hops = get_igdb_physical_hops(hop1, hop2)
+        if physical_hops_by_pair is not None and (hop1, hop2) in physical_hops_by_pair:
+            intermediate_hops = physical_hops_by_pair[(hop1, hop2)]
+        else:
+            intermediate_hops = get_igdb_physical_hops(hop1, hop2)
         # Connect physical hops together, while removing the common intermediate hop
         if len(physical_route) > 0:
             intermediate_hops = intermediate_hops[1:]
         physical_route += intermediate_hops[:-1]
     return physical_route
 
-def convert_all_logical_routes_to_physical_routes(logical_routes: list[Route],
-                                                  output: Optional[io.TextIOWrapper]) -> None:
-    for route in logical_routes:
-        physical_route = convert_logical_route_to_physical_route(route)
-        print(physical_route, file=output if output else sys.stdout)
+def convert_all_logical_routes_to_physical_routes(logical_routes: Iterable[WeightedRoute],
+                                                  physical_hops_by_pair: dict[HopPair, Route],
+                                                  output_file: Optional[str],
+                                                  weighted: bool = False) -> int:
+    """Convert a stream of (route, count) to physical routes, written with the counts if weighted."""
+    count = 0
+    with RouteWriter(output_file, HOP_TYPE_COORDINATE, weighted=weighted) as writer:
+        for (route, route_count) in logical_routes:
+            physical_route = convert_logical_route_to_physical_route(route, physical_hops_by_pair)
+            writer.write(physical_route, route_count)
+            count += 1
+    return count
+
+def get_unique_hop_pairs_in_file(routes_file: str) -> set[HopPair]:
+    return get_unique_hop_pairs(route for (route, _) in iter_weighted_routes_from_file(routes_file))
+
+def get_unique_hop_pairs_in_files(routes_files: list[str], jobs: int) -> set[HopPair]:
+    """Collect the unique hop pairs across all routes files, parsing the files in parallel if jobs > 1."""
+    hop_pairs: set[HopPair] = set()
+    if jobs > 1:
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            for file_hop_pairs in pool.imap_unordered(get_unique_hop_pairs_in_file, routes_files, chunksize=1):
+                hop_pairs.update(file_hop_pairs)
+    else:
+        for routes_file in routes_files:
+            hop_pairs.update(get_unique_hop_pairs_in_file(routes_file))
+    logging.info(f'Found {len(hop_pairs)} unique hop pairs in {len(routes_files)} routes files')
+    return hop_pairs
+
+def convert_routes_file(task: tuple[str, Optional[str]]) -> int:
+    """Convert one routes file using the resolved physical hops, and return the number of converted routes."""
+    (routes_file, output_file) = task
+    logging.info(f'Converting routes from {routes_file} to {output_file if output_file else "stdout"} ...')
+    return convert_all_logical_routes_to_physical_routes(iter_weighted_routes_from_file(routes_file),
+                                                         resolved_physical_hops, output_file,
+                                                         is_weighted_routes_file(routes_file))
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--routes_file', type=str, help='The logical routes file, each line contains a list of (lat, long) coordinates and represents a route.')
-    parser.add_argument('-o', '--output', type=argparse.FileType('w'), help='The output file.')
+    parser.add_argument('--routes_files', type=str, required=True, nargs='+',
+                        help='The logical routes files, each line contains a list of (lat, long) coordinates and represents a route.')
+    parser.add_argument('-o', '--outputs', type=str, nargs='*',
+                        help='The output files, or none to auto-name them after the routes files.')
     parser.add_argument('--convert-to-physical-hops', action='store_true',
                         help='Convert the routes from logical hops to physical hops using iGDB dataset.')
+    parser.add_argument('--api-concurrency', type=int, default=IGDB_API_MAX_WORKERS,
+                        help='The max number of concurrent iGDB requests.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of worker processes to parse and convert multiple routes files in parallel.')
+    add_igdb_local_arguments(parser)
     args = parser.parse_args()
 
     if not args.convert_to_physical_hops:
         parser.error('No action requested.')
 
+    if args.outputs is not None and len(args.outputs) not in [0, len(args.routes_files)]:
+        parser.error('The number of output files must match the number of routes files, or be 0 (auto-naming files)')
+    if args.igdb_local_db and args.igdb_local_csv:
+        parser.error('--igdb-local-db and --igdb-local-csv are mutually exclusive')
+    if args.api_concurrency < 1:
+        parser.error('--api-concurrency must be at least 1')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.jobs > 1 and args.outputs is None:
+        parser.error('--outputs must be specified when --jobs is greater than 1')
+
     return args
 
 def main():
     init_logging(level=logging.INFO)
     args = parse_args()
+    configure_igdb_api(args.api_concurrency)
+    if args.igdb_local_db or args.igdb_local_csv:
+        init_local_igdb_graph(args.igdb_local_db, args.igdb_local_csv, IgdbSchema.from_overrides(args.igdb_schema))
     if args.convert_to_physical_hops:
-        logical_routes = get_routes_from_file(args.routes_file)
-        convert_all_logical_routes_to_physical_routes(logical_routes, args.output)
+        tasks = []
+        for i in range(len(args.routes_files)):
+            routes_file: str = args.routes_files[i]
+            # Auto-name output_file
+            if args.outputs is not None:
+                if len(args.outputs) == 0:
+                    name = os.path.basename(routes_file)
+                    binary_suffix = ROUTES_BINARY_SUFFIX if name.endswith(ROUTES_BINARY_SUFFIX) else ''
+                    output_file = name.removesuffix(binary_suffix) + '.physical' + binary_suffix
+                else:
+                    output_file = args.outputs[i]
+            else:
+                output_file = None
+            tasks.append((routes_file, output_file))
+
+        # Plan the lookups across all files first, so that each unique hop pair is looked up once
+        hop_pairs = get_unique_hop_pairs_in_files(args.routes_files, args.jobs)
+        resolved_physical_hops.update(resolve_igdb_physical_hops(hop_pairs))
+
+        if args.jobs > 1:
+            # Workers are forked after the hops are resolved, and thus share them copy-on-write.
+            logging.info(f'Converting {len(tasks)} files with {args.jobs} processes ...')
+            with multiprocessing.get_context('fork').Pool(args.jobs) as pool:
+                for _ in pool.imap_unordered(convert_routes_file, tasks, chunksize=1):
+                    pass
+        else:
+            for task in tasks:
+                convert_routes_file(task)
     else:
         raise ValueError('No action specified')
 
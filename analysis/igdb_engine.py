@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from common import Coordinate, init_logging
+from route_distance import get_haversine_distances_km
+
+# Number of sources to run Dijkstra's from at once, which bounds the memory of the distance/predecessor matrices.
+DIJKSTRA_BATCH_SIZE = 64
+# Max number of shortest path trees to memoize, least recently used first out, each being one int32 per node.
+MAX_MEMOIZED_SOURCES = 1024
+
+@dataclass
+class IgdbSchema:
+    """Table and column names of the iGDB physical nodes and links, in the local database or the exported CSV files.
+
+        Links refer to nodes by node_id_column, and their length defaults to the great-circle distance between the
+        two ends, unless link_length_column is set.
+    """
+    nodes_table: str = 'phys_nodes'
+    node_id_column: str = 'node_id'
+    latitude_column: str = 'latitude'
+    longitude_column: str = 'longitude'
+    links_table: str = 'phys_links'
+    link_from_column: str = 'from_node'
+    link_to_column: str = 'to_node'
+    link_length_column: Optional[str] = None
+
+    @staticmethod
+    def from_overrides(overrides: list[str]) -> 'IgdbSchema':
+        """Create a schema from a list of "name=value" overrides of the default names."""
+        schema = IgdbSchema()
+        names = [field.name for field in fields(IgdbSchema)]
+        for override in overrides:
+            (name, _, value) = override.partition('=')
+            if name not in names:
+                raise ValueError(f'Unknown iGDB schema name "{name}", expected one of {names}')
+            setattr(schema, name, value)
+        return schema
+
+def to_unit_vectors(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Convert (lat, lon) in degrees to 3D unit vectors, where Euclidean nearest neighbors are also the nearest on
+        the sphere."""
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+    return np.column_stack((np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)))
+
+class IgdbPhysicalGraph:
+    """The iGDB physical network in-process, as an undirected graph of physical nodes weighted by link length.
+
+        Coordinates are snapped to the nearest physical node with a KD-tree, and the shortest paths from each source
+        node are computed with Dijkstra's in batches and memoized as predecessor arrays, so that a set of hop pairs
+        resolves with one graph search per unique source.
+    """
+    def __init__(self, nodes: pd.DataFrame, links: pd.DataFrame, schema: IgdbSchema):
+        nodes = nodes.dropna(subset=[schema.latitude_column, schema.longitude_column])
+        nodes = nodes.drop_duplicates(subset=[schema.node_id_column])
+        self.lat = nodes[schema.latitude_column].to_numpy(dtype=np.float64)
+        self.lon = nodes[schema.longitude_column].to_numpy(dtype=np.float64)
+        node_index = pd.Index(nodes[schema.node_id_column])
+
+        from_rows = node_index.get_indexer(links[schema.link_from_column])
+        to_rows = node_index.get_indexer(links[schema.link_to_column])
+        is_valid_link = (from_rows >= 0) & (to_rows >= 0) & (from_rows != to_rows)
+        if not is_valid_link.all():
+            logging.warning(f'Skipping {int((~is_valid_link).sum())} links with unknown or identical ends')
+        (from_rows, to_rows) = (from_rows[is_valid_link], to_rows[is_valid_link])
+        if schema.link_length_column:
+            lengths = links[schema.link_length_column].to_numpy(dtype=np.float64)[is_valid_link]
+        else:
+            lengths = get_haversine_distances_km(self.lat[from_rows], self.lon[from_rows],
+                                                 self.lat[to_rows], self.lon[to_rows])
+        # Zero-length links would be dropped as missing edges by the sparse matrix.
+        lengths = np.maximum(lengths, 1e-9)
+
+        node_count = len(self.lat)
+        # Add links in both directions, and keep only the shortest of parallel links, as the sparse matrix would
+        #   otherwise sum them up.
+        (edge_from_rows, edge_to_rows) = (np.concatenate((from_rows, to_rows)), np.concatenate((to_rows, from_rows)))
+        edge_lengths = np.concatenate((lengths, lengths))
+        order = np.lexsort((edge_lengths, edge_to_rows, edge_from_rows))
+        (edge_from_rows, edge_to_rows, edge_lengths) = (edge_from_rows[order], edge_to_rows[order], edge_lengths[order])
+        is_shortest = np.ones(len(order), dtype=bool)
+        is_shortest[1:] = (edge_from_rows[1:] != edge_from_rows[:-1]) | (edge_to_rows[1:] != edge_to_rows[:-1])
+        self.graph = csr_matrix((edge_lengths[is_shortest], (edge_from_rows[is_shortest], edge_to_rows[is_shortest])),
+                                shape=(node_count, node_count))
+        self.tree = cKDTree(to_unit_vectors(self.lat, self.lon))
+
+        self.lock = threading.Lock()
+        self.predecessors_by_source: OrderedDict[int, np.ndarray] = OrderedDict()
+        logging.info(f'Loaded iGDB physical graph with {node_count} nodes and {int(is_valid_link.sum())} links')
+
+    @staticmethod
+    def from_sqlite(db_path: str, schema: IgdbSchema) -> 'IgdbPhysicalGraph':
+        with sqlite3.connect(db_path) as connection:
+            nodes = pd.read_sql_query(f'SELECT * FROM "{schema.nodes_table}"', connection)
+            links = pd.read_sql_query(f'SELECT * FROM "{schema.links_table}"', connection)
+        return IgdbPhysicalGraph(nodes, links, schema)
+
+    @staticmethod
+    def from_csv(nodes_csv: str, links_csv: str, schema: IgdbSchema) -> 'IgdbPhysicalGraph':
+        return IgdbPhysicalGraph(pd.read_csv(nodes_csv), pd.read_csv(links_csv), schema)
+
+    def snap(self, coordinates: list[Coordinate]) -> np.ndarray:
+        """Return the nearest physical node of each (lat, lon) coordinate."""
+        (lats, lons) = np.array(coordinates, dtype=np.float64).reshape(-1, 2).T
+        (_, rows) = self.tree.query(to_unit_vectors(lats, lons))
+        return rows
+
+    def get_shortest_paths(self, sources: list[int]) -> dict[int, np.ndarray]:
+        """Return the shortest path trees (predecessor arrays) from the given source nodes, computing those that are
+            not memoized yet, and evicting the least recently used trees beyond MAX_MEMOIZED_SOURCES."""
+        predecessors_by_source = {}
+        with self.lock:
+            for source in sources:
+                if source in self.predecessors_by_source:
+                    self.predecessors_by_source.move_to_end(source)
+                    predecessors_by_source[source] = self.predecessors_by_source[source]
+        missing_sources = [source for source in sources if source not in predecessors_by_source]
+        for i in range(0, len(missing_sources), DIJKSTRA_BATCH_SIZE):
+            batch = missing_sources[i:i + DIJKSTRA_BATCH_SIZE]
+            (_, predecessors) = dijkstra(self.graph, directed=False, indices=batch, return_predecessors=True)
+            predecessors_by_source.update(zip(batch, predecessors))
+        with self.lock:
+            for source in missing_sources:
+                self.predecessors_by_source[source] = predecessors_by_source[source]
+            while len(self.predecessors_by_source) > MAX_MEMOIZED_SOURCES:
+                self.predecessors_by_source.popitem(last=False)
+        return predecessors_by_source
+
+    @staticmethod
+    def get_node_path(predecessors: np.ndarray, source: int, destination: int) -> Optional[list[int]]:
+        """Return the nodes on the shortest path from source to destination, inclusive, or None if unreachable."""
+        path = [destination]
+        while path[-1] != source:
+            predecessor = predecessors[path[-1]]
+            if predecessor < 0:
+                return None
+            path.append(int(predecessor))
+        path.reverse()
+        return path
+
+    def get_physical_hops_many(self, hop_pairs: list[tuple[Coordinate, Coordinate]]) -> list[list[Coordinate]]:
+        """Return the physical hops between each pair of coordinates, inclusive of both ends, i.e. the coordinates
+            themselves followed by the physical nodes on the shortest path between their nearest nodes.
+
+            Pairs whose nodes are disconnected fall back to the direct hop from src to dst.
+        """
+        if not hop_pairs:
+            return []
+        src_rows = self.snap([src for (src, _) in hop_pairs]).tolist()
+        dst_rows = self.snap([dst for (_, dst) in hop_pairs]).tolist()
+        indices_by_src_row: dict[int, list[int]] = {}
+        for i, src_row in enumerate(src_rows):
+            indices_by_src_row.setdefault(src_row, []).append(i)
+
+        # Resolve the pairs one batch of sources at a time, so only a batch of shortest path trees is held at once.
+        results: list[Optional[list[Coordinate]]] = [None] * len(hop_pairs)
+        unreachable_count = 0
+        l_src_rows = list(indices_by_src_row.keys())
+        for j in range(0, len(l_src_rows), DIJKSTRA_BATCH_SIZE):
+            predecessors_by_source = self.get_shortest_paths(l_src_rows[j:j + DIJKSTRA_BATCH_SIZE])
+            for src_row, predecessors in predecessors_by_source.items():
+                for i in indices_by_src_row[src_row]:
+                    node_path = self.get_node_path(predecessors, src_row, dst_rows[i])
+                    if node_path is None:
+                        unreachable_count += 1
+                        node_path = []
+                    (src, dst) = hop_pairs[i]
+                    results[i] = [tuple(src)] + [(float(self.lat[row]), float(self.lon[row])) for row in node_path] + \
+                        [tuple(dst)]
+        if unreachable_count:
+            logging.warning(f'{unreachable_count}/{len(hop_pairs)} hop pairs have no physical path, '
+                            'using the direct hop instead')
+        return results
+
+    def get_physical_hops(self, src: Coordinate, dst: Coordinate) -> list[Coordinate]:
+        return self.get_physical_hops_many([(src, dst)])[0]
+
+def load_igdb_physical_graph(db_path: Optional[str], csv_paths: Optional[list[str]],
+                             schema: IgdbSchema) -> IgdbPhysicalGraph:
+    """Load the iGDB physical graph from the local SQLite database, or from the exported nodes and links CSV files."""
+    logging.info(f'Loading iGDB physical graph from {db_path or csv_paths} ...')
+    start_time = time.time()
+    if db_path:
+        graph = IgdbPhysicalGraph.from_sqlite(db_path, schema)
+    elif csv_paths:
+        (nodes_csv, links_csv) = csv_paths
+        graph = IgdbPhysicalGraph.from_csv(nodes_csv, links_csv, schema)
+    else:
+        raise ValueError('Either the iGDB database or the nodes and links CSV files must be specified')
+    elapsed_time = time.time() - start_time
+    logging.info(f'Elapsed: {elapsed_time:.2f}s')
+    return graph
+
+def add_igdb_local_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--igdb-local-db', required=False,
+                        help='The local iGDB SQLite database to compute physical routes in-process.')
+    parser.add_argument('--igdb-local-csv', required=False, nargs=2, metavar=('NODES_CSV', 'LINKS_CSV'),
+                        help='The exported iGDB physical nodes and links CSV files to compute physical routes in-process.')
+    parser.add_argument('--igdb-schema', required=False, nargs='+', default=[], metavar='NAME=VALUE',
+                        help='Override the iGDB table and column names, '
+                             f'any of {[field.name for field in fields(IgdbSchema)]}.')
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    add_igdb_local_arguments(parser)
+    parser.add_argument('--src', required=True, help='The source coordinate, in the format of "lat,lon".')
+    parser.add_argument('--dst', required=True, help='The destination coordinate, in the format of "lat,lon".')
+    args = parser.parse_args()
+
+    if not args.igdb_local_db and not args.igdb_local_csv:
+        parser.error('Either --igdb-local-db or --igdb-local-csv must be specified')
+
+    return args
+
+def main():
+    init_logging(level=logging.INFO)
+    args = parse_args()
+    graph = load_igdb_physical_graph(args.igdb_local_db, args.igdb_local_csv,
+                                     IgdbSchema.from_overrides(args.igdb_schema))
+    src = tuple(float(e) for e in args.src.split(',', 1))
+    dst = tuple(float(e) for e in args.dst.split(',', 1))
+    print(graph.get_physical_hops(src, dst))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import math
+import time
+from typing import Callable, Optional
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+from common import Coordinate, init_logging
+
+class OfflineIsoResolver:
+    """Resolve coordinates to ISOs in-process, using the balancing authority / emap boundary polygons of a GeoJSON file.
+
+        The polygons are indexed by an STR-tree, and a batch of coordinates is resolved with one vectorized tree query.
+        The ISO of a feature is its `iso_property` property, prefixed with `iso_prefix` to match the `iso_format` used by
+        the carbon API, e.g. zoneName "US-CAL-CISO" -> "emap:US-CAL-CISO".
+    """
+    def __init__(self, geojson_file: str, iso_property: str = 'zoneName', iso_prefix: str = 'emap:'):
+        logging.info(f'Loading ISO boundaries from {geojson_file} ...')
+        start_time = time.time()
+        with open(geojson_file, 'r') as file:
+            data = json.load(file)
+
+        geometries = []
+        self.isos: list[str] = []
+        for feature in data['features']:
+            if not feature.get('geometry') or iso_property not in feature.get('properties', {}):
+                continue
+            geometries.append(shape(feature['geometry']))
+            self.isos.append(f'{iso_prefix}{feature["properties"][iso_property]}')
+        self.geometries = np.array(geometries, dtype=object)
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+        elapsed_time = time.time() - start_time
+        logging.info(f'Elapsed: {elapsed_time:.2f}s, loaded {len(self.isos)} ISO boundaries')
+
+    def resolve(self, coordinates: list[Coordinate]) -> list[Optional[str]]:
+        """Return the ISO of each (lat, lon) coordinate, or None if it's not covered by any boundary.
+
+            A coordinate covered by multiple boundaries resolves to the first one in the GeoJSON file.
+        """
+        if not coordinates:
+            return []
+        (lats, lons) = np.array(coordinates, dtype=np.float64).T
+        points = shapely.points(lons, lats)
+        (point_indices, geometry_indices) = self.tree.query(points, predicate='intersects')
+
+        resolved_geometry_indices = np.full(len(coordinates), len(self.isos), dtype=np.int64)
+        np.minimum.at(resolved_geometry_indices, point_indices, geometry_indices)
+        return [self.isos[i] if i < len(self.isos) else None for i in resolved_geometry_indices.tolist()]
+
+    def resolve_cells(self, cells: list[tuple[float, float, float, float]]) -> list[Optional[str]]:
+        """Return the ISO of each (min_lat, min_lon, max_lat, max_lon) cell if it lies fully inside exactly one
+            boundary, so that every coordinate in it resolves to this ISO, or None if the cell crosses a boundary."""
+        if not cells:
+            return []
+        (min_lats, min_lons, max_lats, max_lons) = np.array(cells, dtype=np.float64).T
+        boxes = shapely.box(min_lons, min_lats, max_lons, max_lats)
+        (box_indices, geometry_indices) = self.tree.query(boxes, predicate='intersects')
+
+        intersection_counts = np.bincount(box_indices, minlength=len(cells))
+        single_boxes = np.flatnonzero(intersection_counts == 1)
+        single_geometries = np.empty(len(cells), dtype=np.int64)
+        single_geometries[box_indices] = geometry_indices
+        single_geometries = single_geometries[single_boxes]
+        is_covered = shapely.covers(self.geometries[single_geometries], boxes[single_boxes])
+
+        isos: list[Optional[str]] = [None] * len(cells)
+        for (i, geometry_index) in zip(single_boxes[is_covered].tolist(), single_geometries[is_covered].tolist()):
+            isos[i] = self.isos[geometry_index]
+        return isos
+
+class SpatialIsoMemo:
+    """Memoize ISO lookups by snapping coordinates to a grid of cell_size_deg degrees.
+
+        A coordinate in a cell that lies fully inside one ISO boundary resolves to that ISO without any lookup, which
+        covers most of the ITDK coordinates clustered around city centroids. Coordinates in cells near boundaries fall
+        back to an exact (memoized) lookup via resolve_exact, so the results are the same as without the memo.
+    """
+    def __init__(self, resolver: OfflineIsoResolver, resolve_exact: Callable[[list[Coordinate]], list[str]],
+                 cell_size_deg: float = 0.1):
+        self.resolver = resolver
+        self.resolve_exact = resolve_exact
+        self.cell_size_deg = cell_size_deg
+        self.cell_isos: dict[tuple[int, int], Optional[str]] = {}
+        self.exact_isos: dict[Coordinate, str] = {}
+        self.stats = { 'cell_hits': 0, 'exact_hits': 0, 'boundary_lookups': 0,
+                       'interior_cells': 0, 'boundary_cells': 0 }
+
+    def get_cell(self, coordinate: Coordinate) -> tuple[int, int]:
+        (lat, lon) = coordinate
+        return (math.floor(lat / self.cell_size_deg), math.floor(lon / self.cell_size_deg))
+
+    def resolve(self, coordinates: list[Coordinate]) -> list[str]:
+        cells = [self.get_cell(coordinate) for coordinate in coordinates]
+        new_cells = list(set(cell for cell in cells if cell not in self.cell_isos))
+        # Pad the cells slightly, so that rounding errors in snapping can't place a coordinate outside of its cell.
+        padding = self.cell_size_deg * 1e-6
+        cell_boxes = [(i * self.cell_size_deg - padding, j * self.cell_size_deg - padding,
+                       (i + 1) * self.cell_size_deg + padding, (j + 1) * self.cell_size_deg + padding)
+                      for (i, j) in new_cells]
+        for cell, iso in zip(new_cells, self.resolver.resolve_cells(cell_boxes)):
+            self.cell_isos[cell] = iso
+            self.stats['interior_cells' if iso is not None else 'boundary_cells'] += 1
+
+        isos: list[Optional[str]] = [None] * len(coordinates)
+        pending_coordinates: dict[Coordinate, list[int]] = {}
+        for i, (coordinate, cell) in enumerate(zip(coordinates, cells)):
+            iso = self.cell_isos[cell]
+            if iso is not None:
+                isos[i] = iso
+                self.stats['cell_hits'] += 1
+            elif coordinate in self.exact_isos:
+                isos[i] = self.exact_isos[coordinate]
+                self.stats['exact_hits'] += 1
+            else:
+                pending_coordinates.setdefault(coordinate, []).append(i)
+
+        l_pending_coordinates = list(pending_coordinates.keys())
+        self.stats['boundary_lookups'] += len(l_pending_coordinates)
+        for coordinate, iso in zip(l_pending_coordinates, self.resolve_exact(l_pending_coordinates)):
+            self.exact_isos[coordinate] = iso
+            for i in pending_coordinates[coordinate]:
+                isos[i] = iso
+        return isos
+
+    def get_stats(self) -> dict[str, int]:
+        return dict(self.stats)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iso-geojson', required=True, help='The GeoJSON file of ISO boundaries.')
+    parser.add_argument('--coordinates', required=True, nargs='+',
+                        help='The coordinates to resolve, each in the format of "lat,lon".')
+    args = parser.parse_args()
+    return args
+
+def main():
+    init_logging(level=logging.INFO)
+    args = parse_args()
+    resolver = OfflineIsoResolver(args.iso_geojson)
+    coordinates = [tuple(float(e) for e in coordinate.split(',', 1)) for coordinate in args.coordinates]
+    for coordinate, iso in zip(coordinates, resolver.resolve(coordinates)):
+        print(f'{coordinate}: {iso}')
+
+if __name__ == '__main__':
+    main()
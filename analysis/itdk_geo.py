@@ -5,91 +5,85 @@ import csv
 import functools
 import io
 import logging
+import multiprocessing
 import os
-import sys
 import traceback
-from typing import Callable, Optional
-import pandas as pd
-
-from common import Coordinate, RouteInCoordinate, RouteInIP, detect_cloud_regions_from_filename, get_routes_from_file, init_logging, load_itdk_node_ip_to_id_mapping
-from carbon_client import get_carbon_region_from_coordinate
-
-def parse_node_geo_as_dataframe(node_geo_filename='../data/caida-itdk/midar-iff.nodes.geo') -> pd.DataFrame:
-    logging.info(f'Loading node geo entries from {node_geo_filename} ...')
-    columns = ['node_id', 'continent', 'country', 'region', 'city', 'lat', 'long', 'pop', 'IX', 'source']
-    column_dtypes = {
-        # 'node_id': None,  # type is already specified by the converter
-        'continent': str,
-        'country': str,
-        'region': str,
-        'city': str,
-        'lat': float,
-        'long': float,
-        'pop': str,
-        'IX': str,
-        'source': str,
-    }
-    usecols = ['node_id', 'continent', 'country', 'region', 'city', 'lat', 'long']
-    converter_node_id = lambda s: s.removeprefix('node.geo ').removesuffix(':')
-
-    node_geo_df = pd.read_csv(node_geo_filename, sep='\t', comment='#', index_col='node_id',
-                              names=columns, dtype=column_dtypes, usecols=usecols,
-                              converters={'node_id': converter_node_id })
-    logging.info(f'Loaded {len(node_geo_df)} entries from {node_geo_filename}.')
-    return node_geo_df
+from typing import Callable, Iterable, Optional
+import numpy as np
+
+from common import Coordinate, RouteInCoordinate, RouteInIP, WeightedRoute, detect_cloud_regions_from_filename, \
+    init_logging, iter_chunks, iter_weighted_routes_from_file
+from itdk_geo_table import IpNodeTable, NodeGeoTable, convert_ip_routes_to_coordinate_arrays, flatten_ip_routes, \
+    load_ip_node_table, load_node_geo_table
+from carbon_client import ISO_GRID_CELL_SIZE_DEG, get_carbon_region_from_coordinate, init_offline_iso_resolver, \
+    log_spatial_iso_memo_stats
+from route_format import HOP_TYPE_COORDINATE, ROUTES_BINARY_SUFFIX, RouteWriter, is_weighted_routes_file
 
 def get_node_ids_with_geo_coordinates() -> list[str]:
-    node_geo_df = parse_node_geo_as_dataframe()
-    return node_geo_df.index.tolist()
+    node_geo_table = load_node_geo_table()
+    return [f'N{node_number}' for node_number in node_geo_table.node_numbers.tolist()]
 
-def convert_routes_from_ip_to_latlon(routes: list[RouteInIP],
-                                     node_ip_to_id: dict[str, str],
-                                     node_geo_df: pd.DataFrame,
-                                     is_valid_route: Callable[[RouteInCoordinate], bool],
-                                     output_file: Optional[str]) -> list[RouteInCoordinate]:
-    logging.info('Converting valid routes from IPs to lat/lons ...')
-    converted_routes: list[RouteInCoordinate] = []
+def convert_route_chunk_from_ip_to_latlon(weighted_routes: list[WeightedRoute],
+                                          ip_node_table: IpNodeTable,
+                                          node_geo_table: NodeGeoTable,
+                                          is_valid_route: Callable[[RouteInCoordinate], bool]) -> \
+                                            list[WeightedRoute]:
+    """Convert a chunk of (route, count) from IPs to lat/lon coordinates, and return the valid ones with their counts."""
+    converted_routes: list[WeightedRoute] = []
+    routes: list[RouteInIP] = [route for (route, _) in weighted_routes]
 
-    if output_file:
-        output = open(output_file, 'w')
-        logging.info(f'Writing (lat, lon) routes to {output_file} ...')
-    else:
-        output = None
-    for ip_addresses in routes:
-        # Convert each IP address to a node ID using the node_ip_to_id dictionary
-        node_ids = [node_ip_to_id.get(ip, '') for ip in ip_addresses]
-
-        # Convert node IDs to latitude and longitude using the node_geo_df dictionary
-        coordinates: list[Coordinate] = []
-        for node_id in node_ids:
-            if not node_id:
-                logging.warning(f'Ignoring unknown node with ip {ip_addresses}')
-                continue
-            if node_id not in node_geo_df.index:
-                logging.error(f'Node ID {node_id} not found in node_geo_df')
-                coordinates = []
-                break
-            row = node_geo_df.loc[node_id]
-            coordinates.append((row['lat'], row['long']))
+    # Convert all hops at once, with invalid hops/routes masked out
+    flattened_routes = flatten_ip_routes(routes)
+    (geo_routes, lats, lons, has_geo_on_all_nodes) = \
+        convert_ip_routes_to_coordinate_arrays(flattened_routes, ip_node_table, node_geo_table)
+    unknown_hop_count = len(flattened_routes.hops) - len(geo_routes.hops)
+    if unknown_hop_count:
+        logging.warning(f'Ignoring {unknown_hop_count} hops with unknown nodes or nodes without geo coordinates')
+    logging.info(f'Found {np.count_nonzero(~has_geo_on_all_nodes)} routes with nodes not found in node geo table')
+
+    offsets = geo_routes.offsets.tolist()
+    lats = lats.tolist()
+    lons = lons.tolist()
+    for i in range(len(routes)):
         # Route must have at least 2 hops, at src and dst.
-        if len(coordinates) < 2:
-            logging.warning(f'Ignoring route with less than 2 hops: {ip_addresses}')
+        if not has_geo_on_all_nodes[i] or offsets[i + 1] - offsets[i] < 2:
+            logging.warning(f'Ignoring route with less than 2 hops: {routes[i]}')
             continue
+        coordinates: list[Coordinate] = list(zip(lats[offsets[i]:offsets[i + 1]], lons[offsets[i]:offsets[i + 1]]))
 
         # Check if the route is valid
         if not is_valid_route(coordinates):
             continue
 
         # Append the converted route to the result
-        print(coordinates, file=output if output else sys.stdout)
-        converted_routes.append(coordinates)
-
-    if output:
-        output.close()
+        converted_routes.append((coordinates, weighted_routes[i][1]))
 
-    logging.info('Converted/Total: %d/%d', len(converted_routes), len(routes))
     return converted_routes
 
+def convert_routes_from_ip_to_latlon(weighted_routes: Iterable[WeightedRoute],
+                                     ip_node_table: IpNodeTable,
+                                     node_geo_table: NodeGeoTable,
+                                     is_valid_route: Callable[[RouteInCoordinate], bool],
+                                     output_file: Optional[str],
+                                     weighted: bool = False) -> int:
+    """Convert a stream of (route, count) from IPs to lat/lon coordinates chunk by chunk, writing out each chunk as
+        soon as it's converted, with the counts if weighted, and return the number of converted routes."""
+    logging.info('Converting valid routes from IPs to lat/lons ...')
+    (converted_count, total_count) = (0, 0)
+
+    if output_file:
+        logging.info(f'Writing (lat, lon) routes to {output_file} ...')
+    with RouteWriter(output_file, HOP_TYPE_COORDINATE, weighted=weighted) as writer:
+        for chunk in iter_chunks(weighted_routes):
+            converted_routes = convert_route_chunk_from_ip_to_latlon(chunk, ip_node_table, node_geo_table,
+                                                                     is_valid_route)
+            writer.write_weighted(converted_routes)
+            converted_count += len(converted_routes)
+            total_count += len(chunk)
+
+    logging.info('Converted/Total: %d/%d', converted_count, total_count)
+    return converted_count
+
 def load_region_to_geo_coordinate_ground_truth(geo_coordinate_ground_truth_csv: io.TextIOWrapper) -> \
                                                 dict[str, Coordinate]:
     with geo_coordinate_ground_truth_csv as f:
@@ -119,6 +113,7 @@ def get_route_check_function_by_ground_truth(geo_coordinate_ground_truth: dict[s
 
         logging.info('Filtering routes based on ground truth geo coordinates of src and dst, converted to ISOs ...')
         logging.info(f'Ground truth: src: {src} -> {src_iso}, dst: {dst} -> {dst_iso}')
+        # Memoized here too, as carbon_client doesn't cache the coordinates that fail to resolve, i.e. 'Unknown'.
         @functools.cache
         def are_isos_equal(coord1: Coordinate, coord2: Coordinate):
             # (lat1, lon1) = gps1.split(',', 1)
@@ -132,6 +127,9 @@ def get_route_check_function_by_ground_truth(geo_coordinate_ground_truth: dict[s
         check_route_by_ground_truth = lambda route: are_isos_equal(route[0], src_coordinate) and are_isos_equal(route[-1], dst_coordinate)
         return check_route_by_ground_truth
 
+# Lookup tables loaded once by the main process, and inherited by the forked worker processes.
+shared_lookup_tables: dict = {}
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--routes_files', type=str, required=True, nargs='+', help='The routes file, each line contains a list that represents a route.')
@@ -146,11 +144,22 @@ def parse_args():
     parser.add_argument('--dst-cloud', required=False, help='The destination cloud')
     parser.add_argument('--src-region', required=False, help='The source region')
     parser.add_argument('--dst-region', required=False, help='The destination region')
+    parser.add_argument('--iso-geojson', required=False,
+                        help='The GeoJSON file of ISO boundaries to resolve coordinates offline when filtering by ground truth.')
+    parser.add_argument('--iso-grid-cell-deg', type=float, default=ISO_GRID_CELL_SIZE_DEG,
+                        help='The grid cell size in degrees to memoize ISO lookups with --iso-geojson, 0 to disable.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of worker processes to convert multiple routes files in parallel.')
     args = parser.parse_args()
 
     if args.outputs is not None and len(args.outputs) not in [0, len(args.routes_files)]:
         parser.error('The number of output files must match the number of routes files, or be 0 (auto-naming files)')
 
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.jobs > 1 and args.outputs is None:
+        parser.error('--outputs must be specified when --jobs is greater than 1')
+
     if args.filter_geo_coordinate_by_ground_truth:
         if not args.geo_coordinate_ground_truth_csv:
             parser.error('--geo-coordinate-ground-truth-csv must be specified when --filter-geo-coordinate-by-ground-truth is specified')
@@ -176,47 +185,74 @@ def parse_args():
 
     return args
 
+def convert_routes_file(task: tuple[str, Optional[str], Optional[tuple[str, str, str, str]]]) -> int:
+    """Convert one routes file using the shared lookup tables, and return the number of converted routes."""
+    (routes_file, output_file, cloud_regions) = task
+    # Generate check route function
+    if cloud_regions is not None:
+        (src_cloud, src_region, dst_cloud, dst_region) = cloud_regions
+        check_route_by_ground_truth = \
+            get_route_check_function_by_ground_truth(shared_lookup_tables['geo_coordinate_ground_truth'],
+                                                    src_cloud, src_region,
+                                                    dst_cloud, dst_region)
+    else:
+        check_route_by_ground_truth = lambda _: True
+    # Convert routes
+    logging.info(f'Converting routes from {routes_file} to {output_file if output_file else "stdout"} ...')
+    # Weighted routes stay weighted, as each unique route converts to one route with the same count.
+    converted_count = convert_routes_from_ip_to_latlon(iter_weighted_routes_from_file(routes_file),
+                                                       shared_lookup_tables['ip_node_table'],
+                                                       shared_lookup_tables['node_geo_table'],
+                                                       check_route_by_ground_truth,
+                                                       output_file,
+                                                       is_weighted_routes_file(routes_file))
+    log_spatial_iso_memo_stats()
+    return converted_count
+
 def main():
     init_logging(level=logging.INFO)
     args = parse_args()
+    if args.iso_geojson:
+        init_offline_iso_resolver(args.iso_geojson, args.iso_grid_cell_deg)
     if args.convert_ip_to_latlon:
-        node_ip_to_id = load_itdk_node_ip_to_id_mapping()
-        node_geo_df = parse_node_geo_as_dataframe()
-        geo_coordinate_ground_truth = \
+        shared_lookup_tables['ip_node_table'] = load_ip_node_table()
+        shared_lookup_tables['node_geo_table'] = load_node_geo_table()
+        shared_lookup_tables['geo_coordinate_ground_truth'] = \
             load_region_to_geo_coordinate_ground_truth(args.geo_coordinate_ground_truth_csv) \
             if args.filter_geo_coordinate_by_ground_truth else {}
+        tasks = []
         for i in range(len(args.routes_files)):
             routes_file: str = args.routes_files[i]
             # Auto-name output_file
             if args.outputs is not None:
                 if len(args.outputs) == 0:
-                    output_file = os.path.basename(routes_file).removesuffix('.by_ip') + '.by_geo'
+                    name = os.path.basename(routes_file)
+                    binary_suffix = ROUTES_BINARY_SUFFIX if name.endswith(ROUTES_BINARY_SUFFIX) else ''
+                    output_file = name.removesuffix(binary_suffix).removesuffix('.by_ip') + '.by_geo' + binary_suffix
                 else:
                     output_file = args.outputs[i]
             else:
                 output_file = None
-            # Generate check route function
             if args.filter_geo_coordinate_by_ground_truth:
                 if routes_file in args.cloud_region_pair_by_filename:
-                    (src_cloud, src_region, dst_cloud, dst_region) = args.cloud_region_pair_by_filename[routes_file]
+                    cloud_regions = args.cloud_region_pair_by_filename[routes_file]
                 else:
-                    (src_cloud, src_region) = (args.src_cloud, args.src_region)
-                    (dst_cloud, dst_region) = (args.dst_cloud, args.dst_region)
-                check_route_by_ground_truth = \
-                    get_route_check_function_by_ground_truth(geo_coordinate_ground_truth,
-                                                            src_cloud, src_region,
-                                                            dst_cloud, dst_region)
+                    cloud_regions = (args.src_cloud, args.src_region, args.dst_cloud, args.dst_region)
             else:
-                check_route_by_ground_truth = lambda _: True
-            # Convert routes
-            logging.info(f'Converting routes from {routes_file} to {output_file if output_file else "stdout"} ...')
-            routes = get_routes_from_file(routes_file)
-            convert_routes_from_ip_to_latlon(routes, node_ip_to_id, node_geo_df,
-                                             check_route_by_ground_truth,
-                                             output_file)
+                cloud_regions = None
+            tasks.append((routes_file, output_file, cloud_regions))
+
+        if args.jobs > 1:
+            # Workers are forked after the tables are loaded, and thus share them copy-on-write.
+            logging.info(f'Converting {len(tasks)} files with {args.jobs} processes ...')
+            with multiprocessing.get_context('fork').Pool(args.jobs) as pool:
+                for _ in pool.imap_unordered(convert_routes_file, tasks, chunksize=1):
+                    pass
+        else:
+            for task in tasks:
+                convert_routes_file(task)
     else:
         raise ValueError('No action specified')
 
 if __name__ == '__main__':
     main()
-
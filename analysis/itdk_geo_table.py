@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+from common import RouteInIP
+
+NODE_GEO_CACHE_VERSION = 1
+NODE_GEO_CATEGORICAL_COLUMNS = ['continent', 'country', 'region', 'city']
+FINGERPRINT_BLOCK_SIZE = 1 << 20
+
+@dataclass
+class NodeGeoTable:
+    """ITDK node geo coordinates as contiguous arrays, sorted by the integer node number (N123 -> 123)."""
+    node_numbers: np.ndarray    # int64
+    lat: np.ndarray             # float64
+    lon: np.ndarray             # float64
+
+    def lookup_rows(self, node_numbers: np.ndarray) -> np.ndarray:
+        """Return the row of each node number in this table, or -1 if the node has no geo coordinate."""
+        return lookup_sorted(self.node_numbers, node_numbers)
+
+@dataclass
+class IpNodeTable:
+    """ITDK IP address to node number mapping as contiguous arrays, sorted by the IP address."""
+    ips: np.ndarray             # uint32
+    node_numbers: np.ndarray    # int64
+
+    def lookup_node_numbers(self, ips: np.ndarray) -> np.ndarray:
+        """Return the node number of each IP address, or -1 if the IP address is unknown."""
+        rows = lookup_sorted(self.ips, ips)
+        return np.where(rows >= 0, self.node_numbers[np.maximum(rows, 0)] if self.ips.size else -1, -1)
+
+@dataclass
+class FlattenedRoutes:
+    """Routes stored as a flat hop array, where the hops of route i are hops[offsets[i]:offsets[i + 1]]."""
+    offsets: np.ndarray         # int64, length is the number of routes + 1
+    hops: np.ndarray
+
+def lookup_sorted(keys: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    """Return the position of each query in the sorted keys array, or -1 if not found."""
+    if keys.size == 0:
+        return np.full(len(queries), -1, dtype=np.int64)
+    positions = np.searchsorted(keys, queries)
+    positions[positions == keys.size] = 0
+    return np.where(keys[positions] == queries, positions, -1)
+
+def node_id_to_number(node_id: str) -> int:
+    return int(node_id.removeprefix('N'))
+
+def ips_to_uint32(ips: Iterable[str]) -> np.ndarray:
+    packed_ips = b''.join(map(socket.inet_aton, ips))
+    return np.frombuffer(packed_ips, dtype='>u4').astype(np.uint32)
+
+def uint32_to_ips(ips: np.ndarray) -> list[str]:
+    packed_ips = ips.astype('>u4').tobytes()
+    return [socket.inet_ntoa(packed_ips[i:i + 4]) for i in range(0, len(packed_ips), 4)]
+
+def read_node_geo_file(node_geo_filename: str) -> pd.DataFrame:
+    """Parse the tab-separated .nodes.geo file, with integer node numbers and categorical country/region/city."""
+    columns = ['node_id', 'continent', 'country', 'region', 'city', 'lat', 'long', 'pop', 'IX', 'source']
+    column_dtypes = {
+        'node_id': str,
+        'continent': 'category',
+        'country': 'category',
+        'region': 'category',
+        'city': 'category',
+        'lat': float,
+        'long': float,
+        'pop': str,
+        'IX': str,
+        'source': str,
+    }
+    usecols = ['node_id', 'continent', 'country', 'region', 'city', 'lat', 'long']
+
+    node_geo_df = pd.read_csv(node_geo_filename, sep='\t', comment='#',
+                              names=columns, dtype=column_dtypes, usecols=usecols)
+    # Node IDs are in the format of "node.geo N123:"
+    node_geo_df['node_id'] = node_geo_df['node_id'].str.removeprefix('node.geo N').str.removesuffix(':') \
+        .astype(np.int64)
+    return node_geo_df.sort_values('node_id', kind='stable', ignore_index=True)
+
+def get_file_fingerprint(filename: str) -> dict:
+    """Return the size, mtime and a hash of the file, where the hash only covers the first and last blocks so that it
+        stays cheap on multi-GB files."""
+    stat = os.stat(filename)
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        sha256.update(file.read(FINGERPRINT_BLOCK_SIZE))
+        if stat.st_size > FINGERPRINT_BLOCK_SIZE:
+            file.seek(max(FINGERPRINT_BLOCK_SIZE, stat.st_size - FINGERPRINT_BLOCK_SIZE))
+            sha256.update(file.read())
+    return { 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256.hexdigest() }
+
+def get_node_geo_cache_dirpath(node_geo_filename: str) -> str:
+    return node_geo_filename + '.cache'
+
+def write_node_geo_cache(cache_dirpath: str, node_geo_df: pd.DataFrame, fingerprint: dict) -> None:
+    """Store each column as a .npy file that can be memory-mapped, and the categories in the metadata file."""
+    logging.info(f'Writing node geo cache to {cache_dirpath} ...')
+    tmp_dirpath = f'{cache_dirpath}.tmp.{os.getpid()}'
+    os.makedirs(tmp_dirpath)
+    try:
+        np.save(os.path.join(tmp_dirpath, 'node_id.npy'), node_geo_df['node_id'].to_numpy(dtype=np.int64))
+        np.save(os.path.join(tmp_dirpath, 'lat.npy'), node_geo_df['lat'].to_numpy(dtype=np.float64))
+        np.save(os.path.join(tmp_dirpath, 'long.npy'), node_geo_df['long'].to_numpy(dtype=np.float64))
+        categories = {}
+        for column in NODE_GEO_CATEGORICAL_COLUMNS:
+            np.save(os.path.join(tmp_dirpath, f'{column}.npy'), node_geo_df[column].cat.codes.to_numpy(dtype=np.int32))
+            categories[column] = node_geo_df[column].cat.categories.tolist()
+        with open(os.path.join(tmp_dirpath, 'metadata.json'), 'w') as file:
+            json.dump({ 'version': NODE_GEO_CACHE_VERSION, 'source': fingerprint, 'categories': categories }, file)
+        # Move the old cache aside before publishing the new one, as a directory can't be replaced in one rename.
+        # Readers in between see no cache, and readers of the old one keep their memory maps after it is removed.
+        old_dirpath = f'{cache_dirpath}.old.{os.getpid()}'
+        try:
+            os.rename(cache_dirpath, old_dirpath)
+        except FileNotFoundError:
+            pass
+        os.rename(tmp_dirpath, cache_dirpath)
+        shutil.rmtree(old_dirpath, ignore_errors=True)
+    except OSError as ex:
+        logging.warning(f'Failed to write node geo cache to {cache_dirpath}: {ex}')
+        shutil.rmtree(tmp_dirpath, ignore_errors=True)
+
+def read_node_geo_cache(cache_dirpath: str, fingerprint: dict) -> Optional[dict]:
+    """Return the memory-mapped columns and categories, or None if the cache is missing or stale, including when it
+        is being replaced by another process."""
+    try:
+        with open(os.path.join(cache_dirpath, 'metadata.json')) as file:
+            metadata = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if metadata.get('version') != NODE_GEO_CACHE_VERSION or metadata.get('source') != fingerprint:
+        logging.info(f'Node geo cache {cache_dirpath} is stale.')
+        return None
+    columns = {}
+    try:
+        for column in ['node_id', 'lat', 'long'] + NODE_GEO_CATEGORICAL_COLUMNS:
+            columns[column] = np.load(os.path.join(cache_dirpath, f'{column}.npy'), mmap_mode='r')
+    except OSError:
+        return None
+    return { 'columns': columns, 'categories': metadata['categories'] }
+
+def load_node_geo_columns(node_geo_filename: str) -> dict:
+    """Load the node geo columns from the cache next to the source file, (re)building the cache if needed."""
+    cache_dirpath = get_node_geo_cache_dirpath(node_geo_filename)
+    fingerprint = get_file_fingerprint(node_geo_filename)
+    cached = read_node_geo_cache(cache_dirpath, fingerprint)
+    if cached is not None:
+        logging.info(f'Loaded {len(cached["columns"]["node_id"])} node geo entries from cache {cache_dirpath}.')
+        return cached
+
+    logging.info(f'Loading node geo entries from {node_geo_filename} ...')
+    node_geo_df = read_node_geo_file(node_geo_filename)
+    logging.info(f'Loaded {len(node_geo_df)} entries from {node_geo_filename}.')
+    write_node_geo_cache(cache_dirpath, node_geo_df, fingerprint)
+    cached = read_node_geo_cache(cache_dirpath, fingerprint)
+    if cached is not None:
+        return cached
+    # Fall back to in-memory columns if the cache is not writable
+    return {
+        'columns': { column: node_geo_df[column].cat.codes.to_numpy(dtype=np.int32)
+                        if column in NODE_GEO_CATEGORICAL_COLUMNS else node_geo_df[column].to_numpy()
+                     for column in node_geo_df.columns },
+        'categories': { column: node_geo_df[column].cat.categories.tolist()
+                        for column in NODE_GEO_CATEGORICAL_COLUMNS },
+    }
+
+def parse_node_geo_as_dataframe(node_geo_filename='../data/caida-itdk/midar-iff.nodes.geo') -> pd.DataFrame:
+    node_geo = load_node_geo_columns(node_geo_filename)
+    columns = node_geo['columns']
+    data = {}
+    for column in NODE_GEO_CATEGORICAL_COLUMNS:
+        data[column] = pd.Categorical.from_codes(columns[column], categories=node_geo['categories'][column])
+    data['lat'] = columns['lat']
+    data['long'] = columns['long']
+    index = pd.Index([f'N{node_number}' for node_number in columns['node_id'].tolist()], name='node_id')
+    return pd.DataFrame(data, index=index)
+
+def load_node_geo_table(node_geo_filename='../data/caida-itdk/midar-iff.nodes.geo') -> NodeGeoTable:
+    """Load the node geo table directly from the memory-mapped cache columns, which are shared across processes."""
+    columns = load_node_geo_columns(node_geo_filename)['columns']
+    return NodeGeoTable(node_numbers=columns['node_id'], lat=columns['lat'], lon=columns['long'])
+
+def build_ip_node_table(ips: np.ndarray, node_numbers: np.ndarray) -> IpNodeTable:
+    order = np.argsort(ips, kind='stable')
+    ips = ips[order]
+    node_numbers = node_numbers[order]
+    # Keep the last node of a duplicate IP address, same as a dictionary would.
+    is_last = np.ones(len(ips), dtype=bool)
+    is_last[:-1] = ips[:-1] != ips[1:]
+    return IpNodeTable(ips=np.ascontiguousarray(ips[is_last]),
+                       node_numbers=np.ascontiguousarray(node_numbers[is_last]))
+
+def load_ip_node_table(node_file='../data/caida-itdk/midar-iff.nodes') -> IpNodeTable:
+    """Load the ITDK IP address to node number mapping, without building the per-IP dictionary."""
+    logging.info('Loading ITDK nodes as IP to node table ...')
+    start_time = time.time()
+    l_ips: list[str] = []
+    l_node_numbers: list[int] = []
+    node_count = 0
+    with open(node_file, 'r') as file:
+        for line in file:
+            if line.startswith('#'):
+                continue
+
+            if not line.startswith('node N'):
+                logging.error(f'Cannot process line: {line}')
+                continue
+
+            arr = line.split(':', 1)
+            node_number = node_id_to_number(arr[0].split()[1])
+            ips = arr[1].split()
+            l_ips += ips
+            l_node_numbers += [node_number] * len(ips)
+
+            node_count += 1
+            if node_count % 1000000 == 0:
+                elapsed_time = time.time() - start_time
+                logging.debug(f'Elapsed: {elapsed_time:.2f}s, node count: {node_count}')
+    ip_node_table = build_ip_node_table(ips_to_uint32(l_ips), np.array(l_node_numbers, dtype=np.int64))
+    elapsed_time = time.time() - start_time
+    logging.info(f'Elapsed: {elapsed_time:.2f}s, total node count: {node_count}, IP count: {len(ip_node_table.ips)}')
+    return ip_node_table
+
+def flatten_ip_routes(routes: list[RouteInIP]) -> FlattenedRoutes:
+    offsets = np.zeros(len(routes) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, routes), dtype=np.int64, count=len(routes)), out=offsets[1:])
+    hops = ips_to_uint32(ip for route in routes for ip in route)
+    return FlattenedRoutes(offsets=offsets, hops=hops)
+
+def convert_ip_routes_to_coordinate_arrays(routes: FlattenedRoutes,
+                                           ip_node_table: IpNodeTable,
+                                           node_geo_table: NodeGeoTable) -> \
+                                            tuple[FlattenedRoutes, np.ndarray, np.ndarray, np.ndarray]:
+    """Convert all routes from IPs to lat/lon coordinates in one gather over the flattened hops.
+
+        Hops with an unknown IP address are dropped, and a route with any hop whose node has no geo coordinate is
+        invalidated. Returns the routes of row indices into the node geo table, the lat and lon arrays of these rows,
+        and a boolean mask of the valid routes.
+    """
+    node_numbers = ip_node_table.lookup_node_numbers(routes.hops)
+    rows = node_geo_table.lookup_rows(node_numbers)
+    is_known_ip = node_numbers >= 0
+    is_missing_geo = is_known_ip & (rows < 0)
+
+    route_ids = np.repeat(np.arange(len(routes.offsets) - 1), np.diff(routes.offsets))
+    is_valid_route = np.bincount(route_ids[is_missing_geo], minlength=len(routes.offsets) - 1) == 0
+
+    kept_hops = is_known_ip & ~is_missing_geo
+    offsets = np.zeros_like(routes.offsets)
+    np.cumsum(np.bincount(route_ids[kept_hops], minlength=len(routes.offsets) - 1), out=offsets[1:])
+    kept_rows = rows[kept_hops]
+    return (FlattenedRoutes(offsets=offsets, hops=kept_rows),
+            node_geo_table.lat[kept_rows], node_geo_table.lon[kept_rows], is_valid_route)
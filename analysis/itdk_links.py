@@ -7,6 +7,7 @@ import logging
 import re
 import sys
 import time
+from collections import Counter
 
 from common import MATCHED_NODES_FILENAME_AWS, MATCHED_NODES_FILENAME_GCLOUD, init_logging, load_itdk_node_id_to_ips_mapping
 from itdk_geo import get_node_ids_with_geo_coordinates
@@ -134,6 +135,9 @@ def parse_args():
     parser.add_argument('--src-ips', required=False, nargs='+', help='The source IP addresses')
     parser.add_argument('--dst-ips', required=False, nargs='+', help='The destination IP addresses')
 
+    parser.add_argument('--weighted', action='store_true',
+                        help='Print each unique path once with its count, as "<count> <path>", instead of every path.')
+
     # Must provide one of src/dst cloud, ips or nodes
     args = parser.parse_args()
     if not (args.src_cloud or args.src_ips or args.src_nodes):
@@ -188,8 +192,12 @@ def main():
 
             print(f'# {src_group} -> {dst_group}')
             paths = [[unsigned_int_to_ip(item) for item in path] for path in paths if path]
-            for path in paths:
-                print(path)
+            if args.weighted:
+                for path, count in Counter(tuple(path) for path in paths).items():
+                    print(count, list(path))
+            else:
+                for path in paths:
+                    print(path)
 
             logging.info(f'Dijkstra from {src_group} to {dst_group} completed. Found {len(paths)} paths in total.')
 
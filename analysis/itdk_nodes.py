@@ -2,13 +2,20 @@
 
 
 import ast
+import json
 import logging
+import os
 import time
 import argparse
+from typing import Iterable
+from ipaddress import IPv4Network
 # from ipaddress import IPv4Address, IPv4Network
+import numpy as np
 from cidr_trie import PatriciaTrie
 
-from common import init_logging, load_cloud_ip_ranges, load_itdk_node_id_to_ips_mapping
+from common import DirType, detect_cloud_regions_from_filename, init_logging, load_cloud_ip_ranges, load_cloud_ip_ranges_version, \
+    load_itdk_node_id_to_ips_mapping
+from itdk_geo_table import IpNodeTable, load_ip_node_table, uint32_to_ips
 
 def build_trie_from_ip_ranges(ip_ranges: list[tuple]) -> PatriciaTrie:
     trie = PatriciaTrie()
@@ -47,6 +54,21 @@ def get_matching_node_ips(cidr_trie: PatriciaTrie, itdk_node_id_to_ips: dict[str
 
     return matched_node_ips
 
+def get_node_ips_covered_by_prefixes(ip_node_table: IpNodeTable, ip_prefixes: Iterable[str]) -> dict[str, list]:
+    """Return the ITDK IPs within any of the IP prefixes by node id, selecting the [network, broadcast] range of each
+        prefix from the IPs sorted in ip_node_table, instead of scanning all IPs."""
+    rows = []
+    for ip_prefix in set(ip_prefixes):
+        network = IPv4Network(ip_prefix, strict=False)
+        start = np.searchsorted(ip_node_table.ips, int(network.network_address), side='left')
+        end = np.searchsorted(ip_node_table.ips, int(network.broadcast_address), side='right')
+        rows.append(np.arange(start, end))
+    rows = np.unique(np.concatenate(rows)) if rows else np.array([], dtype=np.int64)
+    covered_node_ips = {}
+    for node_number, ip in zip(ip_node_table.node_numbers[rows].tolist(), uint32_to_ips(ip_node_table.ips[rows])):
+        covered_node_ips.setdefault(f'N{node_number}', []).append(ip)
+    return covered_node_ips
+
 def convert_matched_nodes_to_by_region(matched_nodes_file, ip_ranges):
     # by region, node, prefix then ip.
     logging.info('Converting matched nodes format ...')
@@ -64,13 +86,127 @@ def convert_matched_nodes_to_by_region(matched_nodes_file, ip_ranges):
             d_by_region[region][node_id].append((prefix, ip))
     return d_by_region
 
+def get_default_manifest_filename(matched_nodes_file: str) -> str:
+    return matched_nodes_file + '.manifest.json'
+
+def write_matched_nodes_manifest(manifest_file: str, cloud: str, region: str, ip_ranges: list[tuple]) -> None:
+    """Record the set of (prefix, region) the matched nodes file was built from, along with the IP ranges version."""
+    manifest = {
+        'cloud': cloud,
+        'region': region,
+        **load_cloud_ip_ranges_version(cloud),
+        'prefixes': sorted(set((ip_prefix, prefix_region) for (ip_prefix, _, prefix_region) in ip_ranges)),
+    }
+    logging.info(f'Writing manifest of {len(manifest["prefixes"])} prefixes to {manifest_file} ...')
+    with open(manifest_file, 'w') as file:
+        json.dump(manifest, file, indent=1)
+
+def load_matched_nodes_manifest(manifest_file: str) -> dict:
+    with open(manifest_file) as file:
+        manifest = json.load(file)
+    manifest['prefixes'] = set(tuple(e) for e in manifest['prefixes'])
+    return manifest
+
+def refresh_matched_nodes(matched_nodes_file: str, manifest_file: str,
+                          cloud: str, region: str, ip_ranges: list[tuple],
+                          node_file: str = '../data/caida-itdk/midar-iff.nodes') -> set[str]:
+    """Patch the matched nodes file (keyed by node id) in place for the prefixes that changed since the manifest,
+        and return the set of stale regions, i.e. those that gained or lost any matched IP.
+
+        Only the ITDK IPs covered by added or removed (prefix, region) pairs are rematched, a re-regioned prefix being
+        both removed and added. The covered IPs are selected from the sorted IP to node table, so the rest of the
+        ITDK IPs are never matched against the trie.
+    """
+    manifest = load_matched_nodes_manifest(manifest_file)
+    if manifest['cloud'] != cloud or manifest['region'] != region:
+        raise ValueError(f'Manifest {manifest_file} was built for {manifest["cloud"]}:{manifest["region"]}, '
+                         f'not {cloud}:{region}')
+    new_prefixes = set((ip_prefix, prefix_region) for (ip_prefix, _, prefix_region) in ip_ranges)
+    removed_prefixes = manifest['prefixes'] - new_prefixes
+    added_prefixes = new_prefixes - manifest['prefixes']
+    logging.info(f'IP ranges version: {manifest["syncToken"]} ({manifest["createDate"]}) -> '
+                 f'{load_cloud_ip_ranges_version(cloud)}')
+    logging.info(f'Prefixes removed: {len(removed_prefixes)}, added: {len(added_prefixes)}')
+    if not removed_prefixes and not added_prefixes:
+        logging.info('Matched nodes are up to date.')
+        return set()
+
+    with open(matched_nodes_file) as file:
+        d_by_node = ast.literal_eval(file.read())
+
+    # Drop the matches against removed prefixes
+    stale_regions = set()
+    removed_ips = 0
+    removed_prefix_set = set(ip_prefix for (ip_prefix, _) in removed_prefixes)
+    for node_id in list(d_by_node.keys()):
+        matches = []
+        for (ip, prefix, data) in d_by_node[node_id]:
+            is_removed = (prefix, data[1]) in removed_prefixes if data else prefix in removed_prefix_set
+            if is_removed:
+                stale_regions.add(data[1] if data else next(r for (p, r) in removed_prefixes if p == prefix))
+                removed_ips += 1
+            else:
+                matches.append((ip, prefix, data))
+        if matches:
+            d_by_node[node_id] = matches
+        else:
+            del d_by_node[node_id]
+    logging.info(f'Removed {removed_ips} matched IPs.')
+
+    # Match ITDK IPs against the added prefixes only
+    added_ips = 0
+    if added_prefixes:
+        trie = build_trie_from_ip_ranges([(ip_prefix, cloud, prefix_region)
+                                          for (ip_prefix, prefix_region) in added_prefixes])
+        covered_node_ips = get_node_ips_covered_by_prefixes(load_ip_node_table(node_file),
+                                                            (ip_prefix for (ip_prefix, _) in added_prefixes))
+        logging.info(f'Rematching {sum(len(ips) for ips in covered_node_ips.values())} ITDK IPs '
+                     f'of {len(covered_node_ips)} nodes ...')
+        for node_id, matches in get_matching_node_ips(trie, covered_node_ips).items():
+            existing_matches = d_by_node.setdefault(node_id, [])
+            for match in matches:
+                if match in existing_matches:
+                    continue
+                existing_matches.append(match)
+                stale_regions.add(match[2][1])
+                added_ips += 1
+    logging.info(f'Added {added_ips} matched IPs.')
+
+    logging.info(f'Patching {matched_nodes_file} ...')
+    tmp_file = matched_nodes_file + '.tmp'
+    with open(tmp_file, 'w') as file:
+        print(d_by_node, file=file)
+    os.replace(tmp_file, matched_nodes_file)
+    write_matched_nodes_manifest(manifest_file, cloud, region, ip_ranges)
+    return stale_regions
+
+def get_stale_routes_files(routes_dirpath: str, cloud: str, stale_regions: set[str]) -> list[str]:
+    """Return the per-region-pair routes files whose source or destination region is stale."""
+    stale_files = []
+    for filename in sorted(os.listdir(routes_dirpath)):
+        cloud_regions = detect_cloud_regions_from_filename(filename)
+        if cloud_regions is None:
+            continue
+        (src_cloud, src_region, dst_cloud, dst_region) = cloud_regions
+        if (src_cloud == cloud and src_region in stale_regions) or \
+                (dst_cloud == cloud and dst_region in stale_regions):
+            stale_files.append(os.path.join(routes_dirpath, filename))
+    return stale_files
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--cloud', required=True, choices=[ 'aws', 'gcloud' ], help='The cloud provider to use')
     parser.add_argument('-r', '--region', required=False, help='The region to match')
     parser.add_argument('--convert_to_by_region', action='store_true', help='Convert the result to be by region')
     parser.add_argument('--match_cloud_ips_with_itdk', action='store_true', help='Match nodes in the ITDK dataset')
+    parser.add_argument('--refresh_matched_nodes', action='store_true',
+                        help='Rematch only the prefixes that changed since the manifest, and patch the matched nodes file in place')
     parser.add_argument('--matched_nodes_file', help='The matched nodes dictionary file, keyed by node id')
+    parser.add_argument('--manifest_file',
+                        help='The manifest of prefixes the matched nodes file is built from, '
+                             'default to <matched_nodes_file>.manifest.json when refreshing')
+    parser.add_argument('--routes_dirpath', type=DirType,
+                        help='The directory of per-region-pair routes files to report as stale after refreshing')
     args = parser.parse_args()
 
     if args.convert_to_by_region:
@@ -78,6 +214,11 @@ def parse_args():
             parser.error('--convert_to_by_region requires --matched_nodes_file')
     elif args.match_cloud_ips_with_itdk:
         pass
+    elif args.refresh_matched_nodes:
+        if not args.matched_nodes_file:
+            parser.error('--refresh_matched_nodes requires --matched_nodes_file')
+        if not args.manifest_file:
+            args.manifest_file = get_default_manifest_filename(args.matched_nodes_file)
     else:
         parser.error('No action specified')
 
@@ -101,6 +242,18 @@ def main():
         itdk_node_id_to_ips = load_itdk_node_id_to_ips_mapping()
         matching_node_and_ips = get_matching_node_ips(trie, itdk_node_id_to_ips)
         print(matching_node_and_ips)
+        if args.manifest_file:
+            write_matched_nodes_manifest(args.manifest_file, args.cloud, args.region, ip_ranges)
+    elif args.refresh_matched_nodes:
+        stale_regions = refresh_matched_nodes(args.matched_nodes_file, args.manifest_file,
+                                              args.cloud, args.region, ip_ranges)
+        logging.info(f'Stale regions: {sorted(stale_regions)}')
+        if args.routes_dirpath:
+            for stale_file in get_stale_routes_files(args.routes_dirpath, args.cloud, stale_regions):
+                print(stale_file)
+        else:
+            for stale_region in sorted(stale_regions):
+                print(f'{args.cloud}:{stale_region}')
 
 if __name__ == '__main__':
     main()
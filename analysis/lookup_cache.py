@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional
+
+from common import Coordinate, get_routes_from_file, init_logging
+
+# The cache file is shared by all runs, regardless of the working directory, unless overridden by this variable.
+LOOKUP_CACHE_PATH_ENV = 'CIDT_LOOKUP_CACHE'
+DEFAULT_LOOKUP_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'cidt', 'lookup_cache.sqlite3')
+COORDINATE_PRECISION = 6
+SQLITE_MAX_VARIABLES = 500
+
+NAMESPACE_CARBON_REGION = 'carbon_region'
+NAMESPACE_IGDB_PHYSICAL_HOPS = 'igdb_physical_hops'
+
+def get_coordinate_key(coordinate: Coordinate) -> str:
+    """Normalize a (lat, lon) coordinate into a cache key."""
+    (lat, lon) = coordinate
+    return f'{lat:.{COORDINATE_PRECISION}f},{lon:.{COORDINATE_PRECISION}f}'
+
+def get_coordinate_pair_key(src: Coordinate, dst: Coordinate) -> str:
+    return f'{get_coordinate_key(src)}|{get_coordinate_key(dst)}'
+
+class LookupCache:
+    """A persistent key-value cache of lookup results in one SQLite file, indexed by (namespace, key).
+
+        The file is opened in WAL mode so that concurrent processes can read and write it, and hits are memoized
+        in-process so that repeated lookups don't touch the database.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.environ.get(LOOKUP_CACHE_PATH_ENV, DEFAULT_LOOKUP_CACHE_PATH)
+        self.pid = os.getpid()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.memo: dict[tuple[str, str], str] = {}
+        self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS entries (
+                                        namespace TEXT NOT NULL,
+                                        key TEXT NOT NULL,
+                                        value TEXT NOT NULL,
+                                        updated_at REAL NOT NULL,
+                                        PRIMARY KEY (namespace, key)
+                                    ) WITHOUT ROWID''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS entries_updated_at ON entries (updated_at)')
+
+    def get_many(self, namespace: str, keys: Iterable[str]) -> dict[str, str]:
+        """Return the cached values of the given keys, skipping the missing ones."""
+        results: dict[str, str] = {}
+        missing_keys = []
+        for key in keys:
+            value = self.memo.get((namespace, key))
+            if value is not None:
+                results[key] = value
+            else:
+                missing_keys.append(key)
+        with self.lock:
+            for i in range(0, len(missing_keys), SQLITE_MAX_VARIABLES):
+                batch = missing_keys[i:i + SQLITE_MAX_VARIABLES]
+                rows = self.connection.execute(
+                    f'SELECT key, value FROM entries WHERE namespace = ? AND key IN ({",".join("?" * len(batch))})',
+                    [namespace] + batch).fetchall()
+                for (key, value) in rows:
+                    results[key] = value
+                    self.memo[(namespace, key)] = value
+        return results
+
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        return self.get_many(namespace, [key]).get(key)
+
+    def put_many(self, namespace: str, items: dict[str, str]) -> None:
+        if not items:
+            return
+        updated_at = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                                        [(namespace, key, value, updated_at) for key, value in items.items()])
+        for key, value in items.items():
+            self.memo[(namespace, key)] = value
+
+    def put(self, namespace: str, key: str, value: str) -> None:
+        self.put_many(namespace, { key: value })
+
+    def count(self, namespace: Optional[str] = None) -> int:
+        with self.lock:
+            if namespace:
+                return self.connection.execute('SELECT COUNT(*) FROM entries WHERE namespace = ?',
+                                               [namespace]).fetchone()[0]
+            return self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def evict(self, max_entries: int) -> int:
+        """Evict the least recently updated entries to keep at most max_entries, and return the number evicted."""
+        with self.lock, self.connection:
+            cursor = self.connection.execute('''DELETE FROM entries WHERE (namespace, key) IN (
+                                                    SELECT namespace, key FROM entries ORDER BY updated_at DESC
+                                                    LIMIT -1 OFFSET ?)''', [max_entries])
+            evicted_count = cursor.rowcount
+        self.memo.clear()
+        return evicted_count
+
+lookup_cache: Optional[LookupCache] = None
+
+def get_lookup_cache() -> LookupCache:
+    """Return the process-wide lookup cache, opened on first use, and reopened in forked child processes as SQLite
+        connections cannot be shared across a fork."""
+    global lookup_cache
+    if lookup_cache is None or lookup_cache.pid != os.getpid():
+        lookup_cache = LookupCache()
+    return lookup_cache
+
+def warm_up_carbon_regions_from_routes(cache: LookupCache, by_geo_files: list[str], by_iso_dirpath: str) -> int:
+    """Populate the coordinate -> ISO entries from existing pairs of .by_geo and .by_iso route files, where the routes
+        on the same line correspond to each other. Pairs filtered to different routes are skipped."""
+    total_count = 0
+    for by_geo_file in by_geo_files:
+        by_iso_file = os.path.join(by_iso_dirpath,
+                                   os.path.basename(by_geo_file).removesuffix('.by_geo') + '.by_iso')
+        if not os.path.exists(by_iso_file):
+            logging.warning(f'Skipping {by_geo_file} without {by_iso_file}')
+            continue
+        geo_routes = get_routes_from_file(by_geo_file)
+        iso_routes = get_routes_from_file(by_iso_file)
+        if len(geo_routes) != len(iso_routes) or \
+                any(len(geo_route) != len(iso_route) for geo_route, iso_route in zip(geo_routes, iso_routes)):
+            logging.warning(f'Skipping {by_geo_file}, as its routes do not match those in {by_iso_file}')
+            continue
+        items = {}
+        for geo_route, iso_route in zip(geo_routes, iso_routes):
+            for coordinate, iso in zip(geo_route, iso_route):
+                if iso != 'Unknown':
+                    items[get_coordinate_key(coordinate)] = iso
+        cache.put_many(NAMESPACE_CARBON_REGION, items)
+        total_count += len(items)
+    return total_count
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache-path', required=False,
+                        help=f'The cache file, default to ${LOOKUP_CACHE_PATH_ENV} or {DEFAULT_LOOKUP_CACHE_PATH}')
+    parser.add_argument('--warm-up-from-routes', action='store_true',
+                        help='Populate the coordinate to ISO entries from existing .by_geo and .by_iso files.')
+    parser.add_argument('--by-geo-files', nargs='+', help='The .by_geo files to warm up from.')
+    parser.add_argument('--by-iso-dirpath', help='The directory of the corresponding .by_iso files.')
+    parser.add_argument('--evict', action='store_true', help='Evict the least recently updated entries.')
+    parser.add_argument('--max-entries', type=int, help='The max number of entries to keep when evicting.')
+    parser.add_argument('--stats', action='store_true', help='Print the number of entries in each namespace.')
+    args = parser.parse_args()
+
+    if args.warm_up_from_routes and not (args.by_geo_files and args.by_iso_dirpath):
+        parser.error('--warm-up-from-routes requires --by-geo-files and --by-iso-dirpath')
+    if args.evict and args.max_entries is None:
+        parser.error('--evict requires --max-entries')
+    if not (args.warm_up_from_routes or args.evict or args.stats):
+        parser.error('No action specified')
+
+    return args
+
+def main():
+    init_logging(level=logging.INFO)
+    args = parse_args()
+    cache = LookupCache(args.cache_path)
+    logging.info(f'Using lookup cache {cache.path}')
+    if args.warm_up_from_routes:
+        count = warm_up_carbon_regions_from_routes(cache, args.by_geo_files, args.by_iso_dirpath)
+        logging.info(f'Stored {count} coordinate to ISO entries')
+    if args.evict:
+        count = cache.evict(args.max_entries)
+        logging.info(f'Evicted {count} entries')
+    if args.stats:
+        for namespace in [NAMESPACE_CARBON_REGION, NAMESPACE_IGDB_PHYSICAL_HOPS]:
+            print(f'{namespace}: {cache.count(namespace)} entries')
+
+if __name__ == '__main__':
+    main()
@@ -2,18 +2,25 @@
 
 import argparse
 import ast
+import json
 import logging
+import multiprocessing
 import os
 import re
 from matplotlib.colors import LinearSegmentedColormap, Normalize
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from typing import Any, Callable, Optional
+from typing import Any, Optional
 
-from common import DirType, RouteMetric, calculate_route_metric, init_logging
+from artifact_dag import FileHasher
+from common import DirType, RouteMetric, init_logging
+from route_distance import DistanceModel, calculate_route_metrics
 
 DATA_SOURCE = 'caida.itdk'
+# The per-file weighted averages are cached in this file in --dirpath by default, see get_weighted_averages_by_region_pair().
+AGGREGATE_CACHE_FILENAME = '.plot.routes.all_region_pairs.cache.json'
+AGGREGATE_CACHE_VERSION = 1
 
 
 def load_weighted_hops(file_path: str) -> pd.DataFrame:
@@ -23,7 +30,17 @@ def load_weighted_hops(file_path: str) -> pd.DataFrame:
         4 hop1|hop2|hop3
         1 hop1|hop2
         ...
+
+        or the TSV distributions of distribution.routes.py and conversion_pipeline.py, i.e. the count, the optional
+        metric columns and the route, with or without a header.
     """
+    with open(file_path, 'r') as file:
+        first_line = file.readline()
+    if '\t' in first_line:
+        has_header = not first_line.split('\t', 1)[0].strip().isdigit()
+        df = pd.read_csv(file_path, sep='\t', header=0 if has_header else None)
+        return pd.DataFrame.from_dict({'weight': df.iloc[:, 0].astype(float), 'hops': df.iloc[:, -1].astype(str)})
+
     with open(file_path, 'r') as file:
         lines = file.readlines()
 
@@ -73,6 +90,7 @@ def plot_pdf(values, weights, src_region: str, dst_region: str, metric: str, dat
     filename = f'{metric}.pdf.{data_source}.{src_region}.{dst_region}.png'
     logging.info(f'Saving heatmap to {filename} ...')
     plt.savefig(filename, bbox_inches='tight')
+    plt.close()
 
 def plot_heatmap(src_regions: list[str], dst_regions: list[str], region_hop_counts: dict[tuple[str, str], float],
                  metric: str, data_source: str):
@@ -102,46 +120,135 @@ def plot_heatmap(src_regions: list[str], dst_regions: list[str], region_hop_coun
     logging.info(f'Saving heatmap to {filename} ...')
     plt.savefig(filename, bbox_inches='tight')
 
-def get_weighted_average_by_region_pair(dirpath: str, process_hops: Callable[[list[str]], Any],
-                                        metric: str, plot_pdfs: bool,
-                                        src_cloud: Optional[str], src_region: Optional[str],
-                                        dst_cloud: Optional[str], dst_region: Optional[str]):
-    # Dictionary to hold the source-destination pairs and the aggregated value
-    weighted_average_by_region_pair = {}
-
-    # Corrected processing of each file
-    for file in os.listdir(dirpath):
+def get_metric_cache_key(metric: RouteMetric, distance_model: DistanceModel) -> str:
+    return f'{metric}.{distance_model}' if metric == RouteMetric.DistanceKM else str(metric)
+
+def get_region_pair_aggregates(task: tuple[str, list[RouteMetric], DistanceModel, bool]) -> \
+        tuple[dict[str, float], dict[RouteMetric, tuple[np.ndarray, np.ndarray]]]:
+    """Read a distribution file once, and return the weighted average of each metric by its cache key, along with the
+        values and weights of each metric to plot its PDF if requested."""
+    (file_path, metrics, distance_model, with_values) = task
+    logging.info('Processing file: %s', file_path)
+    hops, weights = get_hops_and_weights(file_path)
+    routes = hops.tolist()
+
+    averages = {}
+    values_and_weights = {}
+    for metric in metrics:
+        values = calculate_route_metrics(routes, metric, distance_model)
+        # Skip bad values, i.e. ignore the distance if it is 0
+        metric_weights = np.where(values == 0., 0., weights)
+        if metric_weights.sum() > 0:
+            averages[get_metric_cache_key(metric, distance_model)] = np.average(values, weights=metric_weights).tolist()
+        else:
+            logging.warning(f'No valid {metric} in {file_path}')
+            averages[get_metric_cache_key(metric, distance_model)] = None
+        if with_values:
+            values_and_weights[metric] = (values, metric_weights)
+    return averages, values_and_weights
+
+def read_aggregate_cache(cache_file: str) -> dict[str, dict]:
+    try:
+        with open(cache_file) as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return cache['files'] if cache.get('version') == AGGREGATE_CACHE_VERSION else {}
+
+def write_aggregate_cache(cache_file: str, entries: dict[str, dict]) -> None:
+    tmp_file = f'{cache_file}.tmp.{os.getpid()}'
+    with open(tmp_file, 'w') as file:
+        json.dump({ 'version': AGGREGATE_CACHE_VERSION, 'files': entries }, file, indent=1)
+    os.replace(tmp_file, cache_file)
+
+def get_weighted_averages_by_region_pair(dirpath: str, metrics: list[RouteMetric], distance_model: DistanceModel,
+                                         plot_pdfs: bool,
+                                         src_cloud: Optional[str], src_region: Optional[str],
+                                         dst_cloud: Optional[str], dst_region: Optional[str],
+                                         jobs: int = 1, cache_file: Optional[str] = None) -> \
+                                            dict[RouteMetric, dict[tuple[str, str], float]]:
+    """Compute the weighted average of all metrics for each region pair in one pass over the distribution files, on
+        `jobs` processes, and plot the PDFs of each region pair if requested.
+
+        The averages of each file are cached in cache_file if specified, along with its size, mtime and hash, so that
+        only new or modified files are read again, unless the PDFs need the values of each route.
+    """
+    entries = read_aggregate_cache(cache_file) if cache_file else {}
+    hasher = FileHasher()
+    hasher.add_known({ os.path.join(dirpath, file): entry['fingerprint'] for file, entry in entries.items() })
+    keys = [get_metric_cache_key(metric, distance_model) for metric in metrics]
+
+    # Source-destination pairs of each file, and the files to process
+    region_pair_by_file = {}
+    tasks = []
+    is_cache_modified = False
+    for file in sorted(os.listdir(dirpath)):
+        # Skip hidden files, e.g. the cache itself
+        if file.startswith('.'):
+            continue
         file_path = os.path.join(dirpath, file)
         src, dst = extract_cloud_regions_from_filename(file)
 
         if (src_cloud and src_cloud != src[0]) or (src_region and src_region != src[1]) or \
               (dst_cloud and dst_cloud != dst[0]) or (dst_region and dst_region != dst[1]):
             continue
-
-        logging.info('Processing file: %s', file_path)
-
-        # Calculate the weighted hop count for the file
-        hops, weights = get_hops_and_weights(file_path)
-        values = np.array(list(map(process_hops, hops)))
-
-        # Skip bad values
-        for i in range(values.size):
-            # Ignore the distance if it is 0
-            if values[i] == 0.:
-                weights[i] = 0.
-
-        src = ':'.join(src)
-        dst = ':'.join(dst)
-        weighted_average_by_region_pair[(src, dst)] = np.average(values, weights=weights).tolist()
-
-        if plot_pdfs:
-            plot_pdf(values, weights, src, dst, metric, DATA_SOURCE)
-    return weighted_average_by_region_pair
+        region_pair_by_file[file] = (':'.join(src), ':'.join(dst))
+
+        entry = entries.get(file)
+        fingerprint = hasher.get_fingerprint(file_path) if entry is not None else None
+        if plot_pdfs or fingerprint is None or fingerprint['sha256'] != entry['fingerprint']['sha256'] or \
+                any(key not in entry['averages'] for key in keys):
+            tasks.append((file_path, metrics, distance_model, plot_pdfs))
+        elif fingerprint is not entry['fingerprint']:
+            # Touched without changes
+            entry['fingerprint'] = fingerprint
+            is_cache_modified = True
+    logging.info(f'Processing {len(tasks)} out of {len(region_pair_by_file)} files, the rest are cached')
+
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.get_context('fork').Pool(jobs)
+        results = pool.imap(get_region_pair_aggregates, tasks)
+    else:
+        pool = None
+        results = map(get_region_pair_aggregates, tasks)
+    try:
+        for task, (averages, values_and_weights) in zip(tasks, results):
+            file_path = task[0]
+            file = os.path.basename(file_path)
+            entry = entries.get(file)
+            if entry is None or entry['fingerprint']['sha256'] != hasher.get_fingerprint(file_path)['sha256']:
+                entry = entries[file] = { 'averages': {} }
+            entry['fingerprint'] = hasher.get_fingerprint(file_path)
+            entry['averages'].update(averages)
+            is_cache_modified = True
+            # The PDFs are plotted in this process, as matplotlib is not fork-safe.
+            (src, dst) = region_pair_by_file[file]
+            for metric, (values, weights) in values_and_weights.items():
+                plot_pdf(values, weights, src, dst, metric, DATA_SOURCE)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if cache_file and is_cache_modified:
+        # Drop the files that no longer exist
+        existing_files = set(os.listdir(dirpath))
+        write_aggregate_cache(cache_file, { file: entry for file, entry in entries.items() if file in existing_files })
+
+    # Dictionary to hold the source-destination pairs and the aggregated value of each metric
+    weighted_averages_by_region_pair = {}
+    for metric, key in zip(metrics, keys):
+        weighted_averages_by_region_pair[metric] = {
+            region_pair: entries[file]['averages'][key] for file, region_pair in region_pair_by_file.items()
+            if entries[file]['averages'][key] is not None }
+    return weighted_averages_by_region_pair
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--metrics', required=True, nargs='+', type=RouteMetric, choices=list(RouteMetric),
                         help='The metrics to plot')
+    parser.add_argument('--distance-model', type=DistanceModel, choices=list(DistanceModel),
+                        default=DistanceModel.Geodesic, help='The model to calculate the distance_km metric.')
     parser.add_argument('--dirpath', type=DirType, required=True, help='The directory that contains the routes files')
     parser.add_argument('--plot-heatmap', action='store_true',
                         help='Plot the heatmap of the metric across all region pairs')
@@ -151,8 +258,17 @@ def parse_args():
     parser.add_argument('--dst-cloud', required=False, help='The destination cloud to filter on')
     parser.add_argument('--src-region', required=False, help='The source region to filter on')
     parser.add_argument('--dst-region', required=False, help='The destination region to filter on')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of processes to read the distribution files in parallel')
+    parser.add_argument('--cache-file', required=False,
+                        help=f'The file to cache the weighted averages of each distribution file in, '
+                             f'default to {AGGREGATE_CACHE_FILENAME} in --dirpath')
+    parser.add_argument('--no-cache', action='store_true', help='Read all distribution files without the cache')
     args = parser.parse_args()
 
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
     if not (args.plot_heatmap or args.plot_pdfs):
         parser.error('At least one of --plot-heatmap or --plot-pdfs must be specified')
 
@@ -168,11 +284,15 @@ def main():
     init_logging(level=logging.INFO)
     args = parse_args()
 
+    cache_file = None if args.no_cache else \
+        args.cache_file or os.path.join(args.dirpath, AGGREGATE_CACHE_FILENAME)
+    value_by_region_pair_by_metric = get_weighted_averages_by_region_pair(args.dirpath, args.metrics,
+                                                                          args.distance_model, args.plot_pdfs,
+                                                                          args.src_cloud, args.src_region,
+                                                                          args.dst_cloud, args.dst_region,
+                                                                          args.jobs, cache_file)
     for metric in args.metrics:
-        process_hops = lambda x: calculate_route_metric(x, metric)
-        value_by_region_pair = get_weighted_average_by_region_pair(args.dirpath, process_hops, metric, args.plot_pdfs,
-                                                                   args.src_cloud, args.src_region,
-                                                                   args.dst_cloud, args.dst_region)
+        value_by_region_pair = value_by_region_pair_by_metric[metric]
         src_dst_pairs = value_by_region_pair.keys()
         src_regions = sorted(set(t[0] for t in src_dst_pairs))
         dst_regions = sorted(set(t[1] for t in src_dst_pairs))
@@ -5,9 +5,14 @@ import collections
 from datetime import datetime
 import matplotlib.pyplot as plt
 import matplotlib.markers as markers
+import numpy as np
+from matplotlib.collections import LineCollection
 from mpl_toolkits.basemap import Basemap
 
-from common import get_routes_from_file
+from cidt import calculate_cidt_timeseries, load_carbon_intensities
+from common import WeightedRoute, get_routes_from_file, iter_weighted_routes_from_file
+from route_distance import flatten_coordinate_routes
+from route_format import get_weighted_routes
 
 def plot_route_hop_count_distribution(routes: list[list], filename):
     num_entries_per_line = [len(route) for route in routes]
@@ -30,22 +35,32 @@ def assert_route_is_in_latlon_format(routes):
         for entry in route:
             assert len(entry) == 2, f'Entry {entry} is not in lat/lon format'
 
-def plot_routes_on_worldmap(routes: list[list[tuple[float, float]]], filename):
-    # Each route is a list of (lat, lon) coordinates that will be connected hop-by-hop
+def get_route_linewidths(counts: np.ndarray) -> np.ndarray:
+    """Scale the line width of each unique route by its count, where routes seen once keep the base width."""
+    return 0.5 * (1 + np.log2(counts))
+
+def plot_routes_on_worldmap(weighted_routes: list[WeightedRoute], filename):
+    # Each route is a list of (lat, lon) coordinates that will be connected hop-by-hop, drawn once per unique route
+    # with its count as the line width, so that identical routes don't add more artists.
     # Create a Basemap object
     map = Basemap(projection='mill', llcrnrlat=-90, urcrnrlat=90, llcrnrlon=-180, urcrnrlon=180, resolution='c')
 
     # Create a figure and axis for the map
     fig, ax = plt.subplots(figsize=(20, 10))
 
+    # Project the hops of all routes at once
+    weighted_routes = [(route, count) for (route, count) in weighted_routes if route]
+    (offsets, lats, lons) = flatten_coordinate_routes(route for (route, _) in weighted_routes)
+    counts = np.array([count for (_, count) in weighted_routes], dtype=np.float64)
+    x, y = map(lons, lats)
+    points = np.column_stack((x, y))
+
     # Plot the routes
-    for line in routes:
-        lats, lons = zip(*line)
-        x, y = map(lons, lats)
-        # ax.plot(x, y, marker='o')
-        ax.plot(x, y, color='gray', linewidth=0.5)
-        ax.scatter(x[:1], y[:1], marker=markers.MarkerStyle('o'), color='red')
-        ax.scatter(x[-1:], y[-1:], marker=markers.MarkerStyle('o'), color='green')
+    segments = np.split(points, offsets[1:-1])
+    ax.add_collection(LineCollection(segments, colors='gray', linewidths=get_route_linewidths(counts)))
+    (starts, ends) = (np.unique(points[offsets[:-1]], axis=0), np.unique(points[offsets[1:] - 1], axis=0))
+    ax.scatter(starts[:, 0], starts[:, 1], marker=markers.MarkerStyle('o'), color='red')
+    ax.scatter(ends[:, 0], ends[:, 1], marker=markers.MarkerStyle('o'), color='green')
 
     # # Set labels for the start and end points
     # for i, line in enumerate(routes):
@@ -84,39 +99,55 @@ def parse_args():
     parser.add_argument('--plot_hop_count_cdf', action='store_true')
     parser.add_argument('--plot_routes_on_map', action='store_true')
     parser.add_argument('--group_by', choices=['hopcount', 'hops'], help='Rank the routes by hop count or actual hops')
-    parser.add_argument('--plot_carbon_timeseries', type=datetime.fromisoformat)
+    parser.add_argument('--plot_carbon_timeseries', action='store_true',
+                        help='Plot the CIDT of the routes over time, where the routes file must be in ISOs')
+    parser.add_argument('--carbon_intensity_csv', type=str,
+                        help='The CSV file of carbon intensities, with timestamp, iso and carbon_intensity columns')
     parser.add_argument('--start_time', type=datetime.fromisoformat)
     parser.add_argument('--end_time', type=datetime.fromisoformat)
     args = parser.parse_args()
 
     if args.plot_carbon_timeseries and not (args.start_time and args.end_time):
         parser.error('--start_time and --end_time must be specified when --plot_carbon_timeseries is specified')
+    if args.plot_carbon_timeseries and not args.carbon_intensity_csv:
+        parser.error('--carbon_intensity_csv must be specified when --plot_carbon_timeseries is specified')
 
     return args
 
-def plot_carbon_timeseries(routes: list[list[tuple]], start_time: datetime, end_time: datetime):
-    # TODO: Aggregate the routes
-    raise NotImplementedError()
-    # Fetch carbon intensity for the time range and locations on each route
-    # Calculate carbon intensity of data transfer for each route
-    # Weight average the CIDT across all routes
+def plot_carbon_timeseries(weighted_routes: list[WeightedRoute], carbon_intensity_csv: str,
+                           start_time: datetime, end_time: datetime, filename):
+    # Fetch carbon intensity for the time range and the ISOs on each route
+    intensities = load_carbon_intensities(carbon_intensity_csv, start_time, end_time)
+    # Calculate carbon intensity of data transfer for each route, and weight average the CIDT across all routes
+    cidts = calculate_cidt_timeseries(weighted_routes, intensities)
+
     # Plot the weighted average CIDT over time
+    fig, ax = plt.subplots(figsize=(20, 5))
+    ax.plot(cidts.index, cidts.to_numpy(), linewidth=0.8)
+    ax.set_xlabel('Time')
+    ax.set_ylabel('CIDT (gCO2eq/kWh)')
+    ax.set_title(f'Weighted average CIDT of {sum(count for (_, count) in weighted_routes)} routes')
+    ax.grid(True)
+    plt.savefig(f'{filename}.carbon_timeseries.png', bbox_inches='tight')
 
 def main():
     args = parse_args()
-    routes = get_routes_from_file(args.routes_file)
     file_basename = args.routes_file.removesuffix('.by_ip')
+    # The map and the CIDT timeseries only keep the unique routes in memory
     if args.plot_hop_count_cdf:
-        plot_route_hop_count_distribution(routes, file_basename)
+        plot_route_hop_count_distribution(get_routes_from_file(args.routes_file), file_basename)
     elif args.plot_routes_on_map:
-        assert_route_is_in_latlon_format(routes)
-        plot_routes_on_worldmap(routes, file_basename)
+        weighted_routes = get_weighted_routes(iter_weighted_routes_from_file(args.routes_file))
+        assert_route_is_in_latlon_format(route for (route, _) in weighted_routes)
+        plot_routes_on_worldmap(weighted_routes, file_basename)
     elif args.group_by:
-        route_groups = group_routes_by(routes, args.group_by)
+        route_groups = group_routes_by(get_routes_from_file(args.routes_file), args.group_by)
         for count, route in route_groups:
             print(f'{count} occurences: {route}')
     elif args.plot_carbon_timeseries:
-        plot_carbon_timeseries(routes, args.start_time, args.end_time)
+        weighted_routes = get_weighted_routes(iter_weighted_routes_from_file(args.routes_file))
+        plot_carbon_timeseries(weighted_routes, args.carbon_intensity_csv, args.start_time, args.end_time,
+                               file_basename)
     else:
         raise ValueError('No action specified')
 
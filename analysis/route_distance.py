@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import ast
+import logging
+from enum import Enum
+from typing import Iterable
+
+import numpy as np
+from geographiclib.geodesic import Geodesic
+from geopy.distance import ELLIPSOIDS, geodesic
+
+from common import Coordinate, RouteInCoordinate, RouteMetric
+
+EARTH_RADIUS_KM = 6371.0088
+# WGS-84, the default ellipsoid of geopy.distance.geodesic.
+(WGS84_A_KM, _, WGS84_F) = ELLIPSOIDS['WGS-84']
+WGS84_B_KM = WGS84_A_KM * (1 - WGS84_F)
+VINCENTY_MAX_ITERATIONS = 200
+VINCENTY_TOLERANCE = 1e-12
+# The same solver as geopy.distance.geodesic uses, in km, called directly to skip its per-call Point parsing.
+GEODESIC_SOLVER = Geodesic(ELLIPSOIDS['WGS-84'][0], ELLIPSOIDS['WGS-84'][2])
+
+class DistanceModel(str, Enum):
+    """The model to compute the distance between two coordinates.
+
+        - geodesic: the exact ellipsoidal distance of geopy.distance.geodesic (Karney), memoized by segment.
+        - vincenty: the ellipsoidal distance by Vincenty's formulae, vectorized, within a millimeter of geodesic.
+        - haversine: the great-circle distance on a sphere of the mean Earth radius, vectorized, within 0.6%.
+    """
+    Geodesic = 'geodesic'
+    Vincenty = 'vincenty'
+    Haversine = 'haversine'
+
+    def __str__(self) -> str:
+        return self.value
+
+# Process-wide memo of the exact geodesic segment distances, keyed by the (lat1, lon1, lat2, lon2) of each segment.
+geodesic_distance_memo: dict[tuple[float, float, float, float], float] = {}
+
+def parse_coordinate(hop: str) -> Coordinate:
+    """Parse a hop printed as a "(lat, lon)" tuple, without the overhead of ast.literal_eval() in the common case."""
+    try:
+        (lat, lon) = hop.strip().removeprefix('(').removesuffix(')').split(',')
+        return (float(lat), float(lon))
+    except ValueError:
+        return tuple(ast.literal_eval(hop))
+
+def parse_coordinate_route(route: str) -> RouteInCoordinate:
+    """Parse a route of "|"-joined "(lat, lon)" hops, as exported by distribution.routes.py."""
+    return [parse_coordinate(hop) for hop in route.split('|')]
+
+def flatten_coordinate_routes(routes: Iterable[RouteInCoordinate]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Flatten routes into (offsets, lat, lon) arrays, where the hops of route i are at [offsets[i]:offsets[i + 1]]."""
+    lengths = []
+    coordinates: list[Coordinate] = []
+    for route in routes:
+        lengths.append(len(route))
+        coordinates.extend(route)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    (lat, lon) = np.array(coordinates, dtype=np.float64).reshape(-1, 2).T
+    return offsets, lat, lon
+
+def get_haversine_distances_km(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    (lat1, lon1, lat2, lon2) = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def get_vincenty_distances_km(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    """Vectorized Vincenty's inverse formula on WGS-84. Nearly antipodal segments where the iteration does not
+        converge fall back to the exact geodesic distance."""
+    (lat1, lon1, lat2, lon2) = (np.asarray(e, dtype=np.float64) for e in (lat1, lon1, lat2, lon2))
+    u1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat1)))
+    u2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat2)))
+    l = np.radians(lon2 - lon1)
+    (sin_u1, cos_u1, sin_u2, cos_u2) = (np.sin(u1), np.cos(u1), np.sin(u2), np.cos(u2))
+
+    lam = l.copy()
+    converged = np.zeros(l.shape, dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(VINCENTY_MAX_ITERATIONS):
+            (sin_lam, cos_lam) = (np.sin(lam), np.cos(lam))
+            sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0., cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            # Equatorial lines have cos_sq_alpha = 0
+            cos_2sigma_m = np.where(cos_sq_alpha == 0, 0., cos_sigma - 2 * sin_u1 * sin_u2 / cos_sq_alpha)
+            c = WGS84_F / 16 * cos_sq_alpha * (4 + WGS84_F * (4 - 3 * cos_sq_alpha))
+            prev_lam = lam
+            lam = l + (1 - c) * WGS84_F * sin_alpha * \
+                (sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam - prev_lam) <= VINCENTY_TOLERANCE
+            if converged.all():
+                break
+
+        u_sq = cos_sq_alpha * (WGS84_A_KM ** 2 - WGS84_B_KM ** 2) / WGS84_B_KM ** 2
+        a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = b * sin_sigma * (cos_2sigma_m + b / 4 * (cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+            b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        distances = WGS84_B_KM * a * (sigma - delta_sigma)
+
+    distances = np.where(sin_sigma == 0, 0., distances)
+    for i in np.flatnonzero(~converged | ~np.isfinite(distances)):
+        distances[i] = geodesic((lat1[i], lon1[i]), (lat2[i], lon2[i])).km
+    return distances
+
+def get_geodesic_distances_km(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    """Exact geodesic distances as computed by geopy, memoized by segment across calls."""
+    segments = list(zip(lat1.tolist(), lon1.tolist(), lat2.tolist(), lon2.tolist()))
+    distances = np.empty(len(segments), dtype=np.float64)
+    for i, segment in enumerate(segments):
+        distance = geodesic_distance_memo.get(segment)
+        if distance is None:
+            distance = GEODESIC_SOLVER.Inverse(*segment, Geodesic.DISTANCE)['s12']
+            geodesic_distance_memo[segment] = distance
+        distances[i] = distance
+    return distances
+
+def get_segment_distances_km(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray,
+                             model: DistanceModel = DistanceModel.Geodesic) -> np.ndarray:
+    match model:
+        case DistanceModel.Geodesic:
+            return get_geodesic_distances_km(lat1, lon1, lat2, lon2)
+        case DistanceModel.Vincenty:
+            return get_vincenty_distances_km(lat1, lon1, lat2, lon2)
+        case DistanceModel.Haversine:
+            return get_haversine_distances_km(lat1, lon1, lat2, lon2)
+        case _:
+            raise ValueError(f'Unknown distance model {model}')
+
+def calculate_total_distances_km(routes: Iterable[RouteInCoordinate],
+                                 model: DistanceModel = DistanceModel.Geodesic) -> np.ndarray:
+    """Calculate the total distance of each route at once, by summing the distances between consecutive hops."""
+    (offsets, lat, lon) = flatten_coordinate_routes(routes)
+    return calculate_flattened_total_distances_km(offsets, lat, lon, model)
+
+def calculate_flattened_total_distances_km(offsets: np.ndarray, lat: np.ndarray, lon: np.ndarray,
+                                           model: DistanceModel = DistanceModel.Geodesic) -> np.ndarray:
+    """Same as calculate_total_distances_km(), over routes already flattened into (offsets, lat, lon) arrays."""
+    totals = np.zeros(len(offsets) - 1, dtype=np.float64)
+    has_segments = (offsets[1:] - offsets[:-1]) >= 2
+    if not has_segments.any():
+        return totals
+    # Segment i goes from hop i to hop i + 1, except for the ones across adjacent routes, which are left as zeros.
+    is_segment = np.ones(lat.size - 1, dtype=bool)
+    cross_segments = offsets[1:-1] - 1
+    is_segment[cross_segments[(cross_segments >= 0) & (cross_segments < is_segment.size)]] = False
+    segment_starts = np.flatnonzero(is_segment)
+    segment_distances = np.zeros(lat.size - 1, dtype=np.float64)
+    segment_distances[segment_starts] = get_segment_distances_km(lat[segment_starts], lon[segment_starts],
+                                                                 lat[segment_starts + 1], lon[segment_starts + 1],
+                                                                 model)
+    # Sum up the segments starting from the hops of each route, where the ones in between are all zeros.
+    totals[has_segments] = np.add.reduceat(segment_distances, offsets[:-1][has_segments])
+    return totals
+
+def calculate_route_metrics(routes: list[str], metric: RouteMetric,
+                            distance_model: DistanceModel = DistanceModel.Geodesic) -> np.ndarray:
+    """Calculate the metric of each route of "|"-joined hops at once."""
+    match metric:
+        case RouteMetric.HopCount:
+            return np.array([route.count('|') + 1 for route in routes], dtype=np.int64)
+        case RouteMetric.DistanceKM:
+            logging.debug(f'Calculating the {distance_model} distances of {len(routes)} routes ...')
+            distances = calculate_total_distances_km(map(parse_coordinate_route, routes), distance_model)
+            return np.round(distances, 2)
+        case _:
+            raise ValueError(f'Unknown metric {metric}')
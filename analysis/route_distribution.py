@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import io
+import logging
+import sys
+from typing import Any, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+from common import RouteMetric, WeightedRoute, iter_chunks, iter_weighted_routes_from_file
+from itdk_geo_table import FlattenedRoutes
+from route_distance import DistanceModel, calculate_flattened_total_distances_km
+from route_format import is_binary_routes_file, read_routes
+
+def remove_duplicate_consecutive_hops(route: list[Any]):
+    # Keep at least 2 hops, aka source and destination.
+    route[:] = [hop for i, hop in enumerate(route) if i == 0 or hop != route[i - 1]]
+    if len(route) == 1:
+        route.append(route[0])
+
+def remove_duplicate_consecutive_hop_codes(routes: FlattenedRoutes) -> FlattenedRoutes:
+    """Vectorized remove_duplicate_consecutive_hops() over flattened routes, by comparing each hop with the previous
+        one, where the single hop left of a route is repeated as both source and destination."""
+    lengths = np.diff(routes.offsets)
+    is_kept = np.ones(len(routes.hops), dtype=bool)
+    is_kept[1:] = routes.hops[1:] != routes.hops[:-1]
+    is_kept[routes.offsets[:-1][lengths > 0]] = True
+    kept_counts = np.zeros(len(routes.hops) + 1, dtype=np.int64)
+    np.cumsum(is_kept, out=kept_counts[1:])
+    offsets = kept_counts[routes.offsets]
+    hops = routes.hops[is_kept]
+
+    lengths = np.diff(offsets)
+    is_single_hop = lengths == 1
+    if is_single_hop.any():
+        repeats = np.ones(len(hops), dtype=np.int64)
+        repeats[offsets[:-1][is_single_hop]] = 2
+        hops = np.repeat(hops, repeats)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths + is_single_hop, out=offsets[1:])
+    return FlattenedRoutes(offsets=offsets, hops=hops)
+
+def get_unique_hops(hops: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the unique hops, and the index of each hop in them, where (lat, lon) pairs are compared by their bits."""
+    if hops.ndim == 1:
+        (unique_hops, inverse) = np.unique(hops, return_inverse=True)
+        return (unique_hops, inverse.reshape(-1))
+    # Sorting the rows by two integer keys is much faster than np.unique(axis=0) over the rows as opaque bytes.
+    bits = np.ascontiguousarray(hops).view(f'u{hops.dtype.itemsize}').reshape(-1, 2)
+    order = np.lexsort((bits[:, 1], bits[:, 0]))
+    sorted_bits = bits[order]
+    is_first = np.ones(len(hops), dtype=bool)
+    is_first[1:] = (sorted_bits[1:] != sorted_bits[:-1]).any(axis=1)
+    inverse = np.empty(len(hops), dtype=np.int64)
+    inverse[order] = np.cumsum(is_first) - 1
+    return (hops[order[is_first]], inverse)
+
+class HopDictionary:
+    """Encode hops, e.g. IPs, (lat, lon) coordinates or ISOs, as dense integer codes in the order they first appear."""
+    def __init__(self):
+        self.codes: dict[Any, int] = {}
+
+    def encode(self, hops: Iterable[Any]) -> np.ndarray:
+        codes = self.codes
+        def encode_hop(hop: Any) -> int:
+            code = codes.get(hop)
+            if code is None:
+                code = codes[hop] = len(codes)
+            return code
+        return np.fromiter(map(encode_hop, hops), dtype=np.int64)
+
+    def get_hops(self) -> list[Any]:
+        return list(self.codes)
+
+class RouteDistribution:
+    """Incrementally count the unique routes of a stream, and export them as rows of count, metrics and "|"-joined
+        route, from the most frequent.
+
+        Routes are kept as flattened arrays of hop codes, so that duplicate consecutive hops are removed with one
+        shifted compare, unique routes are grouped by hashing the bytes of their codes, and the metrics are computed
+        for all unique routes at once. Only the unique routes are kept in memory.
+    """
+    def __init__(self, remove_duplicate_hops: bool = False):
+        self.remove_duplicate_hops = remove_duplicate_hops
+        self.hop_dictionary = HopDictionary()
+        self.route_ids: dict[bytes, int] = {}
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.total_count = 0
+
+    def __len__(self) -> int:
+        return len(self.route_ids)
+
+    def add(self, route: list[Any], count: int = 1) -> None:
+        self.add_weighted([(route, count)])
+
+    def add_many(self, routes: Iterable[list[Any]]) -> None:
+        self.add_weighted((route, 1) for route in routes)
+
+    def add_weighted(self, weighted_routes: Iterable[WeightedRoute]) -> None:
+        weighted_routes = list(weighted_routes)
+        if not weighted_routes:
+            return
+        offsets = np.zeros(len(weighted_routes) + 1, dtype=np.int64)
+        np.cumsum([len(route) for (route, _) in weighted_routes], out=offsets[1:])
+        hops = self.hop_dictionary.encode(hop for (route, _) in weighted_routes for hop in route)
+        counts = np.array([count for (_, count) in weighted_routes], dtype=np.int64)
+        self.add_flattened(FlattenedRoutes(offsets=offsets, hops=hops), counts)
+
+    def add_flattened(self, routes: FlattenedRoutes, counts: np.ndarray) -> None:
+        """Add routes of hop codes from the hop dictionary, with the count of each route."""
+        if self.remove_duplicate_hops:
+            routes = remove_duplicate_consecutive_hop_codes(routes)
+        buffer = routes.hops.astype(np.int64, copy=False).tobytes()
+        byte_offsets = (routes.offsets * 8).tolist()
+        route_ids = self.route_ids
+        ids = np.fromiter((route_ids.setdefault(buffer[start:end], len(route_ids))
+                           for (start, end) in zip(byte_offsets, byte_offsets[1:])),
+                          dtype=np.int64, count=len(byte_offsets) - 1)
+        if len(route_ids) > len(self.counts):
+            self.counts = np.concatenate((self.counts, np.zeros(len(route_ids) - len(self.counts), dtype=np.int64)))
+        np.add.at(self.counts, ids, counts)
+        self.total_count += int(counts.sum())
+
+    def add_routes_file(self, routes_file: str) -> None:
+        """Add all routes of a routes file, where the hops of a binary file are encoded without decoding each route."""
+        if not is_binary_routes_file(routes_file):
+            for weighted_routes in iter_chunks(iter_weighted_routes_from_file(routes_file)):
+                self.add_weighted(weighted_routes)
+            return
+        logging.info(f'Reading routes from {routes_file} ...')
+        route_file = read_routes(routes_file)
+        for (offsets, hops, counts) in route_file.iter_flattened_chunks():
+            (unique_hops, inverse) = get_unique_hops(hops)
+            codes = self.hop_dictionary.encode(route_file.decode_hops(unique_hops))[inverse]
+            self.add_flattened(FlattenedRoutes(offsets=offsets, hops=codes), counts)
+
+    def get_unique_routes(self, order: np.ndarray) -> FlattenedRoutes:
+        """Return the unique routes as hop codes, in the given order of route ids."""
+        keys = list(self.route_ids)
+        ordered_keys = [keys[i] for i in order.tolist()]
+        offsets = np.zeros(len(ordered_keys) + 1, dtype=np.int64)
+        np.cumsum([len(key) // 8 for key in ordered_keys], out=offsets[1:])
+        return FlattenedRoutes(offsets=offsets, hops=np.frombuffer(b''.join(ordered_keys), dtype=np.int64))
+
+    def calculate_metric(self, routes: FlattenedRoutes, hops: list[Any], metric: RouteMetric,
+                         distance_model: DistanceModel) -> np.ndarray:
+        match metric:
+            case RouteMetric.HopCount:
+                return np.diff(routes.offsets)
+            case RouteMetric.DistanceKM:
+                (lat, lon) = np.array(hops, dtype=np.float64).reshape(-1, 2).T
+                distances = calculate_flattened_total_distances_km(routes.offsets, lat[routes.hops],
+                                                                   lon[routes.hops], distance_model)
+                return np.round(distances, 2)
+            case _:
+                raise ValueError(f'Unknown metric {metric}')
+
+    def to_dataframe(self, metrics: list[RouteMetric],
+                     distance_model: DistanceModel = DistanceModel.Geodesic) -> pd.DataFrame:
+        # Sorting is stable, so routes with the same count are in the order they first appeared.
+        order = np.argsort(-self.counts, kind='stable')
+        routes = self.get_unique_routes(order)
+        hops = self.hop_dictionary.get_hops()
+        hop_strs = [str(hop) for hop in hops]
+        codes = routes.hops.tolist()
+        offsets = routes.offsets.tolist()
+
+        columns: dict[str, Any] = { 'count': self.counts[order] }
+        for metric in metrics:
+            columns[str(metric)] = self.calculate_metric(routes, hops, metric, distance_model)
+        columns['route'] = ['|'.join([hop_strs[code] for code in codes[start:end]])
+                            for (start, end) in zip(offsets, offsets[1:])]
+        return pd.DataFrame(columns, columns=['count'] + [str(metric) for metric in metrics] + ['route'])
+
+def write_routes_distribution(distribution: RouteDistribution, metrics: list[RouteMetric],
+                              output: Optional[io.TextIOWrapper] = None,
+                              header: bool = False,
+                              distance_model: DistanceModel = DistanceModel.Geodesic) -> None:
+    df = distribution.to_dataframe(metrics, distance_model)
+    df.to_csv(output if output else sys.stdout, sep='\t', index=False, header=header)
+    logging.info(f'Done, {len(distribution)} unique routes out of {distribution.total_count}')
+
+def export_routes_distribution(weighted_routes: Iterable[WeightedRoute], metrics:list[RouteMetric],
+                               output: Optional[io.TextIOWrapper] = None,
+                               header: bool = False,
+                               distance_model: DistanceModel = DistanceModel.Geodesic,
+                               remove_duplicate_hops: bool = False) -> RouteDistribution:
+    """Export the distribution of a stream of (route, count) as TSV, and return the aggregated distribution.
+
+        Weighted routes are counted by their counts, so the distribution is the same as of the expanded routes.
+    """
+    logging.info('Exporting routes distribution ...')
+
+    distribution = RouteDistribution(remove_duplicate_hops)
+    for chunk in iter_chunks(weighted_routes):
+        distribution.add_weighted(chunk)
+    write_routes_distribution(distribution, metrics, output, header, distance_model)
+    return distribution
+
+def export_routes_file_distribution(routes_file: str, metrics:list[RouteMetric],
+                                    output: Optional[io.TextIOWrapper] = None,
+                                    header: bool = False,
+                                    distance_model: DistanceModel = DistanceModel.Geodesic,
+                                    remove_duplicate_hops: bool = False) -> RouteDistribution:
+    """Same as export_routes_distribution(), over all routes of a routes file in either format."""
+    logging.info('Exporting routes distribution ...')
+
+    distribution = RouteDistribution(remove_duplicate_hops)
+    distribution.add_routes_file(routes_file)
+    write_routes_distribution(distribution, metrics, output, header, distance_model)
+    return distribution
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import pandas as pd
+
+from combine_per_region_pair_tsvs import REGION_COLUMNS, REQUIRED_COLUMNS, iter_tsv_files_with_regions
+from common import ROUTES_CHUNK_SIZE, RegionPair, init_logging
+
+DEFAULT_ROUTE_DISTRIBUTION_DB_PATH = 'routes.all.by_geo.distribution.sqlite3'
+
+# A row of a region pair distribution, i.e. (count, hop_count, distance_km, route), from the most frequent route.
+DistributionRow = tuple[int, int, float, str]
+
+@dataclass
+class RegionPairSummary:
+    """The aggregate metrics of a region pair distribution, where the means are weighted by the route counts."""
+    unique_route_count: int
+    total_count: int
+    mean_hop_count: float
+    mean_distance_km: float
+    min_distance_km: float
+    max_distance_km: float
+
+class RouteDistributionDB:
+    """The geo distributions of all region pairs in one SQLite file, to look up the distribution and aggregate metrics
+        of a region pair without scanning the combined TSV.
+
+        Routes are clustered by (src_cloud, src_region, dst_cloud, dst_region, rank), so the distribution of a pair is
+        one range scan in the order of the TSV, and the aggregate metrics of each pair are precomputed at load time
+        into one row of the region_pairs table.
+    """
+    def __init__(self, path: str = DEFAULT_ROUTE_DISTRIBUTION_DB_PATH, read_only: bool = False):
+        self.path = path
+        if read_only:
+            self.connection = sqlite3.connect(f'file:{os.path.abspath(path)}?mode=ro', uri=True,
+                                              check_same_thread=False)
+            return
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS routes (
+                                        src_cloud TEXT NOT NULL,
+                                        src_region TEXT NOT NULL,
+                                        dst_cloud TEXT NOT NULL,
+                                        dst_region TEXT NOT NULL,
+                                        rank INTEGER NOT NULL,
+                                        count INTEGER NOT NULL,
+                                        hop_count INTEGER,
+                                        distance_km REAL,
+                                        route TEXT NOT NULL,
+                                        PRIMARY KEY (src_cloud, src_region, dst_cloud, dst_region, rank)
+                                    ) WITHOUT ROWID''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS region_pairs (
+                                        src_cloud TEXT NOT NULL,
+                                        src_region TEXT NOT NULL,
+                                        dst_cloud TEXT NOT NULL,
+                                        dst_region TEXT NOT NULL,
+                                        unique_route_count INTEGER NOT NULL,
+                                        total_count INTEGER NOT NULL,
+                                        mean_hop_count REAL,
+                                        mean_distance_km REAL,
+                                        min_distance_km REAL,
+                                        max_distance_km REAL,
+                                        PRIMARY KEY (src_cloud, src_region, dst_cloud, dst_region)
+                                    ) WITHOUT ROWID''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def load_dataframes(self, dfs: Iterable[pd.DataFrame]) -> int:
+        """Load distributions with region columns in one transaction, replacing the rows of the region pairs already
+            in the database, and return the number of region pairs loaded.
+
+            The rows of a region pair keep their order, and may span several dataframes, e.g. chunks of the combined
+            TSV, as long as they are not interleaved with the rows of the same pair from another load.
+        """
+        next_ranks: dict[RegionPair, int] = {}
+        with self.connection:
+            for df in dfs:
+                columns = [df[column].tolist() for column in REGION_COLUMNS + REQUIRED_COLUMNS]
+                rows = []
+                for (src_cloud, src_region, dst_cloud, dst_region, count, hop_count, distance_km, route) in \
+                        zip(*columns):
+                    pair = (src_cloud, src_region, dst_cloud, dst_region)
+                    rank = next_ranks.get(pair)
+                    if rank is None:
+                        self.connection.execute('DELETE FROM routes WHERE src_cloud = ? AND src_region = ? AND '
+                                                'dst_cloud = ? AND dst_region = ?', pair)
+                        rank = 0
+                    next_ranks[pair] = rank + 1
+                    rows.append((*pair, rank, count, hop_count, distance_km, route))
+                self.connection.executemany('INSERT INTO routes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            logging.info(f'Summarizing {len(next_ranks)} region pairs ...')
+            self.connection.executemany('''INSERT OR REPLACE INTO region_pairs
+                                           SELECT src_cloud, src_region, dst_cloud, dst_region, COUNT(*), SUM(count),
+                                                  1.0 * SUM(count * hop_count) / SUM(count),
+                                                  SUM(count * distance_km) / SUM(count),
+                                                  MIN(distance_km), MAX(distance_km)
+                                           FROM routes WHERE src_cloud = ? AND src_region = ? AND dst_cloud = ? AND
+                                                             dst_region = ?''', list(next_ranks))
+        return len(next_ranks)
+
+    def load_combined_tsv(self, tsv_file: str) -> int:
+        """Load the combined TSV of combine_per_region_pair_tsvs.py, in chunks."""
+        logging.info(f'Loading {tsv_file} ...')
+        return self.load_dataframes(pd.read_csv(tsv_file, delimiter='\t', chunksize=ROUTES_CHUNK_SIZE))
+
+    def load_region_pair_tsvs(self, input_files: list[str], jobs: int = 1) -> int:
+        """Load the distribution TSV of each region pair, named as *.src_cloud.src_region.dst_cloud.dst_region.*"""
+        return self.load_dataframes(iter_tsv_files_with_regions(input_files, jobs))
+
+    def get_region_pairs(self) -> list[RegionPair]:
+        return self.connection.execute('SELECT src_cloud, src_region, dst_cloud, dst_region FROM region_pairs '
+                                       'ORDER BY src_cloud, src_region, dst_cloud, dst_region').fetchall()
+
+    def get_summary(self, src_cloud: str, src_region: str, dst_cloud: str, dst_region: str) -> \
+            Optional[RegionPairSummary]:
+        row = self.connection.execute('''SELECT unique_route_count, total_count, mean_hop_count, mean_distance_km,
+                                                min_distance_km, max_distance_km
+                                         FROM region_pairs WHERE src_cloud = ? AND src_region = ? AND
+                                                                 dst_cloud = ? AND dst_region = ?''',
+                                      (src_cloud, src_region, dst_cloud, dst_region)).fetchone()
+        return RegionPairSummary(*row) if row is not None else None
+
+    def get_distribution(self, src_cloud: str, src_region: str, dst_cloud: str, dst_region: str,
+                         limit: Optional[int] = None) -> list[DistributionRow]:
+        """Return the weighted routes of a region pair, from the most frequent, or the top `limit` ones."""
+        return self.connection.execute('''SELECT count, hop_count, distance_km, route FROM routes
+                                          WHERE src_cloud = ? AND src_region = ? AND dst_cloud = ? AND dst_region = ?
+                                          ORDER BY rank LIMIT ?''',
+                                       (src_cloud, src_region, dst_cloud, dst_region,
+                                        limit if limit is not None else -1)).fetchall()
+
+def parse_cloud_region(value: str) -> tuple[str, str]:
+    (cloud, _, region) = value.partition(':')
+    if not cloud or not region:
+        raise argparse.ArgumentTypeError(f'Expected cloud:region, got "{value}"')
+    return (cloud, region)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load region pair route distributions into a SQLite database, '
+                                                 'and query the distribution and metrics of a region pair.')
+    parser.add_argument('--db', default=DEFAULT_ROUTE_DISTRIBUTION_DB_PATH,
+                        help=f'The database file, default to {DEFAULT_ROUTE_DISTRIBUTION_DB_PATH}')
+    parser.add_argument('--load-combined-tsv', help='The combined TSV of combine_per_region_pair_tsvs.py to load.')
+    parser.add_argument('--load-region-pair-tsvs', nargs='+',
+                        help='The distribution TSV files of each region pair to load, named in the format of '
+                             '*.src_cloud.src_region.dst_cloud.dst_region.*')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of processes to read the region pair TSV files in parallel.')
+    parser.add_argument('--src', type=parse_cloud_region, help='The source cloud:region to query, e.g. aws:us-east-1')
+    parser.add_argument('--dst', type=parse_cloud_region, help='The destination cloud:region to query.')
+    parser.add_argument('--limit', type=int, help='Only print the top N routes of the queried region pair.')
+    parser.add_argument('--summary-only', action='store_true',
+                        help='Only print the aggregate metrics of the queried region pair.')
+    parser.add_argument('--list-region-pairs', action='store_true', help='Print all region pairs in the database.')
+    args = parser.parse_args()
+
+    if bool(args.src) != bool(args.dst):
+        parser.error('--src and --dst must be specified together')
+    if not (args.load_combined_tsv or args.load_region_pair_tsvs or args.src or args.list_region_pairs):
+        parser.error('No action specified')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    return args
+
+def main():
+    init_logging(level=logging.INFO)
+    args = parse_args()
+    is_loading = bool(args.load_combined_tsv or args.load_region_pair_tsvs)
+    with RouteDistributionDB(args.db, read_only=not is_loading) as db:
+        if args.load_combined_tsv:
+            count = db.load_combined_tsv(args.load_combined_tsv)
+            logging.info(f'Loaded {count} region pairs into {args.db}')
+        if args.load_region_pair_tsvs:
+            count = db.load_region_pair_tsvs(args.load_region_pair_tsvs, args.jobs)
+            logging.info(f'Loaded {count} region pairs into {args.db}')
+        if args.list_region_pairs:
+            for pair in db.get_region_pairs():
+                print('\t'.join(pair))
+        if args.src:
+            pair = (*args.src, *args.dst)
+            start_time = time.perf_counter()
+            summary = db.get_summary(*pair)
+            rows = db.get_distribution(*pair, limit=args.limit) if not args.summary_only else []
+            elapsed_time = time.perf_counter() - start_time
+            logging.info(f'Elapsed: {elapsed_time * 1000:.3f}ms')
+            if summary is None:
+                logging.error(f'No routes for {args.src[0]}:{args.src[1]} -> {args.dst[0]}:{args.dst[1]} in {args.db}')
+                sys.exit(1)
+            for (name, value) in vars(summary).items():
+                print(f'# {name}: {value}')
+            if not args.summary_only:
+                print('\t'.join(REQUIRED_COLUMNS))
+                for row in rows:
+                    print('\t'.join(str(value) for value in row))
+
+if __name__ == '__main__':
+    main()
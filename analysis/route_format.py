@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+from array import array
+from typing import Any, Iterable, Iterator, Optional
+
+import numpy as np
+
+from common import ROUTES_CHUNK_SIZE, WeightedRoute, init_logging, iter_chunks, iter_weighted_routes_from_file
+
+# Routes files with this suffix are stored in the binary format, e.g. routes.aws.us-west-1.aws.us-east-1.by_geo.bin,
+#   and all other files in the legacy text format of one Python-literal list per line.
+ROUTES_BINARY_SUFFIX = '.bin'
+ROUTES_BINARY_MAGIC = b'CIDTRTE\0'
+ROUTES_BINARY_VERSION = 1
+# The offsets and payload arrays start at multiples of this alignment, so that they can be memory-mapped directly.
+ROUTES_BINARY_ALIGNMENT = 8
+
+HOP_TYPE_IP = 'ip'
+HOP_TYPE_COORDINATE = 'coordinate'
+HOP_TYPE_ISO = 'iso'
+HOP_TYPES = [HOP_TYPE_IP, HOP_TYPE_COORDINATE, HOP_TYPE_ISO]
+
+def is_binary_routes_file(filename: str) -> bool:
+    return filename.endswith(ROUTES_BINARY_SUFFIX)
+
+def get_aligned_size(size: int) -> int:
+    return (size + ROUTES_BINARY_ALIGNMENT - 1) // ROUTES_BINARY_ALIGNMENT * ROUTES_BINARY_ALIGNMENT
+
+def detect_hop_type(routes: list[list]) -> str:
+    """Detect the hop type from the first hop, i.e. IP addresses, (lat, lon) coordinates or ISO names."""
+    for route in routes:
+        for hop in route:
+            if isinstance(hop, (tuple, list)):
+                return HOP_TYPE_COORDINATE
+            try:
+                socket.inet_aton(hop)
+                return HOP_TYPE_IP
+            except OSError:
+                return HOP_TYPE_ISO
+    # Without any hop, any type reads back the same.
+    return HOP_TYPE_IP
+
+class RouteFile:
+    """A memory-mapped binary routes file, as a ragged array of routes.
+
+        Layout, in little-endian:
+        - magic (8 bytes) and the header length (uint64),
+        - the JSON header, with the hop type, route/hop counts, coordinate dtype and the ISO dictionary,
+        - offsets (uint64, route count + 1), where the hops of route i are hops[offsets[i]:offsets[i + 1]],
+        - weights (uint64, route count), only in weighted files, i.e. the number of times each route occurs,
+        - hops: uint32 IPv4 addresses, (lat, lon) pairs of float32/float64, or uint32 codes into the ISO dictionary.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+        if self.buffer[:len(ROUTES_BINARY_MAGIC)].tobytes() != ROUTES_BINARY_MAGIC:
+            raise ValueError(f'{filename} is not a binary routes file')
+        header_start = len(ROUTES_BINARY_MAGIC) + 8
+        (header_length,) = struct.unpack('<Q', self.buffer[len(ROUTES_BINARY_MAGIC):header_start].tobytes())
+        self.header: dict[str, Any] = json.loads(self.buffer[header_start:header_start + header_length].tobytes())
+        if self.header['version'] != ROUTES_BINARY_VERSION:
+            raise ValueError(f'Unsupported binary routes file version {self.header["version"]} in {filename}')
+
+        self.hop_type: str = self.header['hop_type']
+        route_count: int = self.header['route_count']
+        hop_count: int = self.header['hop_count']
+        offsets_start = get_aligned_size(header_start + header_length)
+        self.offsets = self.buffer[offsets_start:offsets_start + (route_count + 1) * 8].view('<u8')
+        hops_start = get_aligned_size(offsets_start + (route_count + 1) * 8)
+        self.is_weighted: bool = self.header.get('weighted', False)
+        self.weights: Optional[np.ndarray] = None
+        if self.is_weighted:
+            self.weights = self.buffer[hops_start:hops_start + route_count * 8].view('<u8')
+            hops_start = get_aligned_size(hops_start + route_count * 8)
+        if self.hop_type == HOP_TYPE_COORDINATE:
+            dtype = np.dtype(self.header['coordinate_dtype']).newbyteorder('<')
+            self.hops = self.buffer[hops_start:hops_start + hop_count * 2 * dtype.itemsize].view(dtype).reshape(-1, 2)
+        else:
+            self.hops = self.buffer[hops_start:hops_start + hop_count * 4].view('<u4')
+        self.isos: list[str] = self.header.get('isos', [])
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def decode_hops(self, hops: np.ndarray) -> list:
+        match self.hop_type:
+            case 'ip':
+                packed_ips = hops.astype('>u4').tobytes()
+                return [socket.inet_ntoa(packed_ips[i:i + 4]) for i in range(0, len(packed_ips), 4)]
+            case 'coordinate':
+                return [tuple(hop) for hop in hops.astype(np.float64).tolist()]
+            case 'iso':
+                return [self.isos[code] for code in hops.tolist()]
+            case _:
+                raise ValueError(f'Unknown hop type {self.hop_type}')
+
+    def __getitem__(self, i: int) -> list:
+        return self.decode_hops(self.hops[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def get_routes(self, start: int, stop: int) -> list[list]:
+        """Decode the routes in [start, stop) at once, in the same form as parsed from the text format."""
+        offsets = self.offsets[start:stop + 1].tolist()
+        hops = self.decode_hops(self.hops[offsets[0]:offsets[-1]]) if offsets else []
+        return [hops[offsets[i] - offsets[0]:offsets[i + 1] - offsets[0]] for i in range(len(offsets) - 1)]
+
+    def iter_chunks(self, chunk_size: int = ROUTES_CHUNK_SIZE) -> Iterator[list[list]]:
+        for start in range(0, len(self), chunk_size):
+            yield self.get_routes(start, min(start + chunk_size, len(self)))
+
+    def iter_weighted_chunks(self, chunk_size: int = ROUTES_CHUNK_SIZE) -> Iterator[list[WeightedRoute]]:
+        """Iterate over chunks of (route, count), where the count is 1 for all routes if the file is not weighted."""
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            counts = self.weights[start:stop].tolist() if self.weights is not None else [1] * (stop - start)
+            yield list(zip(self.get_routes(start, stop), counts))
+
+    def iter_flattened_chunks(self, chunk_size: int = ROUTES_CHUNK_SIZE) -> \
+                                Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Iterate over chunks of (offsets, hops, counts) without decoding the hops, where the offsets start from 0."""
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            offsets = self.offsets[start:stop + 1].astype(np.int64)
+            hops = self.hops[offsets[0]:offsets[-1]]
+            counts = self.weights[start:stop].astype(np.int64) if self.weights is not None else \
+                np.ones(stop - start, dtype=np.int64)
+            yield (offsets - offsets[0], hops, counts)
+
+    def __iter__(self) -> Iterator[list]:
+        for routes in self.iter_chunks():
+            yield from routes
+
+    def to_list(self) -> list[list]:
+        return self.get_routes(0, len(self))
+
+def read_routes(filename: str) -> RouteFile:
+    return RouteFile(filename)
+
+def encode_hops(routes: list[list], hop_type: str, coordinate_dtype: str, code_by_iso: dict[str, int]) -> np.ndarray:
+    """Encode the hops of all routes into one array, adding new ISOs to the dictionary if any."""
+    hops = [hop for route in routes for hop in route]
+    match hop_type:
+        case 'ip':
+            try:
+                packed_ips = b''.join(map(socket.inet_aton, hops))
+            except OSError as ex:
+                raise ValueError(f'Only IPv4 addresses can be stored in the binary format: {ex}')
+            return np.frombuffer(packed_ips, dtype='>u4').astype('<u4')
+        case 'coordinate':
+            return np.array(hops, dtype=np.dtype(coordinate_dtype).newbyteorder('<')).reshape(-1, 2)
+        case 'iso':
+            return np.array([code_by_iso.setdefault(hop, len(code_by_iso)) for hop in hops], dtype='<u4')
+        case _:
+            raise ValueError(f'Unknown hop type {hop_type}')
+
+class BinaryRouteWriter:
+    """Write routes to a binary routes file in chunks, detecting the hop type from the first hop if not given.
+
+        As the header and offsets precede the hops in the file, the encoded hops are staged in a temporary file next to
+        the output, so that memory is bounded by the chunk size and the offsets. Coordinates are stored as float64 by
+        default, which round-trips exactly to the text format.
+    """
+    def __init__(self, filename: str, hop_type: Optional[str] = None, coordinate_dtype: str = 'float64',
+                 mode: str = 'w', chunk_size: int = ROUTES_CHUNK_SIZE, weighted: bool = False):
+        # Fail early as the text format would, e.g. if the file exists in 'x' mode.
+        open(filename, mode + 'b').close()
+        self.filename = filename
+        self.hop_type = hop_type
+        self.coordinate_dtype = coordinate_dtype
+        self.chunk_size = chunk_size
+        self.weighted = weighted
+        self.route_lengths = array('Q')
+        self.route_weights = array('Q')
+        self.code_by_iso: dict[str, int] = {}
+        self.pending_routes: list[list] = []
+        self.hops_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(filename)),
+                                                     prefix=os.path.basename(filename) + '.', suffix='.tmp',
+                                                     delete=False)
+
+    def write(self, route: list, count: int = 1) -> None:
+        self.pending_routes.append(route)
+        if self.weighted:
+            self.route_weights.append(count)
+        if len(self.pending_routes) >= self.chunk_size:
+            self.flush()
+
+    def write_many(self, routes: Iterable[list]) -> None:
+        for route in routes:
+            self.write(route)
+
+    def write_weighted(self, weighted_routes: Iterable[WeightedRoute]) -> None:
+        for (route, count) in weighted_routes:
+            self.write(route, count)
+
+    def flush(self) -> None:
+        if not self.pending_routes:
+            return
+        if self.hop_type is None and any(self.pending_routes):
+            self.hop_type = detect_hop_type(self.pending_routes)
+        if self.hop_type is not None:
+            self.hops_file.write(encode_hops(self.pending_routes, self.hop_type, self.coordinate_dtype,
+                                             self.code_by_iso).tobytes())
+        self.route_lengths.extend(len(route) for route in self.pending_routes)
+        self.pending_routes = []
+
+    def close(self) -> None:
+        self.flush()
+        self.hops_file.close()
+        # Without any hop, any type reads back the same.
+        hop_type = self.hop_type or HOP_TYPE_IP
+        offsets = np.zeros(len(self.route_lengths) + 1, dtype='<u8')
+        np.cumsum(np.frombuffer(self.route_lengths, dtype=np.uint64), out=offsets[1:])
+
+        header: dict[str, Any] = {
+            'version': ROUTES_BINARY_VERSION,
+            'hop_type': hop_type,
+            'route_count': len(self.route_lengths),
+            'hop_count': int(offsets[-1]),
+        }
+        if self.weighted:
+            header['weighted'] = True
+        if hop_type == HOP_TYPE_COORDINATE:
+            header['coordinate_dtype'] = self.coordinate_dtype
+        if hop_type == HOP_TYPE_ISO:
+            header['isos'] = list(self.code_by_iso.keys())
+        header_bytes = json.dumps(header).encode()
+
+        try:
+            with open(self.filename, 'wb') as file, open(self.hops_file.name, 'rb') as hops_file:
+                file.write(ROUTES_BINARY_MAGIC)
+                file.write(struct.pack('<Q', len(header_bytes)))
+                file.write(header_bytes)
+                file.write(b'\0' * (get_aligned_size(file.tell()) - file.tell()))
+                file.write(offsets.tobytes())
+                file.write(b'\0' * (get_aligned_size(file.tell()) - file.tell()))
+                if self.weighted:
+                    file.write(np.frombuffer(self.route_weights, dtype=np.uint64).astype('<u8').tobytes())
+                    file.write(b'\0' * (get_aligned_size(file.tell()) - file.tell()))
+                shutil.copyfileobj(hops_file, file)
+        finally:
+            os.remove(self.hops_file.name)
+
+def write_routes(routes: Iterable[list], filename: str, hop_type: Optional[str] = None,
+                 coordinate_dtype: str = 'float64') -> int:
+    """Write routes in the binary format, and return the number of routes written."""
+    writer = BinaryRouteWriter(filename, hop_type, coordinate_dtype)
+    writer.write_many(routes)
+    writer.close()
+    return len(writer.route_lengths)
+
+def write_weighted_routes(weighted_routes: Iterable[WeightedRoute], filename: str, hop_type: Optional[str] = None,
+                          coordinate_dtype: str = 'float64') -> int:
+    """Write (route, count) pairs in the weighted binary format, and return the number of routes written."""
+    writer = BinaryRouteWriter(filename, hop_type, coordinate_dtype, weighted=True)
+    writer.write_weighted(weighted_routes)
+    writer.close()
+    return len(writer.route_lengths)
+
+class RouteWriter:
+    """Write routes one by one to a routes file in the format of its suffix, or to stdout in the text format.
+
+        Weighted routes are written with their counts, i.e. as "<count> <route>" lines in the text format.
+    """
+    def __init__(self, output_file: Optional[str], hop_type: Optional[str] = None, mode: str = 'w',
+                 weighted: bool = False):
+        self.output_file = output_file
+        self.weighted = weighted
+        self.binary_writer = BinaryRouteWriter(output_file, hop_type, mode=mode, weighted=weighted) \
+            if output_file and is_binary_routes_file(output_file) else None
+        if self.binary_writer is None:
+            self.output = open(output_file, mode) if output_file else sys.stdout
+
+    def write(self, route: list, count: int = 1) -> None:
+        if self.binary_writer is not None:
+            self.binary_writer.write(route, count)
+        elif self.weighted:
+            print(count, route, file=self.output)
+        else:
+            print(route, file=self.output)
+
+    def write_many(self, routes: Iterable[list]) -> None:
+        for route in routes:
+            self.write(route)
+
+    def write_weighted(self, weighted_routes: Iterable[WeightedRoute]) -> None:
+        for (route, count) in weighted_routes:
+            self.write(route, count)
+
+    def close(self) -> None:
+        if self.binary_writer is not None:
+            self.binary_writer.close()
+        elif self.output_file:
+            self.output.close()
+        else:
+            self.output.flush()
+
+    def __enter__(self) -> 'RouteWriter':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+def is_weighted_routes_file(filename: str) -> bool:
+    """Whether the routes file has a count for each route, i.e. the weighted flag in a binary file, or text lines
+        starting with the count instead of the route list."""
+    if is_binary_routes_file(filename):
+        return read_routes(filename).is_weighted
+    with open(filename, 'r') as file:
+        for line in file:
+            if line.strip():
+                return line.lstrip()[0].isdigit()
+    return False
+
+def convert_text_to_binary(input_file: str, output_file: str, hop_type: Optional[str] = None,
+                           coordinate_dtype: str = 'float64') -> int:
+    writer = BinaryRouteWriter(output_file, hop_type, coordinate_dtype, weighted=is_weighted_routes_file(input_file))
+    writer.write_weighted(iter_weighted_routes_from_file(input_file))
+    writer.close()
+    return len(writer.route_lengths)
+
+def convert_binary_to_text(input_file: str, output_file: Optional[str]) -> int:
+    route_file = read_routes(input_file)
+    with RouteWriter(output_file, weighted=route_file.is_weighted) as writer:
+        for weighted_routes in route_file.iter_weighted_chunks():
+            writer.write_weighted(weighted_routes)
+    return len(route_file)
+
+def get_weighted_routes(routes: Iterable[WeightedRoute]) -> list[WeightedRoute]:
+    """Merge identical routes by summing up their counts, in the order they first appear."""
+    counts: dict[tuple, int] = {}
+    for (route, count) in routes:
+        key = tuple(route)
+        counts[key] = counts.get(key, 0) + count
+    return [(list(route), count) for route, count in counts.items()]
+
+def convert_to_weighted(input_file: str, output_file: Optional[str]) -> int:
+    """Convert a routes file into a weighted one with each unique route once, in the format of the output suffix."""
+    weighted_routes = get_weighted_routes(iter_weighted_routes_from_file(input_file))
+    with RouteWriter(output_file, weighted=True) as writer:
+        writer.write_weighted(weighted_routes)
+    return len(weighted_routes)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--to-binary', action='store_true', help='Convert text routes files to the binary format.')
+    parser.add_argument('--to-text', action='store_true', help='Convert binary routes files to the text format.')
+    parser.add_argument('--to-weighted', action='store_true',
+                        help='Merge identical routes into weighted routes files, in the format of the output suffix.')
+    parser.add_argument('--routes_files', required=True, nargs='+', help='The routes files to convert.')
+    parser.add_argument('-o', '--outputs', nargs='*',
+                        help='The output files, or none to auto-name them by adding or removing the .bin suffix.')
+    parser.add_argument('--hop-type', choices=HOP_TYPES, help='The hop type, detected from the first hop by default.')
+    parser.add_argument('--coordinate-dtype', choices=['float64', 'float32'], default='float64',
+                        help='The dtype to store coordinates, where float32 halves the size but is not lossless.')
+    args = parser.parse_args()
+
+    if [args.to_binary, args.to_text, args.to_weighted].count(True) != 1:
+        parser.error('Exactly one of --to-binary, --to-text or --to-weighted must be specified')
+    if args.outputs is not None and len(args.outputs) not in [0, len(args.routes_files)]:
+        parser.error('The number of output files must match the number of routes files, or be 0 (auto-naming files)')
+    if args.outputs is None and args.to_binary:
+        parser.error('--outputs must be specified with --to-binary')
+    if args.to_weighted and args.outputs is not None and len(args.outputs) == 0:
+        parser.error('--outputs must be named explicitly with --to-weighted')
+
+    return args
+
+def main():
+    init_logging(level=logging.INFO)
+    args = parse_args()
+    for i, routes_file in enumerate(args.routes_files):
+        if args.outputs is not None:
+            if len(args.outputs) == 0:
+                output_file = os.path.basename(routes_file) + ROUTES_BINARY_SUFFIX if args.to_binary else \
+                    os.path.basename(routes_file).removesuffix(ROUTES_BINARY_SUFFIX)
+            else:
+                output_file = args.outputs[i]
+        else:
+            output_file = None
+        if args.to_binary:
+            count = convert_text_to_binary(routes_file, output_file, args.hop_type, args.coordinate_dtype)
+        elif args.to_text:
+            count = convert_binary_to_text(routes_file, output_file)
+        else:
+            count = convert_to_weighted(routes_file, output_file)
+        logging.info(f'Converted {count} routes from {routes_file} to {output_file if output_file else "stdout"}')
+
+if __name__ == '__main__':
+    main()
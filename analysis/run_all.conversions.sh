@@ -6,39 +6,16 @@ cd "$(dirname "$0")"
 
 set -e
 
-# IP-to-geo conversion
-./itdk_geo.py --convert-ip-to-latlon --filter-geo-coordinate-by-ground-truth --geo-coordinate-ground-truth-csv ./results/geo_distributions/geo_distribution.all.csv --routes_file region_pair.by_ip/routes.*.by_ip --outputs
-chmod 440 routes.*.by_geo
-
-for file in routes.*.by_geo; do
-    echo "Processing $file ..."
-    name="$(basename "$file" ".by_geo")"
-
-    # Geo distribution
-    ./distribution.routes.py --export-routes-distribution --include hop_count distance_km --remove-duplicate-consecutive-hops --routes_file "$name.by_geo" > "$name.by_geo.distribution"
-
-    # Geo-to-ISO conversion
-    ./carbon_client.py --convert-latlon-to-carbon-region --routes_file "$file" > "$name".by_iso
-    # It is not necessary to filter again as we've filtered earlier. See notes at the end of "Clean up noisy routes" section.
-    # src_cloud="$(echo "$name" | awk -F. '{print $2}')"
-    # src_region="$(echo "$name" | awk -F. '{print $3}')"
-    # dst_cloud="$(echo "$name" | awk -F. '{print $4}')"
-    # dst_region="$(echo "$name" | awk -F. '{print $5}')"
-    # ./carbon_client.py --convert-latlon-to-carbon-region --filter-iso-by-ground-truth --iso-ground-truth-csv ./results/iso_distributions/iso_distribution.all.csv --src-cloud "$src_cloud" --src-region "$src_region" --dst-cloud "$dst_cloud" --dst-region "$dst_region" --routes_file "$file" > "$name".by_iso
-
-    # ISO distribution
-    ./distribution.routes.py --export-routes-distribution --routes_file "$name.by_iso" > "$name.by_iso.distribution"
-
-    chmod 440 "$name.by_geo.distribution" $name.by_iso $name.by_iso.distribution
-done
-
-mkdir region_pair.by_geo region_pair.by_geo.distribution region_pair.by_iso region_pair.by_iso.distribution
-mv routes.*.by_geo region_pair.by_geo/
-mv routes.*.by_geo.distribution region_pair.by_geo.distribution/
-mv routes.*.by_iso region_pair.by_iso/
-mv routes.*.by_iso.distribution region_pair.by_iso.distribution/
-
-# Consolidate all the geo distributions TSV files into one, for batch import into SQL
-./combine_per_region_pair_tsvs.py -i region_pair.by_geo.distribution/routes.*.by_geo.distribution -o ./routes.all.by_geo.distribution.tsv
+# IP-to-geo and geo-to-ISO conversions, with the geo and ISO distributions of each region pair, in one pass per region pair.
+# It is not necessary to filter the ISOs again as we've filtered the geo coordinates. See notes at the end of "Clean up noisy routes" section.
+# Then consolidate all the geo distributions TSV files into one, for batch import into SQL
+# Reruns only rebuild the region pairs whose inputs, ground truth rows or code changed, see --dry-run to list them.
+./conversion_pipeline.py --incremental --routes_files region_pair.by_ip/routes.*.by_ip --geo-coordinate-ground-truth-csv ./results/geo_distributions/geo_distribution.all.csv --output-dir . -o ./routes.all.by_geo.distribution.tsv --jobs "$(nproc)"
+
+chmod 440 region_pair.by_geo/routes.*.by_geo region_pair.by_geo.distribution/routes.*.by_geo.distribution
+chmod 440 region_pair.by_iso/routes.*.by_iso region_pair.by_iso.distribution/routes.*.by_iso.distribution
 chmod 440 ./routes.all.by_geo.distribution.tsv
-# import this later into SQL.
+# Load the combined TSV into SQLite, to look up the distribution and metrics of a region pair without scanning the TSV.
+./route_distribution_db.py --db ./routes.all.by_geo.distribution.sqlite3 --load-combined-tsv ./routes.all.by_geo.distribution.tsv
+# Precompile the ISO weights of all region pairs, to calculate the CIDT of all pairs at once from ISO carbon intensities.
+./cidt.py --compile --distribution-files region_pair.by_iso.distribution/routes.*.by_iso.distribution --matrix-file ./routes.all.by_iso.cidt_matrix.npz --jobs "$(nproc)"
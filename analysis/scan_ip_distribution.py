@@ -1,56 +1,98 @@
 #!/usr/bin/env python3
 
 import logging
+import socket
 import sys
-from ipaddress import IPv4Network, IPv4Address
+from ipaddress import IPv4Network
+
+import numpy as np
 
 from common import init_logging
 
-def build_prefix_set(prefix_file):
-    prefix_set = set()
+class PrefixIndex:
+    """Longest-prefix-match index over a set of IPv4 prefixes.
+
+        Prefixes are grouped by length, and each group keeps a sorted array of network addresses, so that a batch of
+        IPs is classified with one vectorized binary search per distinct prefix length, longest first.
+    """
+    def __init__(self, prefixes: list[IPv4Network]):
+        self.prefixes = sorted(set(prefixes), key=lambda prefix: (int(prefix.network_address), prefix.prefixlen))
+        self.levels: list[tuple[np.uint32, np.ndarray, np.ndarray]] = []
+        prefixlens = np.array([prefix.prefixlen for prefix in self.prefixes], dtype=np.int32)
+        networks = np.array([int(prefix.network_address) for prefix in self.prefixes], dtype=np.uint32)
+        for prefixlen in sorted(set(prefixlens.tolist()), reverse=True):
+            indices = np.flatnonzero(prefixlens == prefixlen)
+            # Networks of the same length never overlap, and are already sorted by address.
+            netmask = np.uint32((0xFFFFFFFF << (32 - prefixlen)) & 0xFFFFFFFF)
+            self.levels.append((netmask, networks[indices], indices))
+
+    def lookup(self, ips: np.ndarray) -> np.ndarray:
+        """Return the index in `self.prefixes` of the longest matching prefix of each IP, or -1 if there's none."""
+        matched = np.full(len(ips), -1, dtype=np.int64)
+        for (netmask, networks, indices) in self.levels:
+            unmatched = np.flatnonzero(matched < 0)
+            if unmatched.size == 0:
+                break
+            candidates = ips[unmatched] & netmask
+            positions = np.searchsorted(networks, candidates)
+            positions[positions == networks.size] = 0
+            found = networks[positions] == candidates
+            matched[unmatched[found]] = indices[positions[found]]
+        return matched
+
+def build_prefix_index(prefix_file) -> PrefixIndex:
+    prefixes = []
     with open(prefix_file, 'r') as f:
         for line in f:
             prefix = line.strip()
-            prefix_set.add(IPv4Network(prefix, strict=False))
-    return prefix_set
-
-def match_ip_addresses(ip_file, prefix_set):
-    prefix_distribution = {}
+            if not prefix:
+                continue
+            prefixes.append(IPv4Network(prefix, strict=False))
+    prefix_index = PrefixIndex(prefixes)
+    logging.info(f'Built prefix index with {len(prefix_index.prefixes)} prefixes')
+    return prefix_index
 
+def load_ip_addresses(ip_file) -> tuple[list[str], np.ndarray]:
+    """Load the IP addresses from a zmap output file, as strings and as an array of unsigned integers."""
     with open(ip_file, 'r') as f:
-        for line in f:
-            ip = line.strip()
-            if not ip:
-                continue
-            ip_address = IPv4Address(ip)
-            matched_prefix = None
-            for prefix in prefix_set:
-                if ip_address in prefix:
-                    matched_prefix = str(prefix)
-                    break
-
-            if matched_prefix:
-                logging.debug(f"IP {ip} matches prefix {matched_prefix}")
-                prefix_distribution[matched_prefix] = prefix_distribution.get(matched_prefix, 0) + 1
-            else:
-                logging.error(f"IP {ip} does not match any prefix")
-
-    print("\nDistribution of matched prefixes:")
-    for prefix, count in prefix_distribution.items():
-        print(f"{prefix}: {count} occurrences")
+        ips = [line.strip() for line in f]
+    ips = [ip for ip in ips if ip]
+    packed_ips = b''.join(map(socket.inet_aton, ips))
+    return ips, np.frombuffer(packed_ips, dtype='>u4').astype(np.uint32)
+
+def match_ip_addresses(ip_file, prefix_index: PrefixIndex) -> dict[str, int]:
+    ips, ip_array = load_ip_addresses(ip_file)
+    matched = prefix_index.lookup(ip_array)
+
+    for i in np.flatnonzero(matched < 0):
+        logging.error(f"IP {ips[i]} does not match any prefix")
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for i in np.flatnonzero(matched >= 0):
+            logging.debug(f"IP {ips[i]} matches prefix {prefix_index.prefixes[matched[i]]}")
+
+    counts = np.bincount(matched[matched >= 0], minlength=len(prefix_index.prefixes))
+    prefix_distribution = { str(prefix_index.prefixes[i]): int(counts[i]) for i in np.flatnonzero(counts) }
+    logging.info(f'Matched {int(counts.sum())}/{len(ips)} IPs in {ip_file}')
+    return prefix_distribution
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python script.py prefix_file ip_file")
+    if len(sys.argv) < 3:
+        print("Usage: python script.py prefix_file ip_file [ip_file ...]")
         sys.exit(1)
 
     init_logging(level=logging.INFO)
 
     prefix_file = sys.argv[1]
-    ip_file = sys.argv[2]
+    ip_files = sys.argv[2:]
+
+    prefix_index = build_prefix_index(prefix_file)
+    for ip_file in ip_files:
+        prefix_distribution = match_ip_addresses(ip_file, prefix_index)
 
-    prefix_set = build_prefix_set(prefix_file)
-    match_ip_addresses(ip_file, prefix_set)
+        print(f"\nDistribution of matched prefixes in {ip_file}:" if len(ip_files) > 1 else
+              "\nDistribution of matched prefixes:")
+        for prefix, count in sorted(prefix_distribution.items(), key=lambda x: x[1], reverse=True):
+            print(f"{prefix}: {count} occurrences")
 
 if __name__ == "__main__":
     main()
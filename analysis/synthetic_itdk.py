@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order
+
+from common import init_logging
+from itdk_geo_table import uint32_to_ips
+
+# The layout of a synthetic dataset directory, which mirrors ../data, plus ISO boundaries and a routes file.
+ITDK_NODES_FILENAME = 'caida-itdk/midar-iff.nodes'
+ITDK_LINKS_FILENAME = 'caida-itdk/midar-iff.links'
+ITDK_NODE_GEO_FILENAME = 'caida-itdk/midar-iff.nodes.geo'
+ITDK_NODE_AS_FILENAME = 'caida-itdk/midar-iff.nodes.as'
+AWS_IP_RANGES_FILENAME = 'cloud/ip-ranges.aws.json'
+GCLOUD_IP_RANGES_FILENAME = 'cloud/ip-ranges.gcloud.json'
+ISO_GEOJSON_FILENAME = 'world.synthetic.geojson'
+ROUTES_FILENAME = 'routes.synthetic.by_ip'
+MANIFEST_FILENAME = 'synthetic_itdk.json'
+MANIFEST_VERSION = 1
+
+# The approximate location of the cloud regions, which become the largest cities of the dataset.
+CLOUD_REGION_LOCATIONS: dict[str, dict[str, tuple[float, float]]] = {
+    'aws': {
+        'us-east-1': (38.9, -77.4), 'us-east-2': (40.0, -83.0), 'us-west-1': (37.4, -121.9),
+        'us-west-2': (45.8, -119.7), 'ca-central-1': (45.5, -73.6), 'sa-east-1': (-23.5, -46.6),
+        'eu-west-1': (53.3, -6.3), 'eu-west-2': (51.5, -0.1), 'eu-central-1': (50.1, 8.7),
+        'eu-north-1': (59.3, 18.1), 'ap-south-1': (19.1, 72.9), 'ap-southeast-1': (1.3, 103.8),
+        'ap-southeast-2': (-33.9, 151.2), 'ap-northeast-1': (35.7, 139.7), 'af-south-1': (-33.9, 18.4),
+        'me-south-1': (26.1, 50.6),
+    },
+    'gcloud': {
+        'us-central1': (41.3, -95.9), 'us-east1': (33.2, -80.0), 'us-east4': (38.9, -77.4),
+        'us-west1': (45.6, -121.2), 'us-west2': (34.1, -118.2), 'northamerica-northeast1': (45.5, -73.6),
+        'southamerica-east1': (-23.5, -46.6), 'europe-west1': (50.4, 3.8), 'europe-west2': (51.5, -0.1),
+        'europe-west3': (50.1, 8.7), 'europe-north1': (60.6, 27.2), 'asia-south1': (19.1, 72.9),
+        'asia-southeast1': (1.3, 103.8), 'asia-east1': (24.1, 120.5), 'asia-northeast1': (35.7, 139.7),
+        'australia-southeast1': (-33.9, 151.2),
+    },
+}
+CONTINENTS = ['NA', 'SA', 'EU', 'AF', 'AS', 'OC']
+AS_HEURISTIC_TAGS = ['refinement', 'interfaces', 'last_hop']
+AS_HEURISTIC_TAG_WEIGHTS = [0.6, 0.3, 0.1]
+
+@dataclass
+class SyntheticItdkParameters:
+    """The scale and shape of a synthetic dataset. Degrees, city sizes and alias counts follow power laws, so that a
+        few hubs, big cities and routers with many interfaces dominate, as in the ITDK."""
+    node_count: int = 100000
+    seed: int = 0
+    city_count: int = 0                 # 0 to scale with the node count
+    city_size_exponent: float = 1.0     # Zipf exponent of the number of nodes per city
+    city_radius_deg: float = 0.3        # Standard deviation of the coordinates of nodes away from the city centroid
+    jittered_node_fraction: float = 0.2
+    geo_node_fraction: float = 0.9
+    alias_exponent: float = 2.5         # Zipf exponent of the number of IPs per node
+    max_alias_count: int = 64
+    mean_degree: float = 4.0
+    degree_exponent: float = 2.1        # Power-law exponent of the node degrees
+    local_link_fraction: float = 0.7    # Links that stay within the city of their first node
+    multi_node_link_fraction: float = 0.05
+    known_interface_fraction: float = 0.5
+    local_as_fraction: float = 0.8
+    prefixes_per_region: int = 4
+    cloud_nodes_per_region: int = 20
+    iso_grid_deg: float = 10.0
+    route_count: int = 100000
+
+    def get_city_count(self) -> int:
+        return self.city_count or int(np.clip(self.node_count // 500, 50, 20000))
+
+@dataclass
+class SyntheticItdk:
+    """A synthetic ITDK snapshot, where node i (0-based) is named N{i + 1}, and the IPs of node i are
+        ips[ip_offsets[i]:ip_offsets[i + 1]]. Link i connects link_nodes[link_offsets[i]:link_offsets[i + 1]]."""
+    city_lats: np.ndarray
+    city_lons: np.ndarray
+    node_cities: np.ndarray
+    node_lats: np.ndarray
+    node_lons: np.ndarray
+    has_geo: np.ndarray
+    node_asns: np.ndarray
+    node_as_tags: np.ndarray
+    ip_offsets: np.ndarray
+    ips: np.ndarray
+    link_offsets: np.ndarray
+    link_nodes: np.ndarray
+    # Whether each node of a link is given with its interface IP (N1:1.2.3.4), or inferred (N1)
+    link_known_interfaces: np.ndarray
+    # (cloud, region, prefix) of all cloud IP ranges, and the cloud IP of each (cloud, region, node) in the ranges.
+    cloud_prefixes: list[tuple[str, str, str]]
+    cloud_nodes: list[tuple[str, str, int, int]]
+
+def get_power_law_weights(count: int, exponent: float) -> np.ndarray:
+    """Return the normalized Zipf weights of ranks 1..count."""
+    weights = 1 / np.arange(1, count + 1, dtype=np.float64) ** exponent
+    return weights / weights.sum()
+
+def generate_cities(rng: np.random.Generator, parameters: SyntheticItdkParameters) -> tuple[np.ndarray, np.ndarray]:
+    """Return the centroids of the cities, from the largest, where the cloud region locations come first."""
+    region_locations = sorted(set(location for locations in CLOUD_REGION_LOCATIONS.values()
+                                  for location in locations.values()))
+    city_count = max(parameters.get_city_count(), len(region_locations))
+    random_city_count = city_count - len(region_locations)
+    # Uniform on the sphere, between the latitudes of most of the populated land.
+    lats = np.degrees(np.arcsin(rng.uniform(np.sin(np.radians(-55)), np.sin(np.radians(70)), random_city_count)))
+    lons = rng.uniform(-180, 180, random_city_count)
+    (region_lats, region_lons) = np.array(region_locations, dtype=np.float64).T
+    return (np.concatenate((region_lats, lats)), np.concatenate((region_lons, lons)))
+
+def sample_unique_ips(rng: np.random.Generator, count: int, excluded_blocks: np.ndarray) -> np.ndarray:
+    """Return `count` unique random unicast IPs as uint32, in random order, none in the excluded /24 blocks."""
+    ips = np.zeros(0, dtype=np.uint32)
+    while len(ips) < count:
+        draws = rng.integers(1 << 24, 224 << 24, size=int((count - len(ips)) * 1.1) + 16, dtype=np.uint32)
+        draws = draws[~np.isin(draws >> 8, excluded_blocks)]
+        ips = np.unique(np.concatenate((ips, draws)))
+    return rng.permutation(ips)[:count]
+
+def generate_cloud_prefixes(rng: np.random.Generator, prefixes_per_region: int) -> \
+        tuple[list[tuple[str, str, int, int]], np.ndarray]:
+    """Return non-overlapping (cloud, region, network, prefix length) ranges of /20 to /24, and their /24 blocks."""
+    prefixes = []
+    used_blocks: set[int] = set()
+    for (cloud, locations) in CLOUD_REGION_LOCATIONS.items():
+        for region in locations:
+            region_prefix_count = 0
+            while region_prefix_count < prefixes_per_region:
+                prefix_length = int(rng.integers(20, 25))
+                network = int(rng.integers(1 << 24, 224 << 24)) >> (32 - prefix_length) << (32 - prefix_length)
+                blocks = set(range(network >> 8, (network >> 8) + (1 << (24 - prefix_length))))
+                if blocks & used_blocks:
+                    continue
+                used_blocks |= blocks
+                prefixes.append((cloud, region, network, prefix_length))
+                region_prefix_count += 1
+    return (prefixes, np.array(sorted(used_blocks), dtype=np.uint32))
+
+def generate_links(rng: np.random.Generator, parameters: SyntheticItdkParameters, node_cities: np.ndarray,
+                   city_count: int) -> tuple[np.ndarray, np.ndarray]:
+    """Generate links with power-law degrees, as in the Chung-Lu model, where every node has at least one link, and
+        most links stay within a city. Some links connect a third node, as ITDK links may have more than two nodes."""
+    node_count = parameters.node_count
+    weights = rng.pareto(parameters.degree_exponent - 1, node_count) + 1
+    probabilities = weights / weights.sum()
+    link_count = max(node_count, round(node_count * parameters.mean_degree / 2))
+
+    first_nodes = np.concatenate((np.arange(node_count),
+                                  rng.choice(node_count, link_count - node_count, p=probabilities)))
+    # The second node is a random node in the same city, or any node by its weight.
+    nodes_by_city = np.argsort(node_cities, kind='stable')
+    city_starts = np.searchsorted(node_cities[nodes_by_city], np.arange(city_count + 1))
+    first_cities = node_cities[first_nodes]
+    city_sizes = city_starts[first_cities + 1] - city_starts[first_cities]
+    local_nodes = nodes_by_city[city_starts[first_cities] + (rng.random(link_count) * city_sizes).astype(np.int64)]
+    global_nodes = rng.choice(node_count, link_count, p=probabilities)
+    second_nodes = np.where(rng.random(link_count) < parameters.local_link_fraction, local_nodes, global_nodes)
+    third_nodes = np.where(rng.random(link_count) < parameters.multi_node_link_fraction,
+                           rng.choice(node_count, link_count, p=probabilities), -1)
+
+    is_kept = first_nodes != second_nodes
+    (first_nodes, second_nodes, third_nodes) = (first_nodes[is_kept], second_nodes[is_kept], third_nodes[is_kept])
+    third_nodes[(third_nodes == first_nodes) | (third_nodes == second_nodes)] = -1
+    lengths = 2 + (third_nodes >= 0)
+    link_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=link_offsets[1:])
+    link_nodes = np.column_stack((first_nodes, second_nodes, third_nodes)).reshape(-1)
+    return (link_offsets, link_nodes[link_nodes >= 0])
+
+def generate_synthetic_itdk(parameters: SyntheticItdkParameters) -> SyntheticItdk:
+    logging.info(f'Generating a synthetic ITDK snapshot of {parameters.node_count} nodes ...')
+    start_time = time.time()
+    rng = np.random.default_rng(parameters.seed)
+    node_count = parameters.node_count
+
+    # Nodes are clustered in cities, at the exact city centroid or nearby.
+    (city_lats, city_lons) = generate_cities(rng, parameters)
+    city_count = len(city_lats)
+    node_cities = rng.choice(city_count, node_count, p=get_power_law_weights(city_count,
+                                                                             parameters.city_size_exponent))
+    is_jittered = rng.random(node_count) < parameters.jittered_node_fraction
+    jitters = rng.normal(0, parameters.city_radius_deg, (2, node_count)) * is_jittered
+    node_lats = np.round(np.clip(city_lats[node_cities] + jitters[0], -89.9, 89.9), 4)
+    node_lons = np.round((city_lons[node_cities] + jitters[1] + 180) % 360 - 180, 4)
+    has_geo = rng.random(node_count) < parameters.geo_node_fraction
+
+    # Each AS is local to a city, and nodes belong to the AS of their city, or to a big transit AS.
+    asns = rng.choice(np.arange(1, 400000), city_count, replace=False)
+    node_asns = np.where(rng.random(node_count) < parameters.local_as_fraction, asns[node_cities],
+                         asns[rng.choice(city_count, node_count, p=get_power_law_weights(city_count, 1.0))])
+    node_as_tags = rng.choice(len(AS_HEURISTIC_TAGS), node_count, p=AS_HEURISTIC_TAG_WEIGHTS)
+
+    # Routers have one or more IPs (aliases), none in the cloud IP ranges yet.
+    (prefixes, cloud_blocks) = generate_cloud_prefixes(rng, parameters.prefixes_per_region)
+    alias_counts = np.minimum(rng.zipf(parameters.alias_exponent, node_count), parameters.max_alias_count)
+    ip_offsets = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(alias_counts, out=ip_offsets[1:])
+    ips = sample_unique_ips(rng, int(ip_offsets[-1]), cloud_blocks)
+
+    # Then a few nodes with geo coordinates in the city of each cloud region get an interface in its IP ranges.
+    cloud_nodes = []
+    used_nodes: set[int] = set()
+    used_cloud_ips: set[int] = set()
+    for (cloud, locations) in CLOUD_REGION_LOCATIONS.items():
+        for (region, location) in locations.items():
+            city = np.flatnonzero((city_lats == location[0]) & (city_lons == location[1]))[0]
+            candidates = [node for node in np.flatnonzero((node_cities == city) & has_geo).tolist()
+                          if node not in used_nodes]
+            region_prefixes = [prefix for prefix in prefixes if prefix[1] == region]
+            for node in rng.permutation(candidates)[:parameters.cloud_nodes_per_region].tolist():
+                (_, _, network, prefix_length) = region_prefixes[int(rng.integers(len(region_prefixes)))]
+                ip = network + int(rng.integers(1, (1 << (32 - prefix_length)) - 1))
+                if ip in used_cloud_ips:
+                    continue
+                used_nodes.add(node)
+                used_cloud_ips.add(ip)
+                cloud_nodes.append((cloud, region, node, ip))
+    cloud_prefixes = [(cloud, region, f'{uint32_to_ips(np.array([network]))[0]}/{prefix_length}')
+                      for (cloud, region, network, prefix_length) in prefixes]
+    if cloud_nodes:
+        extra_nodes = np.array([node for (_, _, node, _) in cloud_nodes], dtype=np.int64)
+        extra_ips = np.array([ip for (_, _, _, ip) in cloud_nodes], dtype=np.uint32)
+        # Each cloud node is picked once, and its cloud IP is inserted as its last IP.
+        ips = np.insert(ips, ip_offsets[extra_nodes + 1], extra_ips)
+        ip_offsets[1:] += np.cumsum(np.bincount(extra_nodes, minlength=node_count))
+    (link_offsets, link_nodes) = generate_links(rng, parameters, node_cities, city_count)
+    link_known_interfaces = rng.random(len(link_nodes)) < parameters.known_interface_fraction
+
+    elapsed_time = time.time() - start_time
+    logging.info(f'Elapsed: {elapsed_time:.2f}s, generated {node_count} nodes, {len(ips)} IPs, '
+                 f'{len(link_offsets) - 1} links and {len(cloud_nodes)} cloud nodes')
+    return SyntheticItdk(city_lats=city_lats, city_lons=city_lons, node_cities=node_cities, node_lats=node_lats,
+                         node_lons=node_lons, has_geo=has_geo, node_asns=node_asns, node_as_tags=node_as_tags,
+                         ip_offsets=ip_offsets, ips=ips, link_offsets=link_offsets, link_nodes=link_nodes,
+                         link_known_interfaces=link_known_interfaces, cloud_prefixes=cloud_prefixes,
+                         cloud_nodes=cloud_nodes)
+
+def get_link_edges(itdk: SyntheticItdk) -> tuple[np.ndarray, np.ndarray]:
+    """Return the (node, node) edges of all pairs of nodes on each link."""
+    starts = itdk.link_offsets[:-1]
+    is_multi_node = np.diff(itdk.link_offsets) == 3
+    multi_node_starts = starts[is_multi_node]
+    first_positions = np.concatenate((starts, multi_node_starts, multi_node_starts + 1))
+    second_positions = np.concatenate((starts + 1, multi_node_starts + 2, multi_node_starts + 2))
+    return (itdk.link_nodes[first_positions], itdk.link_nodes[second_positions])
+
+def generate_routes(rng: np.random.Generator, itdk: SyntheticItdk, route_count: int) -> list[list[str]]:
+    """Generate routes between the IPs of random pairs of cloud regions, each being the shortest path in hops from a
+        source cloud node to the nearest cloud node of the destination region, as itdk_links.py finds them.
+
+        Routes only go through nodes with geo coordinates, as itdk_links.py removes the others before building the graph,
+        and each intermediate hop is the first IP of its node.
+    """
+    logging.info(f'Generating {route_count} routes ...')
+    start_time = time.time()
+    node_count = len(itdk.node_cities)
+    regions = sorted(set((cloud, region) for (cloud, region, _, _) in itdk.cloud_nodes))
+    if len(regions) < 2:
+        logging.warning('Not enough cloud regions with nodes to generate routes')
+        return []
+    (first_nodes, second_nodes) = get_link_edges(itdk)
+    is_kept = itdk.has_geo[first_nodes] & itdk.has_geo[second_nodes]
+    (first_nodes, second_nodes) = (first_nodes[is_kept], second_nodes[is_kept])
+    ip_strs = uint32_to_ips(itdk.ips[itdk.ip_offsets[:-1]])
+
+    # Pick a random source cloud node and a random destination region in another region for each route.
+    src_indices = rng.integers(len(itdk.cloud_nodes), size=route_count)
+    dst_region_indices = rng.integers(len(regions) - 1, size=route_count)
+    region_indices = { region: i for i, region in enumerate(regions) }
+    src_region_indices = np.array([region_indices[(cloud, region)] for (cloud, region, _, _) in itdk.cloud_nodes])
+    dst_region_indices += dst_region_indices >= src_region_indices[src_indices]
+
+    routes: list[Optional[list[str]]] = [None] * route_count
+    for (dst_region_index, (dst_cloud, dst_region)) in enumerate(regions):
+        route_indices = np.flatnonzero(dst_region_indices == dst_region_index)
+        if not route_indices.size:
+            continue
+        dst_nodes = [(node, ip) for (cloud, region, node, ip) in itdk.cloud_nodes
+                     if (cloud, region) == (dst_cloud, dst_region)]
+        dst_ip_strs = dict(zip([node for (node, _) in dst_nodes],
+                               uint32_to_ips(np.array([ip for (_, ip) in dst_nodes], dtype=np.uint32))))
+        # A BFS from a virtual node linked to all destination nodes finds the nearest destination of every node.
+        rows = np.concatenate((first_nodes, np.full(len(dst_nodes), node_count)))
+        columns = np.concatenate((second_nodes, list(dst_ip_strs)))
+        graph = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, columns)),
+                           shape=(node_count + 1, node_count + 1))
+        (_, predecessors) = breadth_first_order(graph, node_count, directed=False, return_predecessors=True)
+
+        paths: dict[int, Optional[list[str]]] = {}
+        for route_index in route_indices.tolist():
+            (_, _, src_node, src_ip) = itdk.cloud_nodes[src_indices[route_index]]
+            if src_node not in paths:
+                path = [src_node]
+                while path[-1] >= 0 and predecessors[path[-1]] != node_count:
+                    path.append(int(predecessors[path[-1]]))
+                paths[src_node] = [uint32_to_ips(np.array([src_ip], dtype=np.uint32))[0]] + \
+                    [ip_strs[node] for node in path[1:-1]] + [dst_ip_strs[path[-1]]] if path[-1] >= 0 else None
+            routes[route_index] = paths[src_node]
+
+    routes = [route for route in routes if route is not None]
+    elapsed_time = time.time() - start_time
+    logging.info(f'Elapsed: {elapsed_time:.2f}s, generated {len(routes)} routes, '
+                 f'{route_count - len(routes)} between disconnected nodes are left out')
+    return routes
+
+def get_continent(lat: float, lon: float) -> str:
+    if lon < -30:
+        return 'NA' if lat > 12 else 'SA'
+    if lon < 60:
+        return 'EU' if lat > 35 else 'AF'
+    return 'OC' if lat < -10 else 'AS'
+
+def get_country(lat: float, lon: float) -> str:
+    """Return a two-letter code of the 15-degree grid cell of the coordinate, as the synthetic country."""
+    cell = int((lat + 90) // 15) * 24 + int((lon + 180) // 15)
+    return chr(ord('A') + cell // 26 % 26) + chr(ord('A') + cell % 26)
+
+def write_nodes_file(itdk: SyntheticItdk, filename: str) -> None:
+    ip_strs = uint32_to_ips(itdk.ips)
+    offsets = itdk.ip_offsets.tolist()
+    with open(filename, 'w') as file:
+        file.write('# Synthetic ITDK nodes generated by synthetic_itdk.py\n')
+        file.writelines(f'node N{i + 1}:  {" ".join(ip_strs[start:end])}\n'
+                        for i, (start, end) in enumerate(zip(offsets, offsets[1:])))
+
+def write_links_file(itdk: SyntheticItdk, filename: str) -> None:
+    first_ip_strs = uint32_to_ips(itdk.ips[itdk.ip_offsets[:-1]])
+    entries = [f'N{node + 1}:{first_ip_strs[node]}' if is_known else f'N{node + 1}'
+               for (node, is_known) in zip(itdk.link_nodes.tolist(), itdk.link_known_interfaces.tolist())]
+    offsets = itdk.link_offsets.tolist()
+    with open(filename, 'w') as file:
+        file.write('# Synthetic ITDK links generated by synthetic_itdk.py\n')
+        file.writelines(f'link L{i + 1}:  {" ".join(entries[start:end])}\n'
+                        for i, (start, end) in enumerate(zip(offsets, offsets[1:])))
+
+def write_node_geo_file(itdk: SyntheticItdk, filename: str) -> None:
+    city_columns = [(get_continent(lat, lon), get_country(lat, lon), f'R{city}', f'City{city}')
+                    for city, (lat, lon) in enumerate(zip(itdk.city_lats.tolist(), itdk.city_lons.tolist()))]
+    with open(filename, 'w') as file:
+        file.write('# Synthetic ITDK node geo locations generated by synthetic_itdk.py\n')
+        for node in np.flatnonzero(itdk.has_geo).tolist():
+            (continent, country, region, city) = city_columns[itdk.node_cities[node]]
+            file.write(f'node.geo N{node + 1}:\t{continent}\t{country}\t{region}\t{city}\t'
+                       f'{itdk.node_lats[node]}\t{itdk.node_lons[node]}\t\t\tsynthetic\n')
+
+def write_node_as_file(itdk: SyntheticItdk, filename: str) -> None:
+    with open(filename, 'w') as file:
+        file.write('# Synthetic ITDK node ASes generated by synthetic_itdk.py\n')
+        file.writelines(f'node.AS\tN{node + 1}\t{asn}\t{AS_HEURISTIC_TAGS[tag]}\n'
+                        for node, (asn, tag) in enumerate(zip(itdk.node_asns.tolist(), itdk.node_as_tags.tolist())))
+
+def write_cloud_ip_ranges_files(itdk: SyntheticItdk, parameters: SyntheticItdkParameters, aws_filename: str,
+                                gcloud_filename: str) -> None:
+    """Write the cloud IP ranges in the formats of the AWS and Google cloud ip-ranges JSON files."""
+    aws_prefixes = [{ 'ip_prefix': prefix, 'region': region, 'service': 'EC2', 'network_border_group': region }
+                    for (cloud, region, prefix) in itdk.cloud_prefixes if cloud == 'aws']
+    with open(aws_filename, 'w') as file:
+        json.dump({ 'syncToken': str(parameters.seed), 'createDate': '2023-01-01-00-00-00', 'prefixes': aws_prefixes,
+                    'ipv6_prefixes': [] }, file, indent=2)
+    gcloud_prefixes = [{ 'ipv4Prefix': prefix, 'service': 'Google Cloud', 'scope': region }
+                       for (cloud, region, prefix) in itdk.cloud_prefixes if cloud == 'gcloud']
+    with open(gcloud_filename, 'w') as file:
+        json.dump({ 'syncToken': str(parameters.seed), 'creationTime': '2023-01-01T00:00:00.000000',
+                    'prefixes': gcloud_prefixes }, file, indent=2)
+
+def write_iso_geojson_file(grid_deg: float, filename: str) -> None:
+    """Write ISO boundaries tiling the world in a grid, so that every coordinate resolves offline."""
+    features = []
+    for row, min_lat in enumerate(np.arange(-90, 90, grid_deg).tolist()):
+        for column, min_lon in enumerate(np.arange(-180, 180, grid_deg).tolist()):
+            (max_lat, max_lon) = (min(min_lat + grid_deg, 90), min(min_lon + grid_deg, 180))
+            features.append({
+                'type': 'Feature',
+                'properties': { 'zoneName': f'SYN-{row}-{column}' },
+                'geometry': { 'type': 'Polygon', 'coordinates': [[[min_lon, min_lat], [max_lon, min_lat],
+                                                                  [max_lon, max_lat], [min_lon, max_lat],
+                                                                  [min_lon, min_lat]]] },
+            })
+    with open(filename, 'w') as file:
+        json.dump({ 'type': 'FeatureCollection', 'features': features }, file)
+
+def write_synthetic_dataset(parameters: SyntheticItdkParameters, output_dir: str) -> dict:
+    """Generate a synthetic dataset into output_dir, in the layout of the *_FILENAME constants, and return its
+        manifest, which is also written to MANIFEST_FILENAME."""
+    itdk = generate_synthetic_itdk(parameters)
+    routes = generate_routes(np.random.default_rng(parameters.seed + 1), itdk, parameters.route_count)
+
+    logging.info(f'Writing the synthetic dataset to {output_dir} ...')
+    start_time = time.time()
+    for dirname in ['caida-itdk', 'cloud']:
+        os.makedirs(os.path.join(output_dir, dirname), exist_ok=True)
+    write_nodes_file(itdk, os.path.join(output_dir, ITDK_NODES_FILENAME))
+    write_links_file(itdk, os.path.join(output_dir, ITDK_LINKS_FILENAME))
+    write_node_geo_file(itdk, os.path.join(output_dir, ITDK_NODE_GEO_FILENAME))
+    write_node_as_file(itdk, os.path.join(output_dir, ITDK_NODE_AS_FILENAME))
+    write_cloud_ip_ranges_files(itdk, parameters, os.path.join(output_dir, AWS_IP_RANGES_FILENAME),
+                                os.path.join(output_dir, GCLOUD_IP_RANGES_FILENAME))
+    write_iso_geojson_file(parameters.iso_grid_deg, os.path.join(output_dir, ISO_GEOJSON_FILENAME))
+    with open(os.path.join(output_dir, ROUTES_FILENAME), 'w') as file:
+        file.writelines(f'{route}\n' for route in routes)
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'parameters': asdict(parameters),
+        'counts': {
+            'nodes': parameters.node_count,
+            'nodes_with_geo': int(np.count_nonzero(itdk.has_geo)),
+            'ips': len(itdk.ips),
+            'links': len(itdk.link_offsets) - 1,
+            'cities': len(itdk.city_lats),
+            'cloud_prefixes': len(itdk.cloud_prefixes),
+            'cloud_nodes': len(itdk.cloud_nodes),
+            'routes': len(routes),
+        },
+    }
+    with open(os.path.join(output_dir, MANIFEST_FILENAME), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    elapsed_time = time.time() - start_time
+    logging.info(f'Elapsed: {elapsed_time:.2f}s, wrote {manifest["counts"]}')
+    return manifest
+
+def parse_args():
+    defaults = SyntheticItdkParameters()
+    parser = argparse.ArgumentParser(description='Generate a synthetic ITDK snapshot (nodes, links, geo and AS files), '
+                                                 'with the matching cloud IP ranges, ISO boundaries and routes, to '
+                                                 'benchmark the pipeline at any scale.')
+    parser.add_argument('-o', '--output-dir', required=True, help='The directory to write the dataset to.')
+    parser.add_argument('--nodes', type=int, default=defaults.node_count, help='The number of nodes.')
+    parser.add_argument('--seed', type=int, default=defaults.seed, help='The random seed.')
+    parser.add_argument('--cities', type=int, default=defaults.city_count,
+                        help='The number of cities that nodes are clustered in, default to scale with the nodes.')
+    parser.add_argument('--mean-degree', type=float, default=defaults.mean_degree,
+                        help='The mean number of links per node.')
+    parser.add_argument('--degree-exponent', type=float, default=defaults.degree_exponent,
+                        help='The power-law exponent of the node degrees, which must be greater than 1.')
+    parser.add_argument('--geo-node-fraction', type=float, default=defaults.geo_node_fraction,
+                        help='The fraction of nodes with geo coordinates.')
+    parser.add_argument('--alias-exponent', type=float, default=defaults.alias_exponent,
+                        help='The Zipf exponent of the number of IPs per node, which must be greater than 1.')
+    parser.add_argument('--cloud-nodes-per-region', type=int, default=defaults.cloud_nodes_per_region,
+                        help='The number of nodes with an IP in the IP ranges of each cloud region.')
+    parser.add_argument('--routes', type=int, default=defaults.route_count,
+                        help='The number of routes between cloud regions to generate.')
+    args = parser.parse_args()
+
+    if args.nodes < 1:
+        parser.error('--nodes must be at least 1')
+    if args.degree_exponent <= 1 or args.alias_exponent <= 1:
+        parser.error('--degree-exponent and --alias-exponent must be greater than 1')
+    if not 0 <= args.geo_node_fraction <= 1:
+        parser.error('--geo-node-fraction must be between 0 and 1')
+
+    return args
+
+def main():
+    init_logging(level=logging.INFO)
+    args = parse_args()
+    parameters = SyntheticItdkParameters(node_count=args.nodes, seed=args.seed, city_count=args.cities,
+                                         mean_degree=args.mean_degree, degree_exponent=args.degree_exponent,
+                                         geo_node_fraction=args.geo_node_fraction, alias_exponent=args.alias_exponent,
+                                         cloud_nodes_per_region=args.cloud_nodes_per_region,
+                                         route_count=args.routes)
+    write_synthetic_dataset(parameters, args.output_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import ast
+
+import itdk_nodes
+from common import load_itdk_node_id_to_ips_mapping
+
+NODES = {
+    'N1': ['3.5.0.1', '10.0.0.1'],
+    'N2': ['3.5.1.0', '3.5.1.7', '52.94.0.1', '3.5.1.255'],
+    'N3': ['52.94.1.1'],
+    'N4': ['13.32.0.5', '13.32.255.255'],
+    'N5': ['192.168.0.1', '192.168.255.255', '192.169.0.0'],
+}
+OLD_IP_RANGES = [('3.5.0.0/24', 'aws', 'us-west-1'), ('52.94.0.0/22', 'aws', 'us-east-1'),
+                 ('13.32.0.0/16', 'aws', 'eu-west-1')]
+# 3.5.0.0/24 is re-regioned, 13.32.0.0/16 removed, 3.5.1.0/24 and 192.168.0.0/16 added.
+NEW_IP_RANGES = [('3.5.0.0/24', 'aws', 'us-west-2'), ('52.94.0.0/22', 'aws', 'us-east-1'),
+                 ('3.5.1.0/24', 'aws', 'us-west-1'), ('192.168.0.0/16', 'aws', 'ap-south-1')]
+
+def get_full_match(ip_ranges: list[tuple], node_file: str) -> dict:
+    return itdk_nodes.get_matching_node_ips(itdk_nodes.build_trie_from_ip_ranges(ip_ranges),
+                                            load_itdk_node_id_to_ips_mapping(node_file))
+
+def normalize(matched_node_ips: dict) -> dict:
+    return { node_id: sorted(matches) for (node_id, matches) in matched_node_ips.items() }
+
+def test_refresh_matched_nodes_equals_full_rematch(tmp_path, monkeypatch):
+    monkeypatch.setattr(itdk_nodes, 'load_cloud_ip_ranges_version',
+                        lambda cloud: { 'syncToken': '1', 'createDate': '2024-01-01' })
+    node_file = str(tmp_path / 'midar-iff.nodes')
+    with open(node_file, 'w') as file:
+        print('# ITDK nodes', file=file)
+        for node_id, ips in NODES.items():
+            print(f'node {node_id}:  {" ".join(ips)}', file=file)
+    matched_nodes_file = str(tmp_path / 'matched_nodes.aws.by_node.txt')
+    manifest_file = itdk_nodes.get_default_manifest_filename(matched_nodes_file)
+    with open(matched_nodes_file, 'w') as file:
+        print(get_full_match(OLD_IP_RANGES, node_file), file=file)
+    itdk_nodes.write_matched_nodes_manifest(manifest_file, 'aws', None, OLD_IP_RANGES)
+
+    stale_regions = itdk_nodes.refresh_matched_nodes(matched_nodes_file, manifest_file, 'aws', None, NEW_IP_RANGES,
+                                                     node_file)
+
+    with open(matched_nodes_file) as file:
+        refreshed = ast.literal_eval(file.read())
+    assert normalize(refreshed) == normalize(get_full_match(NEW_IP_RANGES, node_file))
+    assert stale_regions == {'us-west-1', 'us-west-2', 'eu-west-1', 'ap-south-1'}
+    assert itdk_nodes.refresh_matched_nodes(matched_nodes_file, manifest_file, 'aws', None, NEW_IP_RANGES,
+                                            node_file) == set()
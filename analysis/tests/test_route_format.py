@@ -0,0 +1,35 @@
+import pytest
+
+from common import iter_weighted_routes_from_file
+from route_format import RouteWriter, convert_binary_to_text, convert_text_to_binary, read_routes
+
+ROUTES_BY_HOP_TYPE = {
+    'ip': [['52.94.0.1', '10.0.0.1', '3.5.0.1'], ['52.94.0.1'], ['52.94.0.1', '3.5.0.1']],
+    'coordinate': [[(37.3394, -121.895), (38.0, -121.0), (39.0438, -77.4874)], [(37.3394, -121.895)],
+                   [(-33.8688, 151.2093), (1.3521, 103.8198)]],
+    'iso': [['emap:US-CAL-CISO', 'emap:US-NW-BPAT', 'emap:US-MIDA-PJM'], ['emap:US-CAL-CISO'],
+            ['emap:AU-NSW', 'Unknown']],
+}
+
+def write_text_routes(filename: str, weighted_routes: list, weighted: bool) -> None:
+    with RouteWriter(filename, weighted=weighted) as writer:
+        writer.write_weighted(weighted_routes)
+
+@pytest.mark.parametrize('hop_type', list(ROUTES_BY_HOP_TYPE))
+@pytest.mark.parametrize('weighted', [False, True])
+def test_text_binary_round_trip(tmp_path, hop_type, weighted):
+    routes = ROUTES_BY_HOP_TYPE[hop_type]
+    weighted_routes = [(route, i + 2 if weighted else 1) for i, route in enumerate(routes)]
+    text_file = str(tmp_path / 'routes.by_x')
+    binary_file = str(tmp_path / 'routes.by_x.bin')
+    round_trip_file = str(tmp_path / 'routes.round_trip.by_x')
+    write_text_routes(text_file, weighted_routes, weighted)
+
+    assert convert_text_to_binary(text_file, binary_file) == len(routes)
+    assert read_routes(binary_file).is_weighted == weighted
+    assert list(iter_weighted_routes_from_file(binary_file, log=False)) == \
+        list(iter_weighted_routes_from_file(text_file, log=False))
+
+    assert convert_binary_to_text(binary_file, round_trip_file) == len(routes)
+    with open(text_file) as file, open(round_trip_file) as round_trip:
+        assert round_trip.read() == file.read()